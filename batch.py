@@ -0,0 +1,55 @@
+import json
+import logging
+import argparse
+import torch
+
+from config import (
+    MODEL_ID,
+    BATCH_SIZE,
+    TORCH_NUM_THREADS,
+    CHAT_TEMPLATE_CACHE_SIZE
+)
+
+logger = logging.getLogger()
+
+# Offline batch inference, without the server
+# Runs a JSONL file of requests with padded model.generate calls and appends the results to an output JSONL
+# Running it again with the same output resumes where it stopped
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of chat completion requests offline with batched generation")
+    parser.add_argument("input", help="JSONL file, one request per line, in the same shape as the benchmark and /v1/batches files")
+    parser.add_argument("output", help="JSONL file the results are appended to, the lines already on it are skipped")
+    parser.add_argument("--model", default=MODEL_ID, help="Model id, by default MODEL_ID")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows of every generate call, by default BATCH_SIZE")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Override max_tokens of every request")
+    args = parser.parse_args()
+
+    # Lets import the model stack once the arguments are valid, it takes seconds
+    from transformers import AutoTokenizer
+    from src.ai.model_load import load_model, get_terminators
+    from src.ai.model_template import ChatTemplateCache
+    from src.ai.model_batch import BatchGenerator, read_batch_file
+
+    if TORCH_NUM_THREADS > 0:
+        torch.set_num_threads(TORCH_NUM_THREADS)
+
+    requests = read_batch_file(args.input)
+    if args.max_tokens is not None:
+        requests = [(custom_id, dict(json_data, max_tokens=args.max_tokens) if json_data is not None else None) for (custom_id, json_data) in requests]
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = load_model(args.model)
+    generator = BatchGenerator(
+        args.model,
+        tokenizer,
+        ChatTemplateCache(tokenizer, CHAT_TEMPLATE_CACHE_SIZE),
+        model,
+        get_terminators(tokenizer),
+        args.batch_size
+    )
+
+    stats = generator.run(requests, args.output)
+    print(json.dumps(stats, indent=4))
+
+if __name__ == "__main__":
+    main()
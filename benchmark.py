@@ -0,0 +1,415 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import httpx
+
+# Route we send the requests to
+INFERENCE_PATH = "/v1/chat/completions"
+
+# Fields used as the user message when a JSONL line has no messages
+TEXT_FIELDS = ("prompt", "content", "text", "body")
+
+# Corpus used to train the tokenizer of the tiny model
+TINY_CORPUS = [
+    "You are a helpful assistant.",
+    "Hello, how are you? I am fine, thanks for asking.",
+    "Whats the capital of Puerto Rico? The capital of Puerto Rico is San Juan.",
+    "Write a short poem about the sea, the wind and the stars.",
+    "def add(a, b):\n    return a + b\n",
+    "The quick brown fox jumps over the lazy dog 0123456789.",
+]
+
+# Llama 3 chat template
+TINY_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "<|start_header_id|>{{ message['role'] }}<|end_header_id|>\n\n{{ message['content'] }}<|eot_id|>"
+    "{% endfor %}{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+)
+
+class RequestResult:
+    """Timings and output of a single benchmark request."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.status = None
+        self.error = None
+        self.started_at = None
+        self.first_chunk_at = None
+        self.finished_at = None
+        self.text = ""
+
+    @property
+    def ok(self):
+        return self.error is None and self.status == 200
+
+    @property
+    def latency(self):
+        return self.finished_at - self.started_at
+
+    @property
+    def time_to_first_token(self):
+        return self.first_chunk_at - self.started_at
+
+class HttpClient:
+    """Sends the requests to a running server."""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.client = httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=None))
+
+    async def post(self, payload, on_chunk):
+        async with self.client.stream("POST", self.url + INFERENCE_PATH, json=payload) as response:
+            async for chunk in response.aiter_bytes():
+                on_chunk(chunk)
+            return response.status_code
+
+    async def close(self):
+        await self.client.aclose()
+
+class AsgiClient:
+    """
+    Sends the requests straight to the Starlette app, in the same process.
+    We drive the ASGI interface ourselves so every body chunk is timed as it is sent.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.lifespan_queue = asyncio.Queue()
+        self.lifespan_task = None
+
+    # Run the app startup, like uvicorn does
+    async def start(self):
+        startup = asyncio.Event()
+        await self.lifespan_queue.put({"type": "lifespan.startup"})
+
+        async def send(message):
+            if message["type"].startswith("lifespan.startup"):
+                if message["type"] == "lifespan.startup.failed":
+                    raise RuntimeError(message.get("message", "Application startup failed"))
+                startup.set()
+
+        scope = {"type": "lifespan", "asgi": {"version": "3.0", "spec_version": "2.0"}, "state": {}}
+        self.lifespan_task = asyncio.create_task(self.app(scope, self.lifespan_queue.get, send))
+        await startup.wait()
+
+    async def post(self, payload, on_chunk):
+        body = json.dumps(payload).encode("utf-8")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": INFERENCE_PATH,
+            "raw_path": INFERENCE_PATH.encode("utf-8"),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"benchmark"), (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("utf-8"))],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+            "state": {},
+        }
+        status = None
+        request_sent = False
+        response_done = asyncio.Event()
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The client stays connected until the whole response is sent
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                if message.get("body"):
+                    on_chunk(message["body"])
+                if not message.get("more_body", False):
+                    response_done.set()
+
+        await self.app(scope, receive, send)
+        return status
+
+    async def close(self):
+        if self.lifespan_task is not None:
+            await self.lifespan_queue.put({"type": "lifespan.shutdown"})
+            await asyncio.wait([self.lifespan_task], timeout=10)
+
+# Read the JSONL file and turn every line into a chat completion request
+def load_payloads(path):
+    payloads = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if "messages" in row:
+                payloads.append(dict(row))
+                continue
+            text = next((row[field] for field in TEXT_FIELDS if isinstance(row.get(field), str)), None)
+            if text is not None:
+                payloads.append({"messages": [{"role": "user", "content": text}]})
+    return payloads
+
+# Apply the command line overrides to a request
+def prepare_payload(payload, args, rng):
+    payload = dict(payload)
+    if args.max_tokens is not None:
+        payload["max_tokens"] = args.max_tokens
+    if args.stream_ratio is not None:
+        payload["stream"] = rng.random() < args.stream_ratio
+    payload["stream"] = payload.get("stream") is True
+    return payload
+
+# Send a request and record its timings
+async def send_request(client, payload):
+    result = RequestResult(payload["stream"])
+    chunks = []
+
+    def on_chunk(chunk):
+        if result.first_chunk_at is None:
+            result.first_chunk_at = time.perf_counter()
+        chunks.append(chunk)
+
+    result.started_at = time.perf_counter()
+    try:
+        result.status = await client.post(payload, on_chunk)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.finished_at = time.perf_counter()
+    if result.first_chunk_at is None:
+        result.first_chunk_at = result.finished_at
+
+    if result.ok:
+        try:
+            (result.text, result.error) = parse_response(b"".join(chunks).decode("utf-8"), result.stream)
+        except ValueError as e:
+            result.error = f"Invalid response: {e}"
+    return result
+
+# Returns (text, error) from a chat completion response
+def parse_response(body, stream):
+    if not stream:
+        data = json.loads(body)
+        return (data["choices"][0]["message"]["content"], None)
+
+    text = []
+    for event in body.split("\n\n"):
+        if not event.startswith("data: ") or event == "data: [DONE]":
+            continue
+        data = json.loads(event[len("data: "):])
+        if "error" in data:
+            return ("".join(text), data["error"].get("code", "error"))
+        text.append(data["choices"][0]["delta"].get("content", ""))
+    return ("".join(text), None)
+
+# Closed loop, every worker sends its next request as soon as the previous one is done
+async def run_closed_loop(client, payloads, concurrency):
+    results = []
+    iterator = iter(payloads)
+
+    async def worker():
+        for payload in iterator:
+            results.append(await send_request(client, payload))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+# Open loop, requests arrive as a Poisson process no matter how fast the server answers
+async def run_open_loop(client, payloads, rate, rng):
+    tasks = []
+    for payload in payloads:
+        tasks.append(asyncio.create_task(send_request(client, payload)))
+        await asyncio.sleep(rng.expovariate(rate))
+    return await asyncio.gather(*tasks)
+
+# Percentile with linear interpolation between the closest ranks
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def distribution(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else None,
+    }
+
+# Lets build the report of the run
+def summarize(results, duration, count_tokens):
+    succeeded = [result for result in results if result.ok]
+    errors = {}
+    for result in results:
+        if not result.ok:
+            key = result.error or f"http_{result.status}"
+            errors[key] = errors.get(key, 0) + 1
+
+    completion_tokens = None
+    if count_tokens is not None:
+        completion_tokens = sum(count_tokens(result.text) for result in succeeded)
+
+    return {
+        "requests": len(results),
+        "stream_requests": sum(1 for result in results if result.stream),
+        "errors": len(results) - len(succeeded),
+        "error_rate": (len(results) - len(succeeded)) / len(results) if results else 0.0,
+        "errors_by_type": errors,
+        "duration_seconds": duration,
+        "requests_per_second": len(succeeded) / duration if duration > 0 else None,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / duration if completion_tokens is not None and duration > 0 else None,
+        # Only streamed responses tell us when the first token arrived
+        "ttft_seconds": distribution([result.time_to_first_token for result in succeeded if result.stream]),
+        "latency_seconds": distribution([result.latency for result in succeeded]),
+    }
+
+# Commit of the tree we are benchmarking, so runs can be compared
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Tokenizer used to count the generated tokens, None if it can not be loaded
+def load_token_counter(tokenizer_id):
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+    except Exception as e:
+        print(f"Tokenizer {tokenizer_id} could not be loaded, tokens will not be counted: {e}", file=sys.stderr)
+        return None
+    return lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+# Create a tiny Llama with random weights and its own tokenizer, so the benchmark runs offline on CPU
+def create_tiny_model(path, seed=0):
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    special_tokens = ["<|begin_of_text|>", "<|end_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=512, special_tokens=special_tokens, initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(TINY_CORPUS, trainer=trainer)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|begin_of_text|>",
+        eos_token="<|end_of_text|>",
+        chat_template=TINY_CHAT_TEMPLATE,
+    )
+
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        tie_word_embeddings=False,
+    )
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config).to(torch.bfloat16)
+
+    model.save_pretrained(path, safe_serialization=True)
+    tokenizer.save_pretrained(path)
+    print(f"Tiny model saved on {path}, use it with MODEL_ID={path}", file=sys.stderr)
+
+async def run(args):
+    rng = random.Random(args.seed)
+
+    payloads = load_payloads(args.input)
+    if not payloads:
+        raise SystemExit(f"No requests found on {args.input}")
+
+    # Lets cycle over the file until we have the number of requests we want
+    count = args.num_requests or len(payloads)
+    payloads = [prepare_payload(payloads[index % len(payloads)], args, rng) for index in range(count + args.warmup)]
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        # The server loads the model on the background once it starts, lets wait until it is ready
+        from server import app, startup
+        client = AsgiClient(app)
+        await client.start()
+        while not startup.ready:
+            if startup.status == "failed":
+                raise SystemExit(f"The model could not be loaded: {startup.error}")
+            await asyncio.sleep(0.1)
+
+    try:
+        # Warm up requests are not measured
+        if args.warmup:
+            await run_closed_loop(client, payloads[:args.warmup], args.concurrency)
+        payloads = payloads[args.warmup:]
+
+        started_at = time.perf_counter()
+        if args.rate:
+            results = await run_open_loop(client, payloads, args.rate, rng)
+        else:
+            results = await run_closed_loop(client, payloads, args.concurrency)
+        duration = time.perf_counter() - started_at
+    finally:
+        await client.close()
+
+    from config import MODEL_ID
+    report = {
+        "commit": current_commit(),
+        "mode": "http" if args.url else "asgi",
+        "url": args.url,
+        "model": MODEL_ID,
+        "input": args.input,
+        "concurrency": None if args.rate else args.concurrency,
+        "rate": args.rate,
+        "stream_ratio": args.stream_ratio,
+        "max_tokens": args.max_tokens,
+    }
+    report.update(summarize(results, duration, load_token_counter(args.tokenizer or MODEL_ID)))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay JSONL chat completion requests against Palma.py and report latency and throughput")
+    parser.add_argument("input", nargs="?", default="requests.jsonl", help="JSONL file, one request per line")
+    parser.add_argument("--url", help="Server url, like http://127.0.0.1:8000. Without it the app runs in process")
+    parser.add_argument("--num-requests", type=int, default=0, help="Requests to send, the file is replayed in a loop. 0 sends every line once")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight on the closed loop mode")
+    parser.add_argument("--rate", type=float, default=0, help="Requests per second on the open loop (Poisson) mode")
+    parser.add_argument("--stream-ratio", type=float, default=None, help="Share of streaming requests, by default the stream value of each line is used")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Override max_tokens of every request")
+    parser.add_argument("--warmup", type=int, default=0, help="Requests sent before measuring")
+    parser.add_argument("--tokenizer", default=None, help="Tokenizer used to count the generated tokens, by default MODEL_ID")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file")
+    parser.add_argument("--create-tiny-model", metavar="PATH", default=None, help="Create a tiny random Llama on PATH and exit")
+    args = parser.parse_args()
+
+    if args.create_tiny_model:
+        create_tiny_model(args.create_tiny_model, args.seed)
+        return
+
+    report = json.dumps(asyncio.run(run(args)), indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    print(report)
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,31 @@
 import os
-import torch
 import logging
 from dotenv import load_dotenv, find_dotenv
 
-# Import packages from src
-
-import src.ai.model_gpu as model_gpu
-
-# We re-export the packages
-__all__ = [
-    'model_gpu',
-]
-
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
 # Check if the .env file exists and load it
+# Without it, the settings come from the environment variables and the defaults
 dotenv_path = find_dotenv()
-if not dotenv_path:
-    raise FileNotFoundError("The .env file is missing. Please create one in the root directory.")
-
-load_dotenv(dotenv_path)
+if dotenv_path:
+    load_dotenv(dotenv_path)
+else:
+    logger.warning("The .env file is missing, using the environment variables and the defaults")
 
 def str_to_bool(value):
     return value.lower() in {'true', '1', 't', 'y', 'yes'}
+def str_to_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+def str_to_weights(value):
+    weights = {}
+    for item in str_to_list(value):
+        (key, _, weight) = item.rpartition(":")
+        if not key or float(weight) <= 0:
+            raise ValueError(f"Invalid weight {item}")
+        weights[key] = float(weight)
+    return weights
 def get_env_variable(name, cast_type=str, default=None):
     value = os.getenv(name, default)
     try:
@@ -36,25 +37,69 @@ def get_env_variable(name, cast_type=str, default=None):
 
 DEBUG = get_env_variable('DEBUG', str_to_bool, False)
 THREADS_MAX_WORKERS = get_env_variable('THREADS_MAX_WORKERS', int, 10)
+MAX_BATCH_SIZE = get_env_variable('MAX_BATCH_SIZE', int, 16)
+TORCH_NUM_THREADS = get_env_variable('TORCH_NUM_THREADS', int, 0)
+
+# Replicas Settings
+
+REPLICAS = get_env_variable('REPLICAS', int, 1)
+REPLICA_BASE_PORT = get_env_variable('REPLICA_BASE_PORT', int, 9000)
+REPLICA_ID = get_env_variable('REPLICA_ID', str, "")
+
+# Admission Control
+
+MAX_QUEUE_DEPTH = get_env_variable('MAX_QUEUE_DEPTH', int, 256)
+QUEUE_RETRY_AFTER = get_env_variable('QUEUE_RETRY_AFTER', int, 1)
+REQUEST_TIMEOUT = get_env_variable('REQUEST_TIMEOUT', float, 300)
+KV_CACHE_BUDGET_MB = get_env_variable('KV_CACHE_BUDGET_MB', int, 0)
+
+# Rate Limiting
+
+RATE_LIMIT_REQUESTS_PER_SECOND = get_env_variable('RATE_LIMIT_REQUESTS_PER_SECOND', float, 0)
+RATE_LIMIT_REQUESTS_BURST = get_env_variable('RATE_LIMIT_REQUESTS_BURST', float, 0)
+RATE_LIMIT_TOKENS_PER_SECOND = get_env_variable('RATE_LIMIT_TOKENS_PER_SECOND', float, 0)
+RATE_LIMIT_TOKENS_BURST = get_env_variable('RATE_LIMIT_TOKENS_BURST', float, 0)
+API_KEY_WEIGHTS = get_env_variable('API_KEY_WEIGHTS', str_to_weights, "")
 
 # Model Settings
 
 MODEL_ID = get_env_variable('MODEL_ID', str, "meta-llama/Meta-Llama-3-8B-Instruct")
+MODEL_IDS = get_env_variable('MODEL_IDS', str_to_list, "")
+MODEL_MEMORY_BUDGET_MB = get_env_variable('MODEL_MEMORY_BUDGET_MB', int, 0)
+PINNED_MODEL_IDS = get_env_variable('PINNED_MODEL_IDS', str_to_list, "")
 CONVERT_TOKENS_TO_IDS = get_env_variable('CONVERT_TOKENS_TO_IDS', str, "<|eot_id|>")
+PREFIX_CACHE_MAX_MB = get_env_variable('PREFIX_CACHE_MAX_MB', int, 1024)
+CHAT_TEMPLATE_CACHE_SIZE = get_env_variable('CHAT_TEMPLATE_CACHE_SIZE', int, 4096)
+MMAP_WEIGHTS = get_env_variable('MMAP_WEIGHTS', str_to_bool, "True")
+
+# Speculative Decoding
+
+SPECULATIVE_MODE = get_env_variable('SPECULATIVE_MODE', str, "")
+DRAFT_MODEL_ID = get_env_variable('DRAFT_MODEL_ID', str, "")
+SPECULATIVE_TOKENS = get_env_variable('SPECULATIVE_TOKENS', int, 5)
+PROMPT_LOOKUP_MAX_NGRAM = get_env_variable('PROMPT_LOOKUP_MAX_NGRAM', int, 3)
+
+# Static Key/Value Cache
+
+STATIC_KV_CACHE = get_env_variable('STATIC_KV_CACHE', str_to_bool, "False")
+STATIC_KV_CACHE_LENGTHS = [int(length) for length in get_env_variable('STATIC_KV_CACHE_LENGTHS', str_to_list, "512,1024,2048")]
+TORCH_COMPILE = get_env_variable('TORCH_COMPILE', str_to_bool, "True")
 
 # Torch DType
-# We can expand support here for other types
-if os.getenv('TORCH_DTYPE') == "bfloat16":
-    TORCH_DTYPE = torch.bfloat16
-# Default value
-else:
-    TORCH_DTYPE = torch.bfloat16
+# The name of a torch dtype, config does not import torch so the server starts fast
 
-# Set the environment variable for MPS fallback
-os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
+TORCH_DTYPES = ("bfloat16", "float16", "float32")
+TORCH_DTYPE = get_env_variable('TORCH_DTYPE', str, "bfloat16")
+if TORCH_DTYPE not in TORCH_DTYPES:
+    raise ValueError(f"Environment variable TORCH_DTYPE must be one of {', '.join(TORCH_DTYPES)}")
+
+# Quantization
 
-# What device are we using
-logger.info(f"Using device: {model_gpu.device}")
+QUANTIZATION = get_env_variable('QUANTIZATION', str, "")
+QUANTIZATION_GROUP_SIZE = get_env_variable('QUANTIZATION_GROUP_SIZE', int, 128)
+
+# Set the environment variable for MPS fallback, before torch is imported
+os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
 
 # Model Inference Settings
 
@@ -62,6 +107,48 @@ DEFAULT_DO_SAMPLE = get_env_variable('DEFAULT_DO_SAMPLE', str_to_bool, True)
 DEFAULT_MAX_TOKENS = get_env_variable('DEFAULT_MAX_TOKENS', int, 256)
 DEFAULT_TEMPERATURE = get_env_variable('DEFAULT_TEMPERATURE', float, 0.6)
 DEFAULT_TOP_P = get_env_variable('DEFAULT_TOP_P', float, 0.7)
+MAX_CHOICES = get_env_variable('MAX_CHOICES', int, 8)
+
+# Completion Cache Settings
+
+COMPLETION_CACHE_SIZE = get_env_variable('COMPLETION_CACHE_SIZE', int, 1024)
+COMPLETION_CACHE_TTL = get_env_variable('COMPLETION_CACHE_TTL', int, 3600)
+COMPLETION_CACHE_DIR = get_env_variable('COMPLETION_CACHE_DIR', str, "")
+
+# Embeddings Settings
+
+EMBEDDINGS_POOLING = get_env_variable('EMBEDDINGS_POOLING', str, "mean")
+EMBEDDINGS_NORMALIZE = get_env_variable('EMBEDDINGS_NORMALIZE', str_to_bool, "True")
+EMBEDDINGS_BATCH_WINDOW_MS = get_env_variable('EMBEDDINGS_BATCH_WINDOW_MS', float, 5)
+EMBEDDINGS_MAX_BATCH_SIZE = get_env_variable('EMBEDDINGS_MAX_BATCH_SIZE', int, 32)
+EMBEDDINGS_MAX_TOKENS = get_env_variable('EMBEDDINGS_MAX_TOKENS', int, 8192)
+EMBEDDINGS_CACHE_SIZE = get_env_variable('EMBEDDINGS_CACHE_SIZE', int, 4096)
+
+# Batch Settings
+
+BATCH_SIZE = get_env_variable('BATCH_SIZE', int, 16)
+BATCH_MAX_IN_FLIGHT = get_env_variable('BATCH_MAX_IN_FLIGHT', int, 4)
+BATCH_DIR = get_env_variable('BATCH_DIR', str, "batches")
+BATCH_JOB_TTL = get_env_variable('BATCH_JOB_TTL', int, 86400)
+BATCH_MAX_JOBS = get_env_variable('BATCH_MAX_JOBS', int, 1000)
+
+# Streaming Settings
+
+STREAM_COALESCE_MS = get_env_variable('STREAM_COALESCE_MS', float, 10)
+STREAM_COALESCE_BYTES = get_env_variable('STREAM_COALESCE_BYTES', int, 256)
+
+# Tracing Settings
+
+TRACING_ENABLED = get_env_variable('TRACING_ENABLED', str_to_bool, "False")
+TRACE_LOG_FILE = get_env_variable('TRACE_LOG_FILE', str, "")
+TRACE_SAMPLE_RATE = get_env_variable('TRACE_SAMPLE_RATE', float, 0.01)
+ADMIN_API_KEY = get_env_variable('ADMIN_API_KEY', str, "")
+PROFILE_DIR = get_env_variable('PROFILE_DIR', str, "profiles")
+
+# Compression Settings
+
+GZIP_MINIMUM_SIZE = get_env_variable('GZIP_MINIMUM_SIZE', int, 1000)
+GZIP_COMPRESS_LEVEL = get_env_variable('GZIP_COMPRESS_LEVEL', int, 1)
 
 # CORS
 
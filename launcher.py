@@ -0,0 +1,133 @@
+import os
+import sys
+import logging
+import argparse
+import threading
+import subprocess
+import uvicorn
+from src.restapi.replica_router import create_app
+
+from config import (
+    REPLICAS,
+    REPLICA_BASE_PORT
+)
+
+logger = logging.getLogger()
+
+# The router logs every request already, no need for the client logs
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Split the CPU cores in count disjoint sets
+# Neighbouring cores stay on the same set, the first sets get the remainder
+def partition_cpus(cpus, count):
+    (size, remainder) = divmod(len(cpus), count)
+    sets = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < remainder else 0)
+        sets.append(cpus[start:end])
+        start = end
+    return sets
+
+# Cores this process is allowed to run on
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+class ReplicaProcess:
+    """
+    A server process with its own model replica, pinned to its own CPU set.
+    The torch, OpenMP and MKL thread pools are sized to the CPU set, so replicas do not oversubscribe the cores.
+    """
+    def __init__(self, index, port, cpus):
+        self.index = index
+        self.port = port
+        self.cpus = cpus
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = None
+
+    def start(self):
+        threads = str(len(self.cpus))
+        env = dict(os.environ)
+        env["TORCH_NUM_THREADS"] = threads
+        env["OMP_NUM_THREADS"] = threads
+        env["MKL_NUM_THREADS"] = threads
+
+        # The replica puts its index on the ids of its batches, so the router sends them back to it
+        env["REPLICA_ID"] = str(self.index)
+
+        # CPU pinning is only available on Linux, other platforms only get the thread count
+        preexec_fn = None
+        if hasattr(os, "sched_setaffinity"):
+            preexec_fn = lambda: os.sched_setaffinity(0, self.cpus)
+
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(self.port)],
+            env=env,
+            preexec_fn=preexec_fn,
+        )
+        logger.info(f"Replica on port {self.port} started with {threads} threads on cpus {self.cpus}")
+
+    def stop(self, timeout=10):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class ReplicaSupervisor:
+    """Starts the replicas and restarts the ones that exit, until it is stopped."""
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="palmapy-supervisor", daemon=True)
+
+    def start(self):
+        for replica in self.replicas:
+            replica.start()
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(1):
+            for replica in self.replicas:
+                if replica.process.poll() is not None and not self.stopping.is_set():
+                    logger.warning(f"Replica on port {replica.port} exited with code {replica.process.returncode}, restarting it")
+                    replica.start()
+
+    def stop(self):
+        self.stopping.set()
+        for replica in self.replicas:
+            replica.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Palma.py with multiple model replicas behind a router")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--replicas", type=int, default=REPLICAS)
+    parser.add_argument("--replica-base-port", type=int, default=REPLICA_BASE_PORT)
+    args = parser.parse_args()
+
+    # Lets make sure every replica has at least one core
+    cpus = available_cpus()
+    count = max(1, min(args.replicas, len(cpus)))
+    if count < args.replicas:
+        logger.warning(f"Only {len(cpus)} cpus are available, running {count} replicas")
+
+    replicas = [
+        ReplicaProcess(index, args.replica_base_port + index, cpu_set)
+        for index, cpu_set in enumerate(partition_cpus(cpus, count))
+    ]
+    supervisor = ReplicaSupervisor(replicas)
+    supervisor.start()
+
+    # The router answers 503 until the replicas have loaded their model
+    try:
+        uvicorn.run(create_app([replica.url for replica in replicas]), host=args.host, port=args.port)
+    finally:
+        supervisor.stop()
+
+if __name__ == "__main__":
+    main()
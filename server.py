@@ -1,29 +1,97 @@
-import src.ai.model_load as model_load
-
+import contextlib
 from starlette.routing import Route
 from starlette.middleware import Middleware
 from starlette.applications import Starlette
-from starlette.middleware.gzip import GZipMiddleware
 
 import src.restapi.constants as constants
-import src.routes.route_inference as route_inference
+import src.routes.route_metrics as route_metrics
+import src.routes.route_models as route_models
 import src.routes.route_healthcheck as route_healthcheck
 import src.restapi.request_middleware as request_middleware
 from src.restapi.exception_handlers import exception_handlers_list
+from src.ai.model_startup import ModelStartup
 
 from config import (
-    DEBUG
+    DEBUG,
+    GZIP_MINIMUM_SIZE,
+    GZIP_COMPRESS_LEVEL
 )
 
-# Lets globally load the model
-model_dependencies = model_load.init()
+# Lets load the model on the background, the server answers the healthchecks while it loads
+startup = ModelStartup()
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    startup.start()
+    yield
 
 # route baseline open ai version
 base_route = "/v1"
 
 # route_inference handler with dependency injection
 async def route_inference_dependencies(request):
-    return await route_inference.inference(request, **model_dependencies)
+    if not startup.ready:
+        return route_healthcheck.not_ready_response(startup)
+
+    # The route imports the model stack, it is only imported once the model is loaded
+    import src.routes.route_inference as route_inference
+    return await route_inference.inference(request, startup.dependencies["registry"], startup.dependencies["metrics"], startup.dependencies["limiter"], startup.dependencies["tracer"])
+
+# route_embeddings handler with dependency injection
+async def route_embeddings_dependencies(request):
+    if not startup.ready:
+        return route_healthcheck.not_ready_response(startup)
+
+    # The route imports the model stack, it is only imported once the model is loaded
+    import src.routes.route_embeddings as route_embeddings
+    return await route_embeddings.embeddings(request, startup.dependencies["registry"], startup.dependencies["metrics"], startup.dependencies["limiter"])
+
+# route_metrics handler with dependency injection
+async def route_metrics_dependencies(request):
+    if not startup.ready:
+        return route_healthcheck.not_ready_response(startup)
+    return await route_metrics.metrics(request, startup.dependencies["metrics"])
+
+# route_models handler with dependency injection
+async def route_models_dependencies(request):
+    if not startup.ready:
+        return route_healthcheck.not_ready_response(startup)
+    return await route_models.models(request, startup.dependencies["registry"])
+
+# route_batches handlers with dependency injection
+# The route imports the model stack, it is only imported once the model is loaded
+def route_batches_dependencies(handler_name):
+    async def handler(request):
+        if not startup.ready:
+            return route_healthcheck.not_ready_response(startup)
+
+        import src.routes.route_batches as route_batches
+        return await getattr(route_batches, handler_name)(request, startup.dependencies["batches"])
+    return handler
+
+# route_admin handlers with dependency injection
+async def route_start_profile_dependencies(request):
+    if not startup.ready:
+        return route_healthcheck.not_ready_response(startup)
+
+    import src.routes.route_admin as route_admin
+    return await route_admin.start_profile(request, startup.dependencies["registry"], startup.dependencies["profiles"])
+
+def route_profiles_dependencies(handler_name):
+    async def handler(request):
+        if not startup.ready:
+            return route_healthcheck.not_ready_response(startup)
+
+        import src.routes.route_admin as route_admin
+        return await getattr(route_admin, handler_name)(request, startup.dependencies["profiles"])
+    return handler
+
+# route_healthcheck handlers with dependency injection
+async def route_liveness_dependencies(request):
+    return await route_healthcheck.healthcheck(request, startup)
+
+async def route_readiness_dependencies(request):
+    return await route_healthcheck.readiness(request, startup)
 
 # Create the Starlette application
 app = Starlette(
@@ -33,29 +101,68 @@ app = Starlette(
     # Define the routes for the Starlette application
     routes=[
         # Create a route for healthchecks
+        # The process is alive as soon as it answers, it is ready once the model is loaded
         Route(base_route + "/healthcheck", request_middleware.options_handler_get, methods=["OPTIONS"]),
-        Route(base_route + "/healthcheck", route_healthcheck.healthcheck, methods=["GET"]),
+        Route(base_route + "/healthcheck", route_liveness_dependencies, methods=["GET"]),
+        Route(base_route + "/healthcheck/ready", request_middleware.options_handler_get, methods=["OPTIONS"]),
+        Route(base_route + "/healthcheck/ready", route_readiness_dependencies, methods=["GET"]),
+
+        # Create a route for the Prometheus metrics
+        Route(base_route + "/metrics", request_middleware.options_handler_get, methods=["OPTIONS"]),
+        Route(base_route + "/metrics", route_metrics_dependencies, methods=["GET"]),
         
+        # Create a route for the models we can serve
+        Route(base_route + "/models", request_middleware.options_handler_get, methods=["OPTIONS"]),
+        Route(base_route + "/models", route_models_dependencies, methods=["GET"]),
+
         # Create a route for the standard OPEN AI inference, accessible via POST method
         Route(base_route + "/chat/completions", request_middleware.options_handler_post, methods=["OPTIONS"]),
         Route(base_route + "/chat/completions", route_inference_dependencies, methods=["POST"]),
+
+        # Create a route for the OPEN AI embeddings, from the hidden states of the same models
+        Route(base_route + "/embeddings", request_middleware.options_handler_post, methods=["OPTIONS"]),
+        Route(base_route + "/embeddings", route_embeddings_dependencies, methods=["POST"]),
+
+        # Create the routes for the OPEN AI batches, they run behind the interactive requests
+        Route(base_route + "/batches", request_middleware.options_handler_get_post, methods=["OPTIONS"]),
+        Route(base_route + "/batches", route_batches_dependencies("create_batch"), methods=["POST"]),
+        Route(base_route + "/batches", route_batches_dependencies("list_batches"), methods=["GET"]),
+        Route(base_route + "/batches/{batch_id}", request_middleware.options_handler_get, methods=["OPTIONS"]),
+        Route(base_route + "/batches/{batch_id}", route_batches_dependencies("get_batch"), methods=["GET"]),
+        Route(base_route + "/batches/{batch_id}/cancel", request_middleware.options_handler_post, methods=["OPTIONS"]),
+        Route(base_route + "/batches/{batch_id}/cancel", route_batches_dependencies("cancel_batch"), methods=["POST"]),
+        Route(base_route + "/batches/{batch_id}/output", request_middleware.options_handler_get, methods=["OPTIONS"]),
+        Route(base_route + "/batches/{batch_id}/output", route_batches_dependencies("batch_output"), methods=["GET"]),
+
+        # Create the admin routes, they need ADMIN_API_KEY
+        Route(base_route + "/admin/profile", request_middleware.options_handler_get_post, methods=["OPTIONS"]),
+        Route(base_route + "/admin/profile", route_start_profile_dependencies, methods=["POST"]),
+        Route(base_route + "/admin/profile", route_profiles_dependencies("list_profiles"), methods=["GET"]),
+        Route(base_route + "/admin/profile/{profile_id}", request_middleware.options_handler_get, methods=["OPTIONS"]),
+        Route(base_route + "/admin/profile/{profile_id}", route_profiles_dependencies("get_profile"), methods=["GET"]),
     ],
 
     # Define the middlewares needed
     middleware = [
-        Middleware(GZipMiddleware, minimum_size=1000, compresslevel=9),
-        Middleware(request_middleware.CustomHeadersMiddleware, headers={
-            constants.API_VERSION_HTTP_HEADER_NAME: constants.API_VERSION,
-
-            # Im adding the CORS here, because the standard CORSMiddleware was not working properly
-            constants.HEADER_DEFAULT_ACCESS_CONTROL_MAX_AGE: constants.HTTP_DEFAULT_ACCESS_CONTROL_MAX_AGE,
-            constants.HEADER_DEFAULT_ACCESS_CONTROL_ALLOW_ORIGIN: constants.HTTP_DEFAULT_ACCESS_CONTROL_ALLOW_ORIGIN,
-            constants.HEADER_DEFAULT_ACCESS_CONTROL_ALLOW_HEADERS: constants.HTTP_DEFAULT_ACCESS_CONTROL_ALLOW_HEADERS
-        }),
-        Middleware(request_middleware.DefaultContentTypeMiddleware, content_type=constants.HTTP_DEFAULT_CONTENT_TYPE),
-        Middleware(request_middleware.ValidateContentTypeMiddleware)
+        # One pure ASGI middleware validates the requests, sets the headers and compresses the responses
+        Middleware(request_middleware.ServerMiddleware,
+            headers={
+                constants.API_VERSION_HTTP_HEADER_NAME: constants.API_VERSION,
+
+                # Im adding the CORS here, because the standard CORSMiddleware was not working properly
+                constants.HEADER_DEFAULT_ACCESS_CONTROL_MAX_AGE: constants.HTTP_DEFAULT_ACCESS_CONTROL_MAX_AGE,
+                constants.HEADER_DEFAULT_ACCESS_CONTROL_ALLOW_ORIGIN: constants.HTTP_DEFAULT_ACCESS_CONTROL_ALLOW_ORIGIN,
+                constants.HEADER_DEFAULT_ACCESS_CONTROL_ALLOW_HEADERS: constants.HTTP_DEFAULT_ACCESS_CONTROL_ALLOW_HEADERS
+            },
+            content_type=constants.HTTP_DEFAULT_CONTENT_TYPE,
+            minimum_size=GZIP_MINIMUM_SIZE,
+            compresslevel=GZIP_COMPRESS_LEVEL
+        )
     ],
 
     # Define the exception handlers
-    exception_handlers=exception_handlers_list
+    exception_handlers=exception_handlers_list,
+
+    # Starts the model loading
+    lifespan=lifespan
 )
@@ -0,0 +1,78 @@
+import time
+import threading
+
+# Priority classes, lower values are decoded first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BATCH = 2
+
+class QueueTicket:
+    """
+    Place of a request on the inference queue.
+    It is held from the moment the request is accepted until the generation engine starts it or drops it.
+    """
+    def __init__(self, admission, priority, deadline, tenant=None, trace=None):
+        self.admission = admission
+        self.priority = priority
+        self.deadline = deadline
+
+        # API key tenant, used by the fair queue and to charge the generated tokens
+        self.tenant = tenant
+
+        # Optional trace of the request phases
+        self.trace = trace
+        self.left = False
+
+        # Used to measure the queue wait and the time to first token
+        self.entered_at = time.monotonic()
+
+    def leave(self):
+        """Free the place on the queue, calling it more than once is safe."""
+        if not self.left:
+            self.left = True
+            self.admission.leave()
+
+    def is_expired(self, now=None):
+        """Check if the deadline has passed."""
+        return self.deadline is not None and (now if now is not None else time.monotonic()) > self.deadline
+
+class AdmissionController:
+    """
+    Admission layer in front of the generation engine.
+    It bounds the number of queued requests and gives each one a deadline that covers queue wait and generation.
+    """
+    def __init__(self, max_queue_depth, request_timeout):
+        self.max_queue_depth = max_queue_depth
+        self.request_timeout = request_timeout
+        self.queued = 0
+        self.lock = threading.Lock()
+
+        # Counters
+        self.rejected = 0
+
+    # Returns a ticket, or None if the queue is full
+    # timeout overrides request_timeout, 0 has no deadline
+    def enter(self, priority=PRIORITY_DEFAULT, timeout=None, tenant=None, trace=None):
+        with self.lock:
+            if self.max_queue_depth > 0 and self.queued >= self.max_queue_depth:
+                self.rejected += 1
+                return None
+            self.queued += 1
+
+        if timeout is None:
+            timeout = self.request_timeout
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        return QueueTicket(self, priority, deadline, tenant, trace)
+
+    def leave(self):
+        with self.lock:
+            self.queued -= 1
+
+# Bytes of key/value cache used by each token of a sequence
+def kv_cache_bytes_per_token(model):
+    config = model.config
+    num_attention_heads = config.num_attention_heads
+    num_key_value_heads = getattr(config, "num_key_value_heads", None) or num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_attention_heads
+    element_size = model.dtype.itemsize
+    return 2 * config.num_hidden_layers * num_key_value_heads * head_dim * element_size
@@ -0,0 +1,488 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import torch
+import src.ai.model_utils as model_utils
+import src.ai.model_admission as model_admission
+import src.restapi.json as json_codec
+import src.restapi.response_builder as response_builder
+import src.utils.validators as validators
+from src.ai.model_engine import GenerationError
+from src.ai.model_inference import start_generating, completion_response
+from src.ai.model_cancellation import CancellationToken
+from src.ai.model_stop import StopSequenceCriteria, truncate_at_stop
+from transformers import StoppingCriteriaList
+from config import (
+    MAX_CHOICES
+)
+
+logger = logging.getLogger()
+
+# Route the batch lines are run against
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Statuses of a job that is done
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+# Fields used as the user message when a line has no messages, the same as benchmark.py
+TEXT_FIELDS = ("prompt", "content", "text", "body")
+
+# Fields used as the custom_id of a line, the line number is used without them
+ID_FIELDS = ("custom_id", "request_id", "id")
+
+# Turn a JSONL line into a chat completion request
+# Lines can be OpenAI batch lines with the request on body, chat completion requests, or a text to use as the user message
+# Returns (custom_id, json_data), json_data is None if the line is not a valid request
+def parse_batch_line(row, index):
+    if not isinstance(row, dict):
+        return (f"request-{index}", None)
+
+    custom_id = next((str(row[field]) for field in ID_FIELDS if row.get(field) is not None), f"request-{index}")
+    if isinstance(row.get("body"), dict):
+        json_data = row["body"]
+    elif "messages" in row:
+        json_data = row
+    else:
+        text = next((row[field] for field in TEXT_FIELDS if isinstance(row.get(field), str)), None)
+        json_data = {"messages": [{"role": "user", "content": text}]} if text is not None else None
+
+    if json_data is not None and not validators.is_valid_messages(json_data.get("messages")):
+        json_data = None
+    return (custom_id, json_data)
+
+# Read a JSONL file of requests
+# returns a list of (custom_id, json_data)
+def read_batch_file(path):
+    requests = []
+    with open(path, "rb") as f:
+        for index, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json_codec.loads(line)
+            except ValueError:
+                row = None
+            requests.append(parse_batch_line(row, index))
+    return requests
+
+# custom_id of the lines already on an output file, so a job can resume where it stopped
+# A line cut by a crash is ignored, its request runs again
+def completed_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                done.add(json_codec.loads(line)["custom_id"])
+            except (ValueError, KeyError, TypeError):
+                continue
+    return done
+
+# Open an output file to append lines to it
+# A line cut by a crash is dropped, so the next line does not end up on the same line
+def open_output(path):
+    f = open(path, "ab+")
+    end = f.seek(0, os.SEEK_END)
+
+    # Lets find the end of the last full line, reading backwards
+    position = end
+    while position > 0:
+        start = max(position - 65536, 0)
+        f.seek(start)
+        newline = f.read(position - start).rfind(b"\n")
+        if newline >= 0:
+            position = start + newline + 1
+            break
+        position = start
+    if position < end:
+        f.truncate(position)
+    return f
+
+# Line of a batch output file, the same shape as the OpenAI batch output
+def output_line(custom_id, status_code, body):
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": custom_id,
+        "response": {"status_code": status_code, "body": body},
+        "error": None
+    }
+
+# Output line of a request that failed
+def error_line(custom_id, error_code, override_message=""):
+    (json_data, status_code) = response_builder.get_error_data(error_code, override_message)
+    return output_line(custom_id, status_code, json_data)
+
+# Characters of the prompt, a cheap estimate of its token length
+def prompt_length(json_data):
+    if json_data is None:
+        return 0
+    return sum(len(message["content"]) for message in json_data["messages"] if isinstance(message.get("content"), str))
+
+# Append lines to an output file
+# They are flushed to disk right away, the output file is the checkpoint of the job
+def write_lines(f, lines):
+    f.write(b"".join(json_codec.dumps(line) + b"\n" for line in lines))
+    f.flush()
+    os.fsync(f.fileno())
+
+class BatchGenerator:
+    """
+    Offline batch inference with padded `model.generate` calls, without the server.
+    Prompts are sorted by token length before they are split into batches, so the rows of a batch need little padding.
+    Every batch is appended to the output file when it is done, running again on the same output skips the finished lines.
+    """
+    def __init__(self, model_id, tokenizer, template_cache, model, terminators, batch_size):
+        self.model_id = model_id
+        self.tokenizer = tokenizer
+        self.template_cache = template_cache
+        self.model = model
+        self.batch_size = batch_size
+        self.eos_token_id = [token_id for token_id in terminators if token_id is not None]
+
+        # Left padding, so the new tokens of every row start at the same position
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else self.eos_token_id[0]
+
+    # Run the requests and append the results to the output file
+    # Returns the stats of the run
+    def run(self, requests, output_path):
+        started_at = time.monotonic()
+        done = completed_ids(output_path)
+        pending = [(custom_id, json_data) for (custom_id, json_data) in requests if custom_id not in done]
+        if done:
+            logger.info(f"Resuming {output_path}, {len(requests) - len(pending)} of {len(requests)} requests are done")
+
+        stats = {"requests": len(requests), "skipped": len(requests) - len(pending), "completed": 0, "failed": 0, "generated_tokens": 0}
+        with open_output(output_path) as f:
+            # Requests with the same sampling parameters can share a generate call
+            groups = {}
+            invalid = []
+            for (custom_id, json_data) in pending:
+                if json_data is None:
+                    invalid.append(error_line(custom_id, "invalid_request", "The request was unacceptable, the line is not a valid chat completion request."))
+                    continue
+
+                # Every generate call row is one choice, so n is only supported by the server
+                if model_utils.get_choices(json_data) != 1:
+                    invalid.append(error_line(custom_id, "invalid_request", "The request was unacceptable, the parameter `n` is not supported offline, use /v1/batches instead."))
+                    continue
+                if model_utils.get_max_tokens(json_data) is None:
+                    invalid.append(error_line(custom_id, "invalid_request", "The request was unacceptable, the parameter `max_tokens` must be a positive integer."))
+                    continue
+                (messages, max_tokens, do_sample, temperature, top_p, stop) = model_utils.get_safe_parameters(json_data)
+
+                # A temperature of 0 means greedy decoding, the same as the generation engine
+                do_sample = bool(do_sample) and temperature > 0
+                key = (True, float(temperature), float(top_p)) if do_sample else (False,)
+                input_ids = self.template_cache.encode(messages)[0].tolist()
+                groups.setdefault(key, []).append((custom_id, input_ids, max_tokens, stop))
+
+            if invalid:
+                write_lines(f, invalid)
+                stats["failed"] += len(invalid)
+
+            for (key, items) in groups.items():
+                items.sort(key=lambda item: len(item[1]))
+                for start in range(0, len(items), self.batch_size):
+                    batch = items[start:start + self.batch_size]
+                    try:
+                        results = self.generate(batch, key)
+                    except Exception as e:
+                        logger.exception(f"Batch of {len(batch)} requests failed: {e}")
+                        write_lines(f, [error_line(custom_id, "internal_error") for (custom_id, _, _, _) in batch])
+                        stats["failed"] += len(batch)
+                        continue
+
+                    created = int(time.time())
+                    write_lines(f, [
+                        output_line(custom_id, 200, completion_response(self.model_id, [(text, finish_reason)], created))
+                        for ((custom_id, _, _, _), (text, _, finish_reason)) in zip(batch, results)
+                    ])
+                    stats["completed"] += len(batch)
+                    stats["generated_tokens"] += sum(tokens for (_, tokens, _) in results)
+
+                    elapsed = time.monotonic() - started_at
+                    logger.info(
+                        f"Batch {stats['completed'] + stats['failed']}/{len(pending)} done, "
+                        f"{stats['generated_tokens'] / elapsed:.1f} tokens/sec"
+                    )
+
+        stats["seconds"] = round(time.monotonic() - started_at, 2)
+        stats["tokens_per_second"] = round(stats["generated_tokens"] / stats["seconds"], 2) if stats["seconds"] > 0 else 0.0
+        return stats
+
+    # One padded generate call for the batch
+    # Returns a (text, generated tokens, finish reason) for every row
+    def generate(self, batch, key):
+        length = max(len(input_ids) for (_, input_ids, _, _) in batch)
+        input_ids = torch.tensor(
+            [[self.pad_token_id] * (length - len(ids)) + ids for (_, ids, _, _) in batch], dtype=torch.long, device=self.model.device
+        )
+        attention_mask = torch.tensor(
+            [[0] * (length - len(ids)) + [1] * len(ids) for (_, ids, _, _) in batch], dtype=torch.long, device=self.model.device
+        )
+
+        # A row is done as soon as its text has one of its stop sequences
+        stops = [stop for (_, _, _, stop) in batch]
+        criteria = StopSequenceCriteria(self.tokenizer, stops, length) if any(stops) else None
+
+        sampling = {"do_sample": True, "temperature": key[1], "top_p": key[2]} if key[0] else {"do_sample": False, "temperature": None, "top_p": None}
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max(max_tokens for (_, _, max_tokens, _) in batch),
+                eos_token_id=self.eos_token_id,
+                pad_token_id=self.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([criteria]) if criteria is not None else None,
+                **sampling
+            )
+
+        # Every row stops at its own terminator, stop sequence and max_tokens
+        results = []
+        for (position, (row, (_, _, max_tokens, stop))) in enumerate(zip(outputs[:, length:].tolist(), batch)):
+            if criteria is not None and criteria.stopped_at[position] is not None:
+                max_tokens = min(max_tokens, criteria.stopped_at[position])
+            row = row[:max_tokens]
+            end = next((index for (index, token_id) in enumerate(row) if token_id in self.eos_token_id), len(row))
+            (text, finish_reason) = truncate_at_stop(self.tokenizer.decode(row[:end], skip_special_tokens=True), stop, row[:end + 1], self.eos_token_id)
+            results.append((text, end, finish_reason))
+        return results
+
+class BatchJob:
+    """
+    A /v1/batches job, its lines are appended to its output file as they complete.
+    """
+    def __init__(self, batch_id, requests, input_file_id, metadata, output_path):
+        self.id = batch_id
+        self.requests = requests
+        self.input_file_id = input_file_id
+        self.metadata = metadata
+        self.output_path = output_path
+        self.total = len(requests)
+
+        self.status = "validating"
+        self.created_at = int(time.time())
+        self.in_progress_at = None
+        self.completed_at = None
+        self.failed_at = None
+        self.cancelled_at = None
+
+        # Request counts
+        self.completed = 0
+        self.failed = 0
+
+        # Cancellation tokens of the lines in flight
+        self.cancellations = set()
+        self.cancelled = False
+        self.task = None
+
+    # Time the job was done, None while it runs
+    def finished_at(self):
+        if self.status not in FINISHED_STATUSES:
+            return None
+        return self.completed_at or self.failed_at or self.cancelled_at
+
+    def cancel(self):
+        if self.status not in ("validating", "in_progress"):
+            return
+        self.status = "cancelling"
+        self.cancelled = True
+        for cancellation in list(self.cancellations):
+            cancellation.cancel()
+
+    # OpenAI batch object
+    def to_json(self):
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": BATCH_ENDPOINT,
+            "errors": None,
+            "input_file_id": self.input_file_id,
+            "completion_window": "24h",
+            "status": self.status,
+            "output_file_id": os.path.basename(self.output_path),
+            "created_at": self.created_at,
+            "in_progress_at": self.in_progress_at,
+            "completed_at": self.completed_at,
+            "failed_at": self.failed_at,
+            "cancelled_at": self.cancelled_at,
+            "request_counts": {
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed
+            },
+            "metadata": self.metadata
+        }
+
+class BatchManager:
+    """
+    Runs the /v1/batches jobs on the server, behind the interactive traffic.
+    The lines go through the generation engine at batch priority, shortest prompts first,
+    with at most max_in_flight of them queued or decoding at once, so a big job never takes the whole batch or queue.
+    Finished jobs are forgotten after job_ttl seconds, or sooner when there are more than max_jobs, their output files stay.
+    """
+    def __init__(self, registry, metrics, output_dir, max_in_flight, retry_after, job_ttl=86400, max_jobs=1000, replica_id=""):
+        self.registry = registry
+        self.metrics = metrics
+        self.output_dir = output_dir
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.job_ttl = job_ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Behind the launcher the ids carry the replica, so the router sends every request of a job to the replica that runs it
+        self.id_prefix = f"batch_r{replica_id}_" if replica_id else "batch_"
+
+    # Path of a file on the batch directory, None if the name is not a plain file name
+    def file_path(self, name):
+        if not validators.is_string(name) or name != os.path.basename(name) or name in ("", ".", ".."):
+            return None
+        return os.path.join(self.output_dir, name)
+
+    # Start a job, this must run on the event loop
+    def create(self, requests, input_file_id, metadata):
+        self.evict()
+        batch_id = f"{self.id_prefix}{uuid.uuid4().hex}"
+        job = BatchJob(batch_id, requests, input_file_id, metadata, os.path.join(self.output_dir, f"{batch_id}_output.jsonl"))
+        self.jobs[batch_id] = job
+        job.task = asyncio.get_running_loop().create_task(self.run(job))
+        return job
+
+    def get(self, batch_id):
+        self.evict()
+        return self.jobs.get(batch_id)
+
+    def list(self):
+        self.evict()
+        return list(self.jobs.values())
+
+    # Forget the finished jobs past their TTL, and the oldest finished ones while there are too many jobs
+    # Jobs that are still running are always kept
+    def evict(self):
+        now = time.time()
+        finished = [job for job in self.jobs.values() if job.finished_at() is not None]
+        excess = len(self.jobs) - self.max_jobs
+        for job in sorted(finished, key=lambda job: job.finished_at()):
+            if excess > 0 or now - job.finished_at() > self.job_ttl:
+                del self.jobs[job.id]
+                excess -= 1
+
+    async def run(self, job):
+        job.status = "in_progress"
+        job.in_progress_at = int(time.time())
+        started_at = time.monotonic()
+
+        # Similar lengths reach the engine together, so the batch rows need less padding
+        requests = sorted(job.requests, key=lambda item: prompt_length(item[1]))
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        try:
+            with open_output(job.output_path) as f:
+                async def run_line(custom_id, json_data):
+                    async with semaphore:
+                        if job.cancelled:
+                            return
+                        line = await self.complete(job, custom_id, json_data)
+                    if line["response"]["status_code"] == 200:
+                        job.completed += 1
+                    else:
+                        job.failed += 1
+                    write_lines(f, [line])
+
+                # Every line is done before the output file closes, a line that could not be written fails the job
+                results = await asyncio.gather(*[run_line(custom_id, json_data) for (custom_id, json_data) in requests], return_exceptions=True)
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
+        except Exception as e:
+            logger.exception(f"Batch {job.id} failed: {e}")
+            job.status = "failed"
+            job.failed_at = int(time.time())
+            return
+        finally:
+            # The results are on the output file, the lines are not needed anymore
+            job.requests = None
+
+        if job.cancelled:
+            job.status = "cancelled"
+            job.cancelled_at = int(time.time())
+        else:
+            job.status = "completed"
+            job.completed_at = int(time.time())
+        logger.info(f"Batch {job.id} {job.status}, {job.completed} completed and {job.failed} failed in {time.monotonic() - started_at:.1f}s")
+
+    # Run a line on the generation engine of its model
+    # Returns the output line
+    async def complete(self, job, custom_id, json_data):
+        if json_data is None:
+            return error_line(custom_id, "invalid_request", "The request was unacceptable, the line is not a valid chat completion request.")
+
+        model_id = json_data.get("model", "")
+        if validators.is_empty(model_id):
+            model_id = self.registry.default_model_id
+        if not validators.is_string(model_id) or self.registry.get(model_id) is None:
+            return error_line(custom_id, "model_not_found", f"The model {model_id} does not exist.")
+
+        n = model_utils.get_choices(json_data)
+        if n is None:
+            return error_line(custom_id, "invalid_request", f"The request was unacceptable, the parameter `n` must be between 1 and {MAX_CHOICES}.")
+        if model_utils.get_max_tokens(json_data) is None:
+            return error_line(custom_id, "invalid_request", "The request was unacceptable, the parameter `max_tokens` must be a positive integer.")
+
+        try:
+            entry = await self.registry.acquire(model_id)
+        except Exception:
+            return error_line(custom_id, "service_unavailable", f"The model {model_id} could not be loaded.")
+
+        cancellation = CancellationToken()
+        job.cancellations.add(cancellation)
+        if job.cancelled:
+            cancellation.cancel()
+        try:
+            dependencies = entry.dependencies
+
+            # If the queue is full of interactive requests, lets wait for a place instead of failing the line
+            # Batch lines have no deadline, the job can take as long as it needs
+            while True:
+                ticket = dependencies["admission"].enter(model_admission.PRIORITY_BATCH, 0)
+                if ticket is not None:
+                    break
+                await asyncio.sleep(self.retry_after)
+
+            future = await start_generating(
+                json_data,
+                model_id,
+                dependencies["tokenizer"],
+                dependencies["template_cache"],
+                dependencies["engine"],
+                dependencies["terminators"],
+                dependencies["shared_executor"],
+                dependencies["completion_cache"],
+                ticket,
+                cancellation,
+                self.metrics,
+                n
+            )
+            # A cancelled line can be detached from a shared generation that goes on, so lets not wait for it
+            cancelled = asyncio.get_running_loop().create_future()
+            cancellation.add_callback(lambda: cancelled.get_loop().call_soon_threadsafe(model_utils.set_future_result, cancelled, None))
+            await asyncio.wait([future, cancelled], return_when=asyncio.FIRST_COMPLETED)
+            if not future.done():
+                future.cancel()
+                return error_line(custom_id, "cancelled")
+
+            return output_line(custom_id, 200, completion_response(model_id, future.result(), int(time.time())))
+        except GenerationError as e:
+            return error_line(custom_id, e.error_code)
+        except Exception as e:
+            # A bad line only fails itself, like on the batch CLI
+            logger.exception(f"Batch {job.id} line {custom_id} failed: {e}")
+            return error_line(custom_id, "internal_error")
+        finally:
+            job.cancellations.discard(cancellation)
+            self.registry.release(entry)
@@ -0,0 +1,36 @@
+import threading
+import torch
+from transformers import StoppingCriteria
+
+class CancellationToken(StoppingCriteria):
+    """
+    Cancellation flag of a request, set when the client goes away.
+    The generation engine checks it before every step, and as a StoppingCriteria it also stops `model.generate`.
+    Callbacks run once, on the thread that cancels the token.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """Cancel the request, calling it more than once is safe."""
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """Run the callback when the token is cancelled, right away if it already is."""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled, dtype=torch.bool, device=input_ids.device)
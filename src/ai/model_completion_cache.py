@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+import torch
+from src.ai.model_cancellation import CancellationToken
+
+logger = logging.getLogger()
+
+class CompletionBroadcast:
+    """
+    Streamer for a generation that is shared between identical requests.
+    It records the generated tokens and forwards them to every subscribed streamer,
+    subscribers that arrive late get the recorded tokens replayed first.
+    The generation is only cancelled when every subscriber that can cancel is gone.
+    """
+    def __init__(self, cache, key, eos_token_id, max_new_tokens, stop_sequences=None):
+        self.cache = cache
+        self.key = key
+        self.eos_token_id = set(eos_token_id)
+        self.max_new_tokens = int(max_new_tokens)
+        self.stop_sequences = stop_sequences
+        self.token_ids = []
+        self.subscribers = []
+        self.ended = False
+        self.exception = None
+        self.lock = threading.Lock()
+
+        # Cancellation token of the shared generation
+        self.cancellation = CancellationToken()
+        self.active = 0
+        self.abandoned = False
+
+    def subscribe(self, streamer, cancellation=None):
+        """Attach a streamer, replaying the tokens generated so far. Returns False if the generation was abandoned."""
+        attached = False
+        with self.lock:
+            if self.abandoned:
+                return False
+            for token_id in self.token_ids:
+                streamer.put(torch.tensor([token_id]))
+            if self.exception is not None:
+                streamer.fail(self.exception)
+            elif self.ended:
+                streamer.end()
+            else:
+                self.subscribers.append(streamer)
+                self.active += 1
+                attached = True
+
+        # Outside of the lock, the callback runs right away if the client is already gone
+        if attached and cancellation is not None:
+            cancellation.add_callback(lambda: self.unsubscribe(streamer))
+        return True
+
+    def unsubscribe(self, streamer):
+        """Detach a cancelled streamer, the generation is cancelled when nobody is left."""
+        with self.lock:
+            if streamer not in self.subscribers:
+                return
+            self.subscribers.remove(streamer)
+            self.active -= 1
+            self.abandoned = self.active == 0 and not self.ended
+            if not self.abandoned:
+                return
+
+        # New identical requests must start their own generation
+        self.cache.finish(self, None)
+        self.cancellation.cancel()
+
+    def put(self, value):
+        """Record the new tokens and forward them."""
+        with self.lock:
+            self.token_ids.extend(value.tolist())
+            for streamer in self.subscribers:
+                streamer.put(value)
+
+    def end(self):
+        """End every subscriber and store the completion if it finished normally."""
+        with self.lock:
+            self.ended = True
+            for streamer in self.subscribers:
+                streamer.end()
+            self.subscribers = []
+
+        # A generation that was cut short must not be cached
+        # A generation that ended on a stop sequence is complete too
+        completed = len(self.token_ids) >= self.max_new_tokens or (self.token_ids and self.token_ids[-1] in self.eos_token_id)
+        if self.stop_sequences is not None and self.stop_sequences.matched:
+            completed = True
+        self.cache.finish(self, self.token_ids if completed else None)
+
+    def fail(self, exception):
+        """Fail every subscriber, nothing is cached."""
+        with self.lock:
+            self.ended = True
+            self.exception = exception
+            subscribers = self.subscribers
+            self.subscribers = []
+        for streamer in subscribers:
+            streamer.fail(exception)
+        self.cache.finish(self, None)
+
+class CompletionCache:
+    """
+    Exact match cache of deterministic completions, with in-flight request coalescing.
+    Entries are kept in memory with a TTL and LRU eviction, and optionally on disk.
+    """
+    def __init__(self, max_entries, ttl, directory=""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.disk_hits = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    # Only greedy decoding gives the same completion every time
+    @staticmethod
+    def is_deterministic(do_sample, temperature):
+        return not do_sample or temperature == 0
+
+    # Lets build the key from the sanitized parameters
+    # Temperature and top_p have no effect on greedy decoding, so they are not part of the key
+    # The stop sequences end the generation early, so they are, without them the key is the same as before
+    @staticmethod
+    def get_key(model_id, messages, max_tokens, stop=()):
+        parameters = [model_id, messages, max_tokens] + ([list(stop)] if stop else [])
+        normalized = json.dumps(parameters, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    # Serve the streamer from the cache or from an identical generation in flight
+    # Returns None if it was served, otherwise the streamer that must be sent to the generation engine
+    # stop_sequences is the StopSequenceMatcher of the generation, if it starts one
+    def subscribe(self, key, streamer, eos_token_id, max_new_tokens, cancellation=None, stop_sequences=None):
+        while True:
+            with self.lock:
+                token_ids = self.get(key)
+                if token_ids is None:
+                    broadcast = self.in_flight.get(key)
+                    if broadcast is None:
+                        self.misses += 1
+                        broadcast = CompletionBroadcast(self, key, eos_token_id, max_new_tokens, stop_sequences)
+                        self.in_flight[key] = broadcast
+                        leader = True
+                    else:
+                        leader = False
+                else:
+                    self.hits += 1
+
+            # The first client starts the generation
+            # Outside of the lock, if the client is already gone unsubscribe calls finish, which takes the lock
+            if token_ids is None and leader:
+                broadcast.subscribe(streamer, cancellation)
+                return broadcast
+
+            # Served from the cache
+            if token_ids is not None:
+                replay(streamer, token_ids)
+                return None
+
+            # Attached to the request in flight
+            if broadcast.subscribe(streamer, cancellation):
+                with self.lock:
+                    self.coalesced += 1
+                return None
+
+            # Every client of that generation went away, lets start a new one
+            with self.lock:
+                if self.in_flight.get(key) is broadcast:
+                    del self.in_flight[key]
+
+    # Called once the shared generation is done or abandoned
+    def finish(self, broadcast, token_ids):
+        with self.lock:
+            if self.in_flight.get(broadcast.key) is broadcast:
+                del self.in_flight[broadcast.key]
+            if token_ids is not None:
+                self.set(broadcast.key, token_ids)
+
+    # Memory lookup with a fallback to the disk, the lock must be held
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            (expires_at, token_ids) = entry
+            if expires_at > time.time():
+                self.entries.move_to_end(key)
+                return token_ids
+            del self.entries[key]
+
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, key + ".json"), "r") as f:
+                    entry = json.load(f)
+                if entry["expires_at"] > time.time():
+                    self.disk_hits += 1
+                    self.entries[key] = (entry["expires_at"], entry["token_ids"])
+                    self.evict()
+                    return entry["token_ids"]
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Error reading the completion cache entry {key}: {e}")
+        return None
+
+    # Store a completion, the lock must be held
+    def set(self, key, token_ids):
+        expires_at = time.time() + self.ttl
+        self.entries[key] = (expires_at, token_ids)
+        self.entries.move_to_end(key)
+        self.evict()
+
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, key + ".json"), "w") as f:
+                    json.dump({"expires_at": expires_at, "token_ids": token_ids}, f)
+            except OSError as e:
+                logger.warning(f"Error writing the completion cache entry {key}: {e}")
+
+    # Remove the least recently used entries
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # Lets report the counters
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "disk_hits": self.disk_hits,
+            "entries": len(self.entries),
+        }
+
+# Send a cached completion to a streamer, one token at a time like the generation engine does
+def replay(streamer, token_ids):
+    for token_id in token_ids:
+        streamer.put(torch.tensor([token_id]))
+    streamer.end()
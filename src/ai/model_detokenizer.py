@@ -0,0 +1,96 @@
+# Characters before a cut that must not be spaces, so no clean up pattern can cross it
+# The longest pattern of tokenizer.clean_up_tokenization is " n't"
+CLEAN_UP_LOOKBACK = 3
+
+class IncrementalDetokenizer:
+    """
+    Turns the tokens of a sequence into text as they are generated, decoding only a small window of the latest tokens.
+    The window starts at prefix_offset, the text of the tokens up to read_offset was already sent, so the new text
+    is what the window decodes past it. The window only moves once its text is complete, so multi byte characters
+    split over several tokens are held until their last byte arrives, and a word keeps the space in front of it.
+    Like TextStreamer every line is decoded on its own, so the text is the same as the TextStreamer one,
+    without decoding the whole line again for every token.
+    """
+    def __init__(self, tokenizer, **decode_kwargs):
+        self.tokenizer = tokenizer
+
+        # The clean up of the tokenization spaces runs on the text we send, the windows are decoded without it
+        self.clean_up = decode_kwargs.pop("clean_up_tokenization_spaces", None)
+        if self.clean_up is None:
+            self.clean_up = bool(getattr(tokenizer, "clean_up_tokenization_spaces", False))
+        self.decode_kwargs = dict(decode_kwargs, clean_up_tokenization_spaces=False)
+
+        # Tokens of the current line from prefix_offset onwards
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+        # Text held back until no clean up pattern can cross its end
+        self.pending = ""
+
+    # Add the new tokens of the sequence
+    # Returns the text that is final now, it can be empty
+    def add(self, token_ids):
+        self.token_ids.extend(token_ids)
+        prefix_text = self.decode(self.prefix_offset, self.read_offset)
+        new_text = self.decode(self.prefix_offset, len(self.token_ids))
+
+        # Nothing new yet, or the last character is not complete
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        text = new_text[len(prefix_text):]
+
+        # After a new line TextStreamer starts over, so lets do the same
+        if text.endswith("\n"):
+            self.reset()
+            return self.release(text, True)
+
+        # The tokens before the window are not needed anymore
+        del self.token_ids[:self.read_offset]
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+        return self.release(text, False)
+
+    # The sequence is done
+    # Returns the rest of the text, with any incomplete character decoded as is
+    def flush(self):
+        prefix_text = self.decode(self.prefix_offset, self.read_offset)
+        new_text = self.decode(self.prefix_offset, len(self.token_ids))
+        self.reset()
+        return self.release(new_text[len(prefix_text):], True)
+
+    def decode(self, start, end):
+        if start >= end:
+            return ""
+        return self.tokenizer.decode(self.token_ids[start:end], **self.decode_kwargs)
+
+    def reset(self):
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    # Clean up the text we send, holding back its end while a clean up pattern could still cross it
+    # Every pattern starts with a space and only removes spaces, so it is safe to cut where the last characters are not spaces
+    def release(self, text, final):
+        if not self.clean_up:
+            return text
+
+        self.pending += text
+        cut = len(self.pending)
+        if not final:
+            while cut > 0 and " " in self.pending[max(cut - CLEAN_UP_LOOKBACK, 0):cut]:
+                cut -= 1
+        (text, self.pending) = (self.pending[:cut], self.pending[cut:])
+        return self.tokenizer.clean_up_tokenization(text) if text else ""
+
+# Token ids of a single sequence, from a tensor or a list, with or without the batch dimension
+def sequence_token_ids(value):
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, int):
+        return [value]
+    if value and isinstance(value[0], list):
+        if len(value) > 1:
+            raise ValueError("The streamer only supports a batch size of 1")
+        value = value[0]
+    return value
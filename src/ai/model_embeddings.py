@@ -0,0 +1,220 @@
+import base64
+import asyncio
+import hashlib
+import threading
+import collections
+import numpy
+import torch
+import torch.nn.functional as F
+from src.ai.model_engine import GenerationError
+
+# Pooling of the hidden states into one vector per input
+POOLING_MEAN = "mean"
+POOLING_LAST = "last"
+POOLING_MODES = (POOLING_MEAN, POOLING_LAST)
+
+# Encodings of the vectors on the response
+ENCODING_FLOAT = "float"
+ENCODING_BASE64 = "base64"
+ENCODING_FORMATS = (ENCODING_FLOAT, ENCODING_BASE64)
+
+class InvalidInputError(GenerationError):
+    """An embedding input the model can not run, the message tells the client why."""
+    error_code = "invalid_request"
+
+class EmbeddingCache:
+    """
+    LRU of pooled embeddings by input hash, with the token count of every input for the usage.
+    The vectors are float32 tensors on the CPU, they are never modified once stored.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    # Returns (vector, tokens) or None
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Lets report the counters
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+        }
+
+class Embedder:
+    """
+    Embeddings from the hidden states of the generation model, so no second model is needed.
+    The inputs of concurrent requests that arrive within window seconds of each other are embedded on one
+    padded forward pass of the base model, without the language model head and without a key/value cache.
+    The forward pass runs on the engine thread between two decode steps, so it never races the generation batch.
+    """
+    def __init__(self, model, tokenizer, engine, pooling, normalize, window, max_batch_size, max_tokens, cache=None, metrics=None):
+        if pooling not in POOLING_MODES:
+            raise ValueError(f"Unknown embeddings pooling {pooling}, use {' or '.join(POOLING_MODES)}")
+
+        # The transformer without the language model head, its last hidden state is already normalized
+        self.encoder = model.base_model
+        self.device = model.device
+        self.vocab_size = model.get_input_embeddings().num_embeddings
+        self.tokenizer = tokenizer
+        self.engine = engine
+        self.pooling = pooling
+        self.normalize = normalize
+        self.window = window
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.metrics = metrics
+
+        # Inputs waiting for the next forward pass, only used from the event loop
+        self.queue = []
+        self.timer = None
+
+    # Embed a list of inputs, every input is a string or a list of token ids
+    # Cached inputs skip the tokenizer and the model
+    # Returns a list of (vector, tokens)
+    async def embed(self, inputs, shared_executor):
+        results = [None] * len(inputs)
+        keys = [input_key(item) for item in inputs]
+        if self.cache is not None:
+            for (index, key) in enumerate(keys):
+                results[index] = self.cache.get(key)
+
+        missing = [index for (index, result) in enumerate(results) if result is None]
+        if not missing:
+            return results
+
+        # Lets tokenize the text inputs off the event loop
+        texts = [inputs[index] for index in missing if isinstance(inputs[index], str)]
+        encoded = iter(await asyncio.get_running_loop().run_in_executor(shared_executor, self.tokenize, texts) if texts else [])
+        token_ids = [next(encoded) if isinstance(inputs[index], str) else inputs[index] for index in missing]
+
+        # A bad input would fail the whole forward pass, so lets reject it before it is batched with others
+        for ids in token_ids:
+            if self.max_tokens > 0 and len(ids) > self.max_tokens:
+                raise InvalidInputError(f"An input has {len(ids)} tokens, the limit is {self.max_tokens}.")
+            if min(ids) < 0 or max(ids) >= self.vocab_size:
+                raise InvalidInputError(f"An input has token ids out of the vocabulary of {self.vocab_size} tokens.")
+
+        vectors = await self.forward(token_ids)
+        for (index, ids, vector) in zip(missing, token_ids, vectors):
+            results[index] = (vector, len(ids))
+            if self.cache is not None:
+                self.cache.put(keys[index], results[index])
+        return results
+
+    def tokenize(self, texts):
+        return self.tokenizer(texts)["input_ids"]
+
+    # Queue the inputs for the next forward pass and wait for their vectors
+    async def forward(self, token_ids):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for ids in token_ids:
+            future = loop.create_future()
+            self.queue.append((ids, future))
+            futures.append(future)
+
+        # A full batch goes right away, otherwise we wait for the window to collect more
+        if len(self.queue) >= self.max_batch_size or self.window <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await asyncio.gather(*futures)
+
+    # Send the queued inputs to the engine thread
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        # The inputs of requests that were cancelled are left out
+        (items, self.queue) = ([item for item in self.queue if not item[1].done()], [])
+        if not items:
+            return
+
+        future = asyncio.wrap_future(self.engine.run_task(lambda: self.run([ids for (ids, _) in items])))
+        future.add_done_callback(lambda done: deliver(items, done))
+
+    # Embed the inputs on the engine thread, in batches of inputs of similar length so there is little padding
+    def run(self, token_ids):
+        order = sorted(range(len(token_ids)), key=lambda index: len(token_ids[index]))
+        vectors = [None] * len(token_ids)
+        for start in range(0, len(order), self.max_batch_size):
+            rows = order[start:start + self.max_batch_size]
+            for (row, vector) in zip(rows, self.run_batch([token_ids[row] for row in rows])):
+                vectors[row] = vector
+        return vectors
+
+    # One padded forward pass
+    # The rows are right padded, the model is causal so the padding never changes the real tokens
+    def run_batch(self, token_ids):
+        length = max(len(ids) for ids in token_ids)
+        input_ids = torch.zeros((len(token_ids), length), dtype=torch.long)
+        attention_mask = torch.zeros((len(token_ids), length), dtype=torch.long)
+        for (row, ids) in enumerate(token_ids):
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        hidden_states = self.encoder(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).last_hidden_state.float()
+        if self.pooling == POOLING_LAST:
+            pooled = hidden_states[torch.arange(len(token_ids), device=self.device), attention_mask.sum(dim=-1) - 1]
+        else:
+            mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+        if self.normalize:
+            pooled = F.normalize(pooled, dim=-1)
+
+        if self.metrics is not None:
+            self.metrics.embedding_batch_inputs.labels().observe(len(token_ids))
+            self.metrics.embedding_tokens.labels().inc(int(attention_mask.sum()))
+        return list(pooled.cpu())
+
+# Resolve the futures of a forward pass, skipping the requests that were cancelled
+def deliver(items, done):
+    exception = done.exception() if not done.cancelled() else asyncio.CancelledError()
+    vectors = done.result() if exception is None else None
+    for (index, (_, future)) in enumerate(items):
+        if future.done():
+            continue
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(vectors[index])
+
+# Cache key of an input, the text or the token ids
+def input_key(item):
+    if isinstance(item, str):
+        return hashlib.sha256(b"text:" + item.encode("utf-8")).hexdigest()
+    return hashlib.sha256(b"ids:" + numpy.asarray(item, dtype=numpy.int64).tobytes()).hexdigest()
+
+# Vector as sent to the client, a list of floats or base64 of the little endian float32 values
+def encode_vector(vector, encoding_format):
+    if encoding_format == ENCODING_BASE64:
+        return base64.b64encode(vector.numpy().astype("<f4").tobytes()).decode("ascii")
+    return vector.tolist()
@@ -0,0 +1,680 @@
+import time
+import heapq
+import queue
+import logging
+import itertools
+import threading
+import concurrent.futures
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from src.ai.model_metrics import stream_label
+
+logger = logging.getLogger()
+
+class GenerationError(Exception):
+    """Base error of a generation request, error_code is the code returned to the client."""
+    error_code = "internal_error"
+
+class DeadlineExceededError(GenerationError):
+    """The request deadline passed while it was queued or generating."""
+    error_code = "timeout"
+
+class RequestCancelledError(GenerationError):
+    """The client went away before the generation was done."""
+    error_code = "cancelled"
+
+class GenerationRequest:
+    """
+    A single sequence scheduled on the generation engine.
+    The engine pushes every generated token to the streamer, the same way `model.generate` does.
+    Streamers must also have a fail(exception) method, called instead of end() when the generation fails.
+    """
+    def __init__(self, input_ids, streamer, max_new_tokens, eos_token_id, do_sample, temperature, top_p, ticket=None, stream=False, cancellation=None, stop_sequences=None):
+        self.input_ids = input_ids
+        self.prompt_ids = input_ids[0].tolist()
+        self.streamer = streamer
+
+        # The prefill always emits a token, so a request can not ask for less than one
+        if isinstance(max_new_tokens, bool) or not isinstance(max_new_tokens, int) or max_new_tokens < 1:
+            raise ValueError(f"max_new_tokens must be a positive integer, got {max_new_tokens!r}")
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = set(eos_token_id)
+
+        # Optional StopSequenceMatcher, the request is finished as soon as its text has a stop sequence
+        self.stop_sequences = stop_sequences
+
+        # Admission ticket with the priority, deadline and API key tenant of the request
+        self.ticket = ticket
+        self.priority = ticket.priority if ticket is not None else 0
+        self.deadline = ticket.deadline if ticket is not None else None
+        self.tenant = ticket.tenant if ticket is not None else None
+
+        # Optional trace of the request phases, the engine adds the queue, prefill and decode phases
+        self.trace = ticket.trace if ticket is not None else None
+
+        # Cancellation token, set when the client disconnects
+        self.cancellation = cancellation
+
+        # Metrics, the times are measured from the moment the request was admitted
+        self.stream = stream
+        self.label = stream_label(stream)
+        self.entered_at = ticket.entered_at if ticket is not None else time.monotonic()
+        self.last_token_at = None
+
+        # Tokens of key/value cache the request can reach
+        self.estimated_tokens = len(self.prompt_ids) + self.max_new_tokens
+
+        # A temperature of 0 means greedy decoding, same as the OpenAI API
+        self.do_sample = bool(do_sample) and temperature > 0
+        self.temperature = float(temperature)
+        self.top_p = float(top_p)
+
+        # Tokens generated so far
+        self.output_ids = []
+
+        # Other choices of the same prompt, they are admitted and prefilled together with this request
+        self.siblings = []
+
+    # The request and its siblings, they share one prefill
+    def group(self):
+        return [self] + self.siblings
+
+    # Returns the error to fail the request with if nobody is waiting for it anymore, otherwise None
+    def abandoned(self, now):
+        if self.cancellation is not None and self.cancellation.cancelled:
+            return RequestCancelledError()
+        if self.deadline is not None and now > self.deadline:
+            return DeadlineExceededError()
+        return None
+
+class EngineTask:
+    """
+    A function that uses the model outside of the generation batch, like an embedding forward pass.
+    It runs on the engine thread between two decode steps, so it never races the batch for the model.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.future = concurrent.futures.Future()
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            self.future.set_result(self.function())
+        except Exception as e:
+            self.future.set_exception(e)
+
+class GenerationEngine:
+    """
+    Continuous batching engine that owns the model.
+    Every active request shares a single batched decode step, new requests are merged into the batch
+    and finished ones are removed from it between steps.
+    """
+    def __init__(self, model, max_batch_size, prefix_cache=None, kv_cache_budget_tokens=0, num_threads=0, metrics=None, speculator=None, static_decoder=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.device = model.device
+
+        # Torch intra-op threads of the engine thread, 0 keeps the torch default
+        self.num_threads = num_threads
+
+        # Optional inference metrics
+        self.metrics = metrics
+
+        # Optional speculative decoding proposer, used when a single request is decoding
+        self.speculator = speculator
+
+        # Optional compiled decode step on a static key/value cache, batches that do not fit its buckets run eager
+        self.static_decoder = static_decoder
+
+        # Optional shared prefix key/value cache
+        self.prefix_cache = prefix_cache
+
+        # Max tokens of key/value cache for the whole batch, 0 is unlimited
+        self.kv_cache_budget_tokens = kv_cache_budget_tokens
+        self.kv_cache_tokens = 0
+
+        # Thread safe queue where the routes submit their requests
+        self.pending = queue.Queue()
+
+        # Requests that are waiting for a free slot in the batch
+        # It is a heap ordered by priority, then by the fair queue start tag and then by arrival
+        self.waiting = []
+        self.sequence = itertools.count()
+
+        # Start time fair queuing between the API keys, only used from the engine thread
+        # Every key has the virtual finish time of its last request, the virtual time is the start tag last admitted
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+
+        # Tasks that run on the engine thread before the next step
+        self.tasks = []
+
+        # torch.profiler session capturing the next requests, only used from the engine thread
+        self.profile = None
+
+        # Batch state, every row of the tensors belongs to the request with the same index
+        # The key/value cache is left padded so all the rows share the same length
+        self.requests = []
+        self.input_ids = None
+        self.attention_mask = None
+        self.cache_layers = None
+
+        # Set once the engine thread is done warming up and takes requests
+        self.ready = threading.Event()
+
+        # Set by stop(), the thread exits once the engine has nothing to do
+        self.stopping = False
+
+        # The engine runs on its own thread for the whole life of the server
+        self.thread = threading.Thread(target=self.run, name="palmapy-engine", daemon=True)
+        self.thread.start()
+
+    # Schedule a request, this can be called from any thread
+    def submit(self, request):
+        self.pending.put(request)
+
+    # Schedule the choices of one prompt, this can be called from any thread
+    # The first request carries the others, the prompt is prefilled once and its cache is copied to every choice
+    def submit_group(self, requests):
+        requests[0].siblings = requests[1:]
+        self.pending.put(requests[0])
+
+    # Run a function on the engine thread between two steps, this can be called from any thread
+    # Returns a concurrent future with its result
+    def run_task(self, function):
+        task = EngineTask(function)
+        self.pending.put(task)
+        return task.future
+
+    # Profile the next requests of the engine, this can be called from any thread
+    # Returns a concurrent future that fails if the engine is already profiling
+    def start_profile(self, session):
+        return self.run_task(lambda: self.begin_profile(session))
+
+    def begin_profile(self, session):
+        if self.profile is not None:
+            raise RuntimeError(f"The profile {self.profile.id} is still running")
+        session.start()
+        self.profile = session
+
+    # True when there is nothing queued or generating
+    def idle(self):
+        return not self.requests and not self.waiting and not self.tasks and self.pending.empty()
+
+    # Stop the engine thread, used when the model is unloaded
+    # The None request wakes the thread up if it is waiting for requests
+    def stop(self):
+        self.stopping = True
+        self.pending.put(None)
+
+    # Main loop of the engine
+    def run(self):
+        # The thread count is a per thread setting, so it has to be set from the engine thread
+        if self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
+
+        # Lets compile the decode step here, so the compile time does not land on the first requests
+        if self.static_decoder is not None:
+            try:
+                with torch.inference_mode():
+                    self.static_decoder.warm_up()
+            except Exception as e:
+                logger.exception(f"Error warming up the static decode step, decoding eager: {e}")
+                self.static_decoder = None
+        self.ready.set()
+
+        while True:
+            # If there is nothing to decode, lets block until a request arrives
+            if not self.requests and not self.waiting:
+                if self.stopping:
+                    return
+                self.enqueue(self.pending.get())
+
+            # Lets collect everything that was submitted since the last step
+            while True:
+                try:
+                    self.enqueue(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.run_tasks()
+
+            try:
+                with torch.inference_mode():
+                    self.admit()
+                    if len(self.requests) == 1 and self.speculator is not None:
+                        self.speculate()
+                    elif self.requests:
+                        self.decode()
+            except Exception as e:
+                logger.exception(f"Error on the generation engine step: {e}")
+                self.abort(e)
+
+    # Add a request to the waiting heap
+    # A key that sends a burst gets later and later start tags, so the requests of the other keys go ahead of its backlog
+    # The cost of a request is the tokens it can reach with all its choices, divided by the weight of its key
+    def enqueue(self, request):
+        if request is None:
+            return
+        if isinstance(request, EngineTask):
+            self.tasks.append(request)
+            return
+        (key, weight) = (request.tenant.key, request.tenant.weight) if request.tenant is not None else (None, 1.0)
+        start = max(self.virtual_time, self.finish_tags.get(key, 0.0))
+        self.finish_tags[key] = start + sum(choice.estimated_tokens for choice in request.group()) / weight
+        heapq.heappush(self.waiting, (request.priority, start, next(self.sequence), request))
+
+    # Add waiting requests to the batch while there is room for them
+    def admit(self):
+        self.drop_abandoned()
+
+        while self.waiting and len(self.requests) < self.max_batch_size:
+            (_, start, _, request) = self.waiting[0]
+            group = request.group()
+
+            # Every choice of the request takes a row, they join the batch together
+            if self.requests and len(self.requests) + len(group) > self.max_batch_size:
+                break
+
+            # The batch must have room for the key/value cache the request can reach
+            # A request that is bigger than the whole budget still runs alone
+            if (
+                self.kv_cache_budget_tokens > 0
+                and self.requests
+                and self.kv_cache_tokens + sum(choice.estimated_tokens for choice in group) > self.kv_cache_budget_tokens
+            ):
+                break
+
+            heapq.heappop(self.waiting)
+            self.advance_virtual_time(start)
+            if request.ticket is not None:
+                request.ticket.leave()
+            if self.metrics is not None:
+                self.metrics.queue_wait.labels(request.label).observe(time.monotonic() - request.entered_at)
+            if request.trace is not None:
+                request.trace.lap("queue")
+
+            # The choices that were abandoned while waiting do not get a row
+            now = time.monotonic()
+            requests = []
+            for choice in group:
+                error = choice.abandoned(now)
+                if error is not None:
+                    self.fail(choice, error)
+                else:
+                    requests.append(choice)
+            if not requests:
+                continue
+
+            try:
+                self.prefill(requests)
+            except Exception as e:
+                logger.exception(f"Error on the generation engine prefill: {e}")
+                for choice in requests:
+                    self.finish(choice)
+                    choice.streamer.fail(e)
+
+    # Run the tasks that were submitted since the last step, their errors go to their futures
+    def run_tasks(self):
+        (tasks, self.tasks) = (self.tasks, [])
+        with torch.inference_mode():
+            for task in tasks:
+                task.run()
+
+    # Move the virtual time to the start tag of the admitted request
+    # The keys that are behind it have nothing queued, so their tags can go
+    def advance_virtual_time(self, start):
+        self.virtual_time = max(self.virtual_time, start)
+        if len(self.finish_tags) > 1024:
+            self.finish_tags = {key: tag for (key, tag) in self.finish_tags.items() if tag > self.virtual_time}
+
+    # Drop the waiting requests that were cancelled or whose deadline passed, before they use any compute
+    # A request with choices is dropped once none of its choices is wanted, the others are dropped on its prefill
+    def drop_abandoned(self):
+        now = time.monotonic()
+        if not any(all(choice.abandoned(now) for choice in request.group()) for (_, _, _, request) in self.waiting):
+            return
+
+        waiting = []
+        for item in self.waiting:
+            request = item[3]
+            errors = [choice.abandoned(now) for choice in request.group()]
+            if all(errors):
+                if request.ticket is not None:
+                    request.ticket.leave()
+                for (choice, error) in zip(request.group(), errors):
+                    self.fail(choice, error)
+            else:
+                waiting.append(item)
+        heapq.heapify(waiting)
+        self.waiting = waiting
+
+    # Run the prompt of a new request and merge its cache into the batch
+    # The choices of the request share the prefill, every choice samples its own first token from the same logits
+    def prefill(self, requests):
+        request = requests[0]
+        input_ids = request.input_ids.to(self.device)
+
+        # Lets reuse the longest cached prefix of the prompt
+        # We always leave at least one token to prefill so we get its logits
+        (cached_length, cache_layers) = (0, None)
+        if self.prefix_cache is not None:
+            (cached_length, cache_layers) = self.prefix_cache.lookup(request.prompt_ids, len(request.prompt_ids) - 1)
+
+        started_at = time.monotonic()
+        outputs = self.model(
+            input_ids=input_ids[:, cached_length:],
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=DynamicCache.from_legacy_cache(cache_layers),
+            use_cache=True,
+        )
+        cache_layers = outputs.past_key_values.to_legacy_cache()
+        next_tokens = sample_next_tokens(outputs.logits[:, -1, :].expand(len(requests), -1), requests)
+        if request.trace is not None:
+            request.trace.lap("prefill")
+
+        if self.metrics is not None:
+            self.metrics.prefill_seconds.labels().inc(time.monotonic() - started_at)
+            self.metrics.prefill_tokens.labels(request.label).inc(len(request.prompt_ids) - cached_length)
+
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(request.prompt_ids, cache_layers)
+
+        # A choice could be done after its first token
+        rows = [row for (row, token) in enumerate(next_tokens.tolist()) if not self.emit(requests[row], token)]
+        if not rows:
+            return
+
+        self.merge([requests[row] for row in rows], expand_cache_layers(cache_layers, len(rows)), next_tokens[rows].view(-1, 1))
+
+    # One decode step for every request on the batch
+    def decode(self):
+        # Rows are left padded, so the position is the number of real tokens
+        position_ids = self.attention_mask.sum(dim=-1, keepdim=True) - 1
+
+        started_at = time.monotonic()
+        if self.static_decoder is not None and self.static_decoder.fits(len(self.requests), self.cache_layers[0][0].shape[2]):
+            (logits, self.cache_layers) = self.static_decoder.decode(self.input_ids, self.attention_mask, position_ids, self.cache_layers)
+        else:
+            outputs = self.model(
+                input_ids=self.input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=DynamicCache.from_legacy_cache(self.cache_layers),
+                use_cache=True,
+            )
+            self.cache_layers = outputs.past_key_values.to_legacy_cache()
+            logits = outputs.logits[:, -1, :]
+        next_tokens = sample_next_tokens(logits, self.requests)
+
+        # Send the tokens back and keep the rows that are not finished
+        # Requests that were cancelled or went over their deadline are stopped here,
+        # removing their rows frees their key/value cache before the next step
+        now = time.monotonic()
+        if self.metrics is not None:
+            self.record_decode(now - started_at, now)
+
+        keep = []
+        for row, token in enumerate(next_tokens.tolist()):
+            request = self.requests[row]
+            error = request.abandoned(now)
+            if error is not None:
+                self.fail(request, error)
+            elif not self.emit(request, token):
+                keep.append(row)
+            elif self.prefix_cache is not None:
+                self.cache_finished(row)
+
+        self.input_ids = next_tokens.view(-1, 1)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+
+        if len(keep) < len(self.requests):
+            self.filter(keep)
+
+    # Speculative decode step for a single request
+    # The candidate tokens are verified on one forward pass, at every position we pick the token the same way decode does
+    # and keep the candidates while they match, so the output is the same as without speculation
+    def speculate(self):
+        request = self.requests[0]
+
+        # We can emit one token more than the candidates, so lets not go over max_new_tokens
+        num_tokens = min(self.speculator.num_tokens, request.max_new_tokens - len(request.output_ids) - 1)
+        candidates = self.speculator.propose(request, num_tokens) if num_tokens > 0 else []
+        if not candidates:
+            self.decode()
+            return
+
+        length = self.cache_layers[0][0].shape[2]
+        start = int(self.attention_mask.sum()) - 1
+        position_ids = torch.arange(start, start + len(candidates) + 1, device=self.device).unsqueeze(0)
+
+        started_at = time.monotonic()
+        outputs = self.model(
+            input_ids=torch.cat([self.input_ids, torch.tensor([candidates], device=self.device)], dim=1),
+            attention_mask=F.pad(self.attention_mask, (0, len(candidates)), value=1),
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(self.cache_layers),
+            use_cache=True,
+        )
+        tokens = sample_next_tokens(outputs.logits[0], [request] * (len(candidates) + 1)).tolist()
+
+        accepted = 0
+        while accepted < len(candidates) and tokens[accepted] == candidates[accepted]:
+            accepted += 1
+        tokens = tokens[:accepted + 1]
+
+        now = time.monotonic()
+        error = request.abandoned(now)
+        if error is not None:
+            self.fail(request, error)
+            self.filter([])
+            return
+
+        emitted = 0
+        finished = False
+        for token in tokens:
+            emitted += 1
+            if self.emit(request, token):
+                finished = True
+                break
+        self.speculator.accept(request, accepted, emitted)
+
+        if self.metrics is not None:
+            self.record_speculate(request, now - started_at, now, len(candidates), accepted, emitted)
+
+        # Keep the cache of the tokens we emitted, the last one is the input of the next step
+        self.cache_layers = tuple(
+            (key[:, :, :length + emitted], value[:, :, :length + emitted])
+            for key, value in outputs.past_key_values.to_legacy_cache()
+        )
+        self.attention_mask = F.pad(self.attention_mask, (0, emitted), value=1)
+        self.input_ids = torch.tensor([[tokens[emitted - 1]]], device=self.device)
+
+        if finished:
+            if self.prefix_cache is not None:
+                self.cache_finished(0)
+            self.filter([])
+
+    # Push a token to the request streamer
+    # Returns True if the request is finished
+    def emit(self, request, token):
+        request.output_ids.append(token)
+        request.streamer.put(torch.tensor([token]))
+
+        finished = token in request.eos_token_id or len(request.output_ids) >= request.max_new_tokens
+        if request.stop_sequences is not None and request.stop_sequences.add([token]):
+            finished = True
+        if finished:
+            self.finish(request)
+            request.streamer.end()
+
+        if self.metrics is not None:
+            if len(request.output_ids) == 1:
+                request.last_token_at = time.monotonic()
+                self.metrics.time_to_first_token.labels(request.label).observe(request.last_token_at - request.entered_at)
+            if finished:
+                self.metrics.prompt_tokens.labels(request.label).observe(len(request.prompt_ids))
+                self.metrics.completion_tokens.labels(request.label).observe(len(request.output_ids))
+        return finished
+
+    # Record the timings of a decode step, the token counters are updated once per label
+    def record_decode(self, duration, now):
+        self.metrics.decode_seconds.labels().inc(duration)
+
+        tokens = {}
+        for request in self.requests:
+            self.metrics.inter_token_latency.labels(request.label).observe(now - request.last_token_at)
+            request.last_token_at = now
+            tokens[request.label] = tokens.get(request.label, 0) + 1
+        for label, count in tokens.items():
+            self.metrics.decode_tokens.labels(label).inc(count)
+
+    # Record the timings of a speculative step, the latency is shared by the tokens it emitted
+    def record_speculate(self, request, duration, now, proposed, accepted, emitted):
+        self.metrics.decode_seconds.labels().inc(duration)
+        self.metrics.decode_tokens.labels(request.label).inc(emitted)
+        self.metrics.inter_token_latency.labels(request.label).observe((now - request.last_token_at) / emitted, emitted)
+        self.metrics.speculative_proposed.labels().inc(proposed)
+        self.metrics.speculative_accepted.labels().inc(accepted)
+        request.last_token_at = now
+
+    # Fail a request that will not be finished
+    def fail(self, request, error):
+        if self.metrics is not None and isinstance(error, RequestCancelledError):
+            self.metrics.cancelled.labels(request.label).inc()
+        self.finish(request)
+        request.streamer.fail(error)
+
+    # Bookkeeping of a request that is done, before its streamer is ended or failed
+    # The generated tokens are charged to its API key, the rate limiter reads them on its next request
+    def finish(self, request):
+        if request.tenant is not None:
+            request.tenant.record_tokens(len(request.output_ids))
+        if request.trace is not None:
+            request.trace.lap("decode")
+        if self.profile is not None and self.profile.request_done():
+            self.profile = None
+
+    # Store the cache of a finished row, so the next turn of the conversation can reuse it
+    # The last generated token was never fed to the model, so it has no cache
+    def cache_finished(self, row):
+        request = self.requests[row]
+        token_ids = request.prompt_ids + request.output_ids[:-1]
+        self.prefix_cache.insert(token_ids, tuple(
+            (key[row:row + 1, :, -len(token_ids):], value[row:row + 1, :, -len(token_ids):])
+            for key, value in self.cache_layers
+        ))
+
+    # Add the rows of a prefilled request to the batch, one row for each of its choices
+    def merge(self, requests, cache_layers, input_ids):
+        attention_mask = torch.ones((len(requests), cache_layers[0][0].shape[2] + 1), dtype=torch.long, device=self.device)
+
+        self.kv_cache_tokens += sum(request.estimated_tokens for request in requests)
+
+        if not self.requests:
+            self.requests = list(requests)
+            self.input_ids = input_ids
+            self.attention_mask = attention_mask
+            self.cache_layers = cache_layers
+            return
+
+        # Lets left pad the shortest side so both have the same length
+        length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+        batch_layers = pad_cache_layers(self.cache_layers, length - self.attention_mask.shape[1])
+        cache_layers = pad_cache_layers(cache_layers, length - attention_mask.shape[1])
+
+        self.requests.extend(requests)
+        self.input_ids = torch.cat([self.input_ids, input_ids], dim=0)
+        self.attention_mask = torch.cat([
+            F.pad(self.attention_mask, (length - self.attention_mask.shape[1], 0), value=0),
+            F.pad(attention_mask, (length - attention_mask.shape[1], 0), value=0),
+        ], dim=0)
+        self.cache_layers = tuple(
+            (torch.cat([batch_key, key], dim=0), torch.cat([batch_value, value], dim=0))
+            for (batch_key, batch_value), (key, value) in zip(batch_layers, cache_layers)
+        )
+
+    # Keep only the given rows of the batch
+    def filter(self, keep):
+        if not keep:
+            self.reset()
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.requests = [self.requests[row] for row in keep]
+        self.kv_cache_tokens = sum(request.estimated_tokens for request in self.requests)
+        self.input_ids = self.input_ids[index]
+        self.attention_mask = self.attention_mask[index]
+
+        # Drop the padding columns that no remaining row is using
+        drop = self.attention_mask.shape[1] - int(self.attention_mask.sum(dim=-1).max())
+        self.attention_mask = self.attention_mask[:, drop:]
+        self.cache_layers = tuple(
+            (key[index, :, drop:], value[index, :, drop:])
+            for key, value in self.cache_layers
+        )
+
+    # Fail every request of the batch, used when a step fails
+    # The exception is raised on each request so none of them waits forever
+    def abort(self, exception):
+        for request in self.requests:
+            try:
+                self.finish(request)
+                request.streamer.fail(exception)
+            except Exception as e:
+                logger.exception(f"Error failing a generation request: {e}")
+        self.reset()
+
+    # Clear the batch state
+    def reset(self):
+        self.kv_cache_tokens = 0
+        self.requests = []
+        self.input_ids = None
+        self.attention_mask = None
+        self.cache_layers = None
+
+# Copy the key/value cache of a prompt to every choice
+def expand_cache_layers(cache_layers, rows):
+    if rows == 1:
+        return cache_layers
+    return tuple(
+        (key.repeat(rows, 1, 1, 1), value.repeat(rows, 1, 1, 1))
+        for key, value in cache_layers
+    )
+
+# Left pad the key/value tensors of every layer
+def pad_cache_layers(cache_layers, padding):
+    if padding == 0:
+        return cache_layers
+    return tuple(
+        (F.pad(key, (0, 0, padding, 0)), F.pad(value, (0, 0, padding, 0)))
+        for key, value in cache_layers
+    )
+
+# Pick the next token for every row of the batch
+# Each request brings its own sampling parameters, same warpers as model.generate
+def sample_next_tokens(logits, requests):
+    logits = logits.float()
+    greedy_tokens = logits.argmax(dim=-1)
+    if not any(request.do_sample for request in requests):
+        return greedy_tokens
+
+    temperature = torch.tensor([request.temperature if request.do_sample else 1.0 for request in requests], device=logits.device)
+    top_p = torch.tensor([request.top_p if request.do_sample else 1.0 for request in requests], device=logits.device)
+    do_sample = torch.tensor([request.do_sample for request in requests], device=logits.device)
+
+    # Temperature
+    scores = logits / temperature.unsqueeze(-1)
+
+    # Top p, we always keep at least the most probable token
+    sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    sorted_indices_to_remove = cumulative_probs <= (1 - top_p.unsqueeze(-1))
+    sorted_indices_to_remove[..., -1:] = False
+    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+    scores = scores.masked_fill(indices_to_remove, -float("inf"))
+
+    sampled_tokens = torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+    return torch.where(do_sample, sampled_tokens, greedy_tokens)
@@ -1,94 +1,164 @@
-import json
 import time
 import asyncio
 import src.ai.model_utils as model_utils
-from config import (
-    model_gpu,
-    MODEL_ID
-)
-
-# Run the generate_wrapper coroutine in the executor
-async def start_generating(response_queue, json_data, tokenizer, model, terminators, shared_executor):
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(
-            shared_executor, 
-            lambda: asyncio.run(
-                generate_wrapper(response_queue, json_data, tokenizer, model, terminators)
-            )
-        )
+import src.restapi.json as json_codec
+from src.ai.model_engine import GenerationRequest, DeadlineExceededError, RequestCancelledError
+from src.ai.model_stop import StopSequenceMatcher, truncate_at_stop
+from src.ai.model_completion_cache import CompletionBroadcast
+import src.ai.model_gpu as model_gpu
+
+class AsyncTextCollector:
+    """
+    Collects the generated tokens and completes an asyncio future with the decoded text and its finish reason once the generation ends.
+    It follows the streamer interface so the generation engine can treat both routes the same way.
+    """
+    def __init__(self, tokenizer, future, eos_token_id, trace=None):
+        self.tokenizer = tokenizer
+        self.future = future
+        self.eos_token_id = set(eos_token_id)
+        self.stop = []
+        self.token_ids = []
+        self.loop = future.get_loop()
+        self.trace = trace
+
+    def set_stop_sequences(self, stop):
+        """The text is cut at the first of these stop sequences."""
+        self.stop = stop
 
-# Define an asynchronous wrapper function for model inference
-async def generate_wrapper(response_queue, json_data, tokenizer, model, terminators):
-    await generate(response_queue, json_data, tokenizer, model, terminators)
+    def put(self, value):
+        """Store the new tokens."""
+        self.token_ids.extend(value.tolist())
+
+    def end(self):
+        """Decode the tokens and complete the future."""
+        result = truncate_at_stop(self.tokenizer.decode(self.token_ids, skip_special_tokens=True), self.stop, self.token_ids, self.eos_token_id)
+        if self.trace is not None:
+            self.trace.lap("detokenize")
+        self.loop.call_soon_threadsafe(model_utils.set_future_result, self.future, result)
+
+    def fail(self, exception):
+        """The generation failed, the exception is raised on the request."""
+        self.loop.call_soon_threadsafe(model_utils.set_future_exception, self.future, exception)
+
+# Prepare the request on the shared executor and send it to the generation engine
+# Returns the future that will hold the (text, finish reason) of every choice
+async def start_generating(json_data, model_id, tokenizer, template_cache, engine, terminators, shared_executor, completion_cache, ticket, cancellation, metrics, n=1):
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in range(n)]
+    collectors = [AsyncTextCollector(tokenizer, future, terminators, ticket.trace) for future in futures]
+    try:
+        await loop.run_in_executor(
+                shared_executor, 
+                metrics.track_executor,
+                generate, collectors, json_data, model_id, tokenizer, template_cache, engine, terminators, completion_cache, ticket, cancellation
+            )
+    except Exception:
+        # The request never reached the generation engine
+        ticket.leave()
+        raise
+    return asyncio.gather(*futures)
 
 # Function to generate inference
-async def generate(response_queue, json_data, tokenizer, model, terminators):
+# Every collector is a choice of the same prompt
+def generate(collectors, json_data, model_id, tokenizer, template_cache, engine, terminators, completion_cache, ticket, cancellation):
+
+    if ticket.trace is not None:
+        ticket.trace.lap("executor_wait")
+
+    # If the request expired or the client left while waiting for a worker, lets drop it before doing any work
+    if ticket.is_expired():
+        raise DeadlineExceededError()
+    if cancellation.cancelled:
+        raise RequestCancelledError()
 
     # Lets sanitize the parameters
-    (messages, max_tokens, do_sample, temperature, top_p) = model_utils.get_safe_parameters(json_data)
-
-    # Lets proccess the messages data
-    input_ids = tokenizer.apply_chat_template(
-        messages,
-        add_generation_prompt=True,
-        return_tensors="pt"
-    ).to(model_gpu.device)
-
-    # Manually set the pad_token_id if it's None
-    # Assuming EOS token can be used as padding
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id  
-
-    # Attention mask
-    attention_mask = (input_ids != tokenizer.pad_token_id).long()
-        
-    # Perform inference
-    outputs = model.generate(
-        input_ids,
-        attention_mask=attention_mask,
-        max_new_tokens=max_tokens,
-        eos_token_id=terminators,
-        pad_token_id=tokenizer.pad_token_id,
-        do_sample=do_sample,
-        temperature=temperature,
-        top_p=top_p,
-    )
-
-    # Lets proccess the tokens
-    token = outputs[0][input_ids.shape[-1]:]
-    response = tokenizer.decode(token, skip_special_tokens=True)
-
-    # Put the processed output into the response queue asynchronously
-    await response_queue.put(response)
+    (messages, max_tokens, do_sample, temperature, top_p, stop) = model_utils.get_safe_parameters(json_data)
+
+    choices = []
+    for collector in collectors:
+        # The engine looks for the stop sequences as it generates, so it stops right after the first one
+        # The collector cuts the text before it
+        collector.set_stop_sequences(stop)
+        stop_sequences = StopSequenceMatcher(tokenizer, stop, skip_special_tokens=True) if stop else None
+        choice_cancellation = cancellation
+
+        # Deterministic requests can be served from the completion cache
+        # or attached to an identical generation that is already running, the greedy choices share a single one
+        if completion_cache is not None and completion_cache.is_deterministic(do_sample, temperature):
+            key = completion_cache.get_key(model_id, messages, max_tokens, stop)
+            collector = completion_cache.subscribe(key, collector, terminators, max_tokens, cancellation, stop_sequences)
+            if collector is None:
+                continue
+
+            # The shared generation is only cancelled when all its clients are gone
+            choice_cancellation = collector.cancellation
+        choices.append((collector, choice_cancellation, stop_sequences))
+
+    if not choices:
+        ticket.leave()
+        return
+
+    try:
+        # Lets proccess the messages template
+        # The template cache only tokenizes the pieces of the conversation it has not seen yet
+        input_ids = template_cache.encode(messages).to(model_gpu.device)
+        if ticket.trace is not None:
+            ticket.trace.lap("chat_template")
+
+        # Schedule the inference on the generation engine, the choices share the prefill of the prompt
+        # The collectors will receive the tokens and send the response
+        engine.submit_group([
+            GenerationRequest(
+                input_ids,
+                collector,
+                max_new_tokens=max_tokens,
+                eos_token_id=terminators,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                ticket=ticket,
+                cancellation=choice_cancellation,
+                stop_sequences=stop_sequences,
+            )
+            for (collector, choice_cancellation, stop_sequences) in choices
+        ])
+    except Exception as e:
+        # Identical requests are waiting on the shared generations this request started, lets fail them too
+        # Otherwise they stay in flight and every later identical request hangs on them
+        for (collector, _, _) in choices:
+            if isinstance(collector, CompletionBroadcast):
+                collector.fail(e)
+        raise
 
 # Catch the generated tokens
 # https://platform.openai.com/docs/api-reference/chat/create
-async def catch_token(response_queue):
-    # Catch the token that are being generated
-    outputs = await response_queue.get()
+async def catch_token(future, model_id):
+    # Wait for the generated text of every choice, if the generation failed this raises its exception
+    outputs = await future
 
-    # Get the current Unix timestamp
-    current_timestamp = int(time.time())
+    # Do NOT use pretty-print here as its 3x slower than normal dump
+    # And we want to return this response to the user as FAST as possible, the bytes go straight to the Response
+    json_response = json_codec.dumps(completion_response(model_id, outputs, int(time.time())))
+
+    return json_response
 
-    # Json response
-    json_response = {
+# Chat completion object of the generated choices, a list of (text, finish reason)
+# Also used for the lines of the batch output files
+# finish_reason is "stop" for a stop sequence or an end of sequence token, "length" when max_tokens ran out
+def completion_response(model_id, outputs, created):
+    return {
         "object": "chat.completion",
-        "created": current_timestamp,
-        "model": MODEL_ID,
+        "created": created,
+        "model": model_id,
         "choices": [
             {
-                "index": 0,
+                "index": index,
                 "message": {
                     "role": "assistant",
-                    "content": outputs 
+                    "content": text
                 },
-                "finish_reason": "stop"
+                "finish_reason": finish_reason
             }
+            for (index, (text, finish_reason)) in enumerate(outputs)
         ]
     }
-
-    # Do NOT use pretty-print here as its 3x slower than normal dump
-    # And we want to return this response to the user as FAST as possible
-    json_response = json.dumps(json_response)
-
-    return json_response
\ No newline at end of file
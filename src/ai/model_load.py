@@ -1,42 +1,261 @@
+import gc
+import logging
+import torch
+import src.ai.model_gpu as model_gpu
 from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoTokenizer, AutoModelForCausalLM
+from src.ai.model_engine import GenerationEngine
+from src.ai.model_weights import load_mmap_model
+from src.ai.model_quantization import validate_dtype, validate_quantization, quantize_model, model_memory_bytes
+from src.ai.model_metrics import InferenceMetrics
+from src.ai.model_registry import ModelRegistry
+from src.ai.model_batch import BatchManager
+from src.ai.model_rate_limit import RateLimiter
+from src.ai.model_embeddings import Embedder, EmbeddingCache
+from src.ai.model_tracing import Tracer, ProfileManager
+from src.ai.model_static_cache import StaticDecoder
+from src.ai.model_speculative import PromptLookupProposer, DraftModelProposer
+from src.ai.model_prefix_cache import PrefixCache
+from src.ai.model_template import ChatTemplateCache
+from src.ai.model_completion_cache import CompletionCache
+from src.ai.model_admission import AdmissionController, kv_cache_bytes_per_token
 
 from config import (
-    model_gpu, 
     THREADS_MAX_WORKERS,
+    MAX_BATCH_SIZE,
+    TORCH_NUM_THREADS,
+    MAX_QUEUE_DEPTH,
+    QUEUE_RETRY_AFTER,
+    REQUEST_TIMEOUT,
+    KV_CACHE_BUDGET_MB,
     MODEL_ID,
+    MODEL_IDS,
+    MODEL_MEMORY_BUDGET_MB,
+    PINNED_MODEL_IDS,
     CONVERT_TOKENS_TO_IDS,
-    TORCH_DTYPE
+    PREFIX_CACHE_MAX_MB,
+    CHAT_TEMPLATE_CACHE_SIZE,
+    MMAP_WEIGHTS,
+    SPECULATIVE_MODE,
+    DRAFT_MODEL_ID,
+    SPECULATIVE_TOKENS,
+    PROMPT_LOOKUP_MAX_NGRAM,
+    STATIC_KV_CACHE,
+    STATIC_KV_CACHE_LENGTHS,
+    TORCH_COMPILE,
+    TORCH_DTYPE,
+    QUANTIZATION,
+    QUANTIZATION_GROUP_SIZE,
+    COMPLETION_CACHE_SIZE,
+    COMPLETION_CACHE_TTL,
+    COMPLETION_CACHE_DIR,
+    BATCH_DIR,
+    BATCH_MAX_IN_FLIGHT,
+    BATCH_JOB_TTL,
+    BATCH_MAX_JOBS,
+    REPLICA_ID,
+    RATE_LIMIT_REQUESTS_PER_SECOND,
+    RATE_LIMIT_REQUESTS_BURST,
+    RATE_LIMIT_TOKENS_PER_SECOND,
+    RATE_LIMIT_TOKENS_BURST,
+    API_KEY_WEIGHTS,
+    EMBEDDINGS_POOLING,
+    EMBEDDINGS_NORMALIZE,
+    EMBEDDINGS_BATCH_WINDOW_MS,
+    EMBEDDINGS_MAX_BATCH_SIZE,
+    EMBEDDINGS_MAX_TOKENS,
+    EMBEDDINGS_CACHE_SIZE,
+    TRACING_ENABLED,
+    TRACE_LOG_FILE,
+    TRACE_SAMPLE_RATE,
+    PROFILE_DIR
 )
 
-def init():
+logger = logging.getLogger()
+
+# Torch dtype of the TORCH_DTYPE setting
+torch_dtype = getattr(torch, TORCH_DTYPE)
+
+# on_stage is called with every stage of model_startup.LOAD_STAGES, to report the progress of the startup
+def init(on_stage=lambda stage: None):
     try:
-        # Load the tokens
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        # What device are we using
+        logger.info(f"Using device: {model_gpu.device}")
 
-        # Load the model
-        model = AutoModelForCausalLM.from_pretrained(
+        # Lets fail early if the device can not run the dtype or the quantization
+        validate_dtype(torch_dtype, model_gpu.device)
+        validate_quantization(QUANTIZATION, torch_dtype, model_gpu.device)
+
+        # Inference metrics, shared by all the models
+        metrics = InferenceMetrics()
+
+        # Registry of the models we can serve, MODEL_ID is the default one
+        model_ids = [MODEL_ID] + [model_id for model_id in MODEL_IDS if model_id != MODEL_ID]
+        registry = ModelRegistry(
+            model_ids,
             MODEL_ID,
-            torch_dtype=TORCH_DTYPE,
-            device_map=model_gpu.device,
+            MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+            PINNED_MODEL_IDS,
+            load=lambda model_id, on_stage: load_dependencies(model_id, metrics, on_stage),
+            unload=lambda dependencies: unload_dependencies(dependencies, metrics),
         )
 
-        # Lets set the terminators
-        terminators = [
-            tokenizer.eos_token_id,
-            tokenizer.convert_tokens_to_ids(CONVERT_TOKENS_TO_IDS)
-        ]
+        # Lets expose the state of the engines, the queues and the caches on the metrics
+        metrics.watch(registry.resident_dependencies)
+
+        # The default model and the pinned ones are loaded on startup, the others on their first request
+        registry.load(MODEL_ID, on_stage).result()
+        for model_id in PINNED_MODEL_IDS:
+            if registry.get(model_id) is not None:
+                registry.load(model_id).result()
 
-        # Shared Thread Pool Executor
-        shared_executor = ThreadPoolExecutor(max_workers=THREADS_MAX_WORKERS)
+        # Jobs of /v1/batches, they run on the same engines behind the interactive requests
+        batches = BatchManager(registry, metrics, BATCH_DIR, BATCH_MAX_IN_FLIGHT, QUEUE_RETRY_AFTER, BATCH_JOB_TTL, BATCH_MAX_JOBS, REPLICA_ID)
+
+        # Rate limits and fair queue weights of the API keys, shared by all the models
+        limiter = RateLimiter(
+            RATE_LIMIT_REQUESTS_PER_SECOND,
+            RATE_LIMIT_REQUESTS_BURST,
+            RATE_LIMIT_TOKENS_PER_SECOND,
+            RATE_LIMIT_TOKENS_BURST,
+            API_KEY_WEIGHTS
+        )
 
         return {
-            "tokenizer": tokenizer, 
-            "model": model, 
-            "terminators": terminators, 
-            "shared_executor": shared_executor
+            "registry": registry,
+            "metrics": metrics,
+            "batches": batches,
+            "limiter": limiter,
+            "tracer": Tracer(TRACING_ENABLED, TRACE_LOG_FILE, TRACE_SAMPLE_RATE),
+            "profiles": ProfileManager(PROFILE_DIR)
         }
     except Exception as e:
         # Handle initialization error
         print(f"Error initializing model dependencies: {e}")
         raise
+
+# Load a model with its own tokenizer, caches, executor, admission queue and generation engine
+# Returns (dependencies, bytes of the weights)
+def load_dependencies(model_id, metrics, on_stage):
+    # Load the tokens
+    on_stage("tokenizer")
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+    # Load the model
+    on_stage("weights")
+    model = load_model(model_id)
+
+    on_stage("engine")
+
+    # Lets set the terminators
+    terminators = get_terminators(tokenizer)
+
+    # Memoized chat template tokenization
+    template_cache = ChatTemplateCache(tokenizer, CHAT_TEMPLATE_CACHE_SIZE)
+
+    # Cache of deterministic completions
+    completion_cache = None
+    if COMPLETION_CACHE_SIZE > 0:
+        completion_cache = CompletionCache(COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL, COMPLETION_CACHE_DIR)
+
+    # Thread Pool Executor of the model, shared by its requests
+    shared_executor = ThreadPoolExecutor(max_workers=THREADS_MAX_WORKERS)
+
+    # Shared prefix cache between requests
+    prefix_cache = None
+    if PREFIX_CACHE_MAX_MB > 0:
+        prefix_cache = PrefixCache(PREFIX_CACHE_MAX_MB * 1024 * 1024)
+
+    # Key/value cache budget in tokens, estimated from the model shape
+    kv_cache_budget_tokens = 0
+    if KV_CACHE_BUDGET_MB > 0:
+        kv_cache_budget_tokens = (KV_CACHE_BUDGET_MB * 1024 * 1024) // kv_cache_bytes_per_token(model)
+
+    # Speculative decoding proposer
+    # The draft model shares the tokenizer of MODEL_ID, so it only speculates for that model
+    speculator = None
+    if SPECULATIVE_MODE == "prompt_lookup":
+        speculator = PromptLookupProposer(SPECULATIVE_TOKENS, PROMPT_LOOKUP_MAX_NGRAM)
+    elif SPECULATIVE_MODE == "draft":
+        if model_id == MODEL_ID:
+            speculator = DraftModelProposer(load_model(DRAFT_MODEL_ID), SPECULATIVE_TOKENS)
+    elif SPECULATIVE_MODE:
+        raise ValueError(f"Unknown SPECULATIVE_MODE {SPECULATIVE_MODE}, use draft or prompt_lookup")
+
+    # Compiled decode step on a static key/value cache
+    static_decoder = None
+    if STATIC_KV_CACHE:
+        static_decoder = StaticDecoder(model, MAX_BATCH_SIZE, STATIC_KV_CACHE_LENGTHS, TORCH_COMPILE)
+
+    # Generation engine, it batches the decoding of all the requests
+    engine = GenerationEngine(model, MAX_BATCH_SIZE, prefix_cache, kv_cache_budget_tokens, TORCH_NUM_THREADS, metrics, speculator, static_decoder)
+
+    # Lets wait for the warm-up, so the model does not take traffic before the decode step is compiled
+    on_stage("warm_up")
+    engine.ready.wait()
+
+    # Admission control in front of the generation engine
+    admission = AdmissionController(MAX_QUEUE_DEPTH, REQUEST_TIMEOUT)
+
+    # Embeddings from the same model, batched on the engine thread
+    embedder = Embedder(
+        model,
+        tokenizer,
+        engine,
+        EMBEDDINGS_POOLING,
+        EMBEDDINGS_NORMALIZE,
+        EMBEDDINGS_BATCH_WINDOW_MS / 1000,
+        EMBEDDINGS_MAX_BATCH_SIZE,
+        EMBEDDINGS_MAX_TOKENS,
+        EmbeddingCache(EMBEDDINGS_CACHE_SIZE) if EMBEDDINGS_CACHE_SIZE > 0 else None,
+        metrics
+    )
+
+    dependencies = {
+        "model_id": model_id,
+        "tokenizer": tokenizer, 
+        "template_cache": template_cache,
+        "model": model, 
+        "terminators": terminators, 
+        "shared_executor": shared_executor,
+        "engine": engine,
+        "completion_cache": completion_cache,
+        "admission": admission,
+        "embedder": embedder
+    }
+    return (dependencies, model_memory_bytes(model))
+
+# Free an idle model, its engine thread exits and the memory goes back once nothing references it
+def unload_dependencies(dependencies, metrics):
+    metrics.retire(dependencies)
+    dependencies["engine"].stop()
+    dependencies["shared_executor"].shutdown(wait=False)
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# Token ids that end a generation
+def get_terminators(tokenizer):
+    return [
+        tokenizer.eos_token_id,
+        tokenizer.convert_tokens_to_ids(CONVERT_TOKENS_TO_IDS)
+    ]
+
+# Load a model, memory mapping the weights when we can
+def load_model(model_id):
+    model = None
+    if MMAP_WEIGHTS:
+        model = load_mmap_model(model_id, torch_dtype, model_gpu.device)
+    if model is None:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=torch_dtype,
+            device_map=model_gpu.device,
+            low_cpu_mem_usage=True,
+        )
+
+    # Quantized weights are private copies, only the layers left as they are stay memory mapped
+    model = quantize_model(model, QUANTIZATION, QUANTIZATION_GROUP_SIZE)
+    logger.info(f"Model {model_id} takes {model_memory_bytes(model) / (1024 * 1024):.1f} MB of weights ({TORCH_DTYPE}, quantization: {QUANTIZATION or 'none'})")
+    return model
@@ -0,0 +1,266 @@
+import bisect
+import threading
+
+# Buckets in seconds, from a single decode step up to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Buckets in tokens
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+class CounterValue:
+    """Value of a counter for one set of labels."""
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    # Used for the counters that other components keep on their own
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class GaugeValue:
+    """Value of a gauge for one set of labels."""
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class HistogramValue:
+    """Value of a histogram for one set of labels, the buckets are cumulated when rendered."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # count lets us record the same value for several events at once
+    def observe(self, value, count=1):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += count
+            self.sum += value * count
+            self.count += count
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            (total, count) = (self.sum, self.count)
+
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            samples.append((name + "_bucket", labels + (("le", format_value(bound)),), cumulative))
+        samples.append((name + "_sum", labels, total))
+        samples.append((name + "_count", labels, count))
+        return samples
+
+class Metric:
+    """
+    Metric family, with one value for each set of label values.
+    Values are created the first time their labels are used, after that labels() is a dict lookup.
+    """
+    def __init__(self, name, documentation, type, label_names, value_factory):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.label_names = tuple(label_names)
+        self.value_factory = value_factory
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *label_values):
+        value = self.values.get(label_values)
+        if value is None:
+            with self.lock:
+                value = self.values.setdefault(label_values, self.value_factory())
+        return value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for label_values, value in list(self.values.items()):
+            for (name, labels, sample) in value.samples(self.name, tuple(zip(self.label_names, label_values))):
+                lines.append(f"{name}{format_labels(labels)} {format_value(sample)}")
+        return lines
+
+class MetricsRegistry:
+    """Holds the metrics and renders them in the Prometheus text format."""
+    def __init__(self):
+        self.metrics = []
+
+        # Functions called when the metrics are rendered, to refresh the gauges that are read from other objects
+        self.collectors = []
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Metric(name, documentation, "counter", label_names, CounterValue))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Metric(name, documentation, "gauge", label_names, GaugeValue))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.register(Metric(name, documentation, "histogram", label_names, lambda: HistogramValue(tuple(buckets))))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        # Metrics without labels are rendered from the start
+        if not metric.label_names:
+            metric.labels()
+        return metric
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class InferenceMetrics(MetricsRegistry):
+    """
+    Metrics of the inference pipeline, served on /v1/metrics.
+    Most of them are labeled by stream ("true" or "false"), the engine records its own timings
+    so nothing is added to the streamer per token path.
+    """
+    def __init__(self):
+        super().__init__()
+
+        # Requests
+        self.requests = self.counter("palmapy_requests_total", "Inference requests received.", ["stream"])
+        self.errors = self.counter("palmapy_errors_total", "Inference requests that failed, by error code.", ["stream", "code"])
+        self.cancelled = self.counter("palmapy_cancelled_total", "Generations stopped because the client disconnected.", ["stream"])
+
+        # Latency
+        self.queue_wait = self.histogram("palmapy_queue_wait_seconds", "Seconds from admission until the generation engine starts the request.", ["stream"])
+        self.time_to_first_token = self.histogram("palmapy_time_to_first_token_seconds", "Seconds from admission until the first generated token.", ["stream"])
+        self.inter_token_latency = self.histogram("palmapy_inter_token_latency_seconds", "Seconds between two generated tokens of the same request.", ["stream"])
+
+        # Throughput, tokens per second is rate(tokens) / rate(seconds)
+        self.prefill_tokens = self.counter("palmapy_prefill_tokens_total", "Prompt tokens run through the model, not counting cached prefixes.", ["stream"])
+        self.prefill_seconds = self.counter("palmapy_prefill_seconds_total", "Seconds spent on prefill.")
+        self.decode_tokens = self.counter("palmapy_decode_tokens_total", "Tokens generated by decode steps.", ["stream"])
+        self.decode_seconds = self.counter("palmapy_decode_seconds_total", "Seconds spent on decode steps.")
+
+        # Speculative decoding, the acceptance rate is rate(accepted) / rate(proposed)
+        self.speculative_proposed = self.counter("palmapy_speculative_proposed_tokens_total", "Candidate tokens proposed by speculative decoding.")
+        self.speculative_accepted = self.counter("palmapy_speculative_accepted_tokens_total", "Candidate tokens accepted by speculative decoding.")
+
+        # Token counts of finished requests
+        self.prompt_tokens = self.histogram("palmapy_prompt_tokens", "Prompt tokens of each finished request.", ["stream"], TOKEN_BUCKETS)
+        self.completion_tokens = self.histogram("palmapy_completion_tokens", "Generated tokens of each finished request.", ["stream"], TOKEN_BUCKETS)
+
+        # Load
+        self.active_generations = self.gauge("palmapy_active_generations", "Requests on the generation engine batch.", ["stream"])
+        self.waiting_generations = self.gauge("palmapy_waiting_generations", "Requests waiting for a slot on the generation engine batch.")
+        self.queue_depth = self.gauge("palmapy_queue_depth", "Requests holding a place on the admission queue.")
+        self.queue_rejected = self.counter("palmapy_queue_rejected_total", "Requests rejected because the admission queue was full.")
+        self.rate_limited = self.counter("palmapy_rate_limited_total", "Requests rejected because their API key was over a rate limit, by limit.", ["limit"])
+        self.executor_busy = self.gauge("palmapy_executor_busy_workers", "Shared executor workers preparing a request.")
+        self.executor_pending = self.gauge("palmapy_executor_pending_tasks", "Tasks waiting for a shared executor worker.")
+        self.executor_max_workers = self.gauge("palmapy_executor_max_workers", "Size of the shared executor.")
+
+        # Embeddings
+        self.embedding_batch_inputs = self.histogram("palmapy_embedding_batch_inputs", "Inputs of each embedding forward pass.", (), TOKEN_BUCKETS)
+        self.embedding_tokens = self.counter("palmapy_embedding_tokens_total", "Tokens run through the model for embeddings, not counting cached inputs.")
+
+        # Caches
+        self.cache_hits = self.counter("palmapy_cache_hits_total", "Cache hits.", ["cache"])
+        self.cache_misses = self.counter("palmapy_cache_misses_total", "Cache misses.", ["cache"])
+
+        # Counters of the models that were unloaded
+        self.retired_rejected = 0
+        self.retired_caches = {}
+
+    # Run a function on the shared executor, keeping count of the busy workers
+    def track_executor(self, function, *args):
+        busy = self.executor_busy.labels()
+        busy.inc()
+        try:
+            return function(*args)
+        finally:
+            busy.dec()
+
+    # Lets read the state of the other components when the metrics are rendered
+    # models returns the dependencies of every resident model, their state is added up
+    def watch(self, models):
+        def collect():
+            dependencies = models()
+
+            requests = [request for item in dependencies for request in item["engine"].requests]
+            streaming = sum(1 for request in requests if request.stream)
+            self.active_generations.labels("true").set(streaming)
+            self.active_generations.labels("false").set(len(requests) - streaming)
+            self.waiting_generations.labels().set(sum(len(item["engine"].waiting) + item["engine"].pending.qsize() for item in dependencies))
+
+            self.queue_depth.labels().set(sum(item["admission"].queued for item in dependencies))
+            self.queue_rejected.labels().set(self.retired_rejected + sum(item["admission"].rejected for item in dependencies))
+
+            # ThreadPoolExecutor has no public API for its backlog
+            self.executor_pending.labels().set(sum(item["shared_executor"]._work_queue.qsize() for item in dependencies))
+            self.executor_max_workers.labels().set(sum(item["shared_executor"]._max_workers for item in dependencies))
+
+            totals = dict(self.retired_caches)
+            for item in dependencies:
+                add_cache_stats(totals, item)
+            for name, (hits, misses) in totals.items():
+                self.cache_hits.labels(name).set(hits)
+                self.cache_misses.labels(name).set(misses)
+        self.collectors.append(collect)
+
+    # Keep the counters of an unloaded model, so the totals never go down
+    def retire(self, dependencies):
+        self.retired_rejected += dependencies["admission"].rejected
+        add_cache_stats(self.retired_caches, dependencies)
+
+# Add the hits and misses of the caches of a model to the (hits, misses) totals by cache label
+def add_cache_stats(totals, dependencies):
+    caches = {
+        "prefix": dependencies["engine"].prefix_cache,
+        "completion": dependencies["completion_cache"],
+        "chat_template": dependencies["template_cache"],
+        "embedding": dependencies["embedder"].cache,
+    }
+    for name, cache in caches.items():
+        if cache is not None:
+            stats = cache.stats()
+            (hits, misses) = totals.get(name, (0, 0))
+            totals[name] = (hits + stats["hits"], misses + stats["misses"])
+
+# Stream label value
+def stream_label(stream):
+    return "true" if stream else "false"
+
+# Labels in the Prometheus text format, like {stream="true",code="timeout"}
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
@@ -0,0 +1,180 @@
+import heapq
+import torch
+
+class PrefixCacheNode:
+    """
+    Node of the prefix cache radix tree.
+    Holds the key/value cache of the tokens on the edge that goes from its parent to this node.
+    """
+    def __init__(self, parent, token_ids, cache_layers):
+        self.parent = parent
+        self.token_ids = token_ids
+        self.cache_layers = cache_layers
+        self.children = {}
+        self.last_access = 0
+        self.size = cache_layers_bytes(cache_layers)
+
+class PrefixCache:
+    """
+    Radix tree of key/value caches keyed on token ids prefixes.
+    A new request only has to prefill the tokens after its longest cached prefix.
+    When the cache goes over its byte budget the least recently used leaves are evicted.
+    It is only used by the generation engine thread, so it does not need any locking.
+    """
+    def __init__(self, max_bytes):
+        self.root = PrefixCacheNode(None, (), ())
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.clock = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    # Find the longest cached prefix of token_ids, up to max_length tokens
+    # Returns (length, cache_layers) where cache_layers is None on a miss
+    def lookup(self, token_ids, max_length):
+        self.clock += 1
+        node = self.root
+        position = 0
+        matched_layers = []
+
+        while position < max_length:
+            child = node.children.get(token_ids[position])
+            if child is None:
+                break
+
+            length = common_prefix_length(child.token_ids, token_ids[position:max_length])
+            child.last_access = self.clock
+            matched_layers.append(slice_cache_layers(child.cache_layers, 0, length))
+            position += length
+
+            # We matched only a part of the edge
+            if length < len(child.token_ids):
+                break
+            node = child
+
+        if position == 0:
+            self.misses += 1
+            return (0, None)
+
+        self.hits += 1
+        self.hit_tokens += position
+        return (position, concat_cache_layers(matched_layers))
+
+    # Store the key/value cache of token_ids
+    # cache_layers must have one position for each token id
+    def insert(self, token_ids, cache_layers):
+        self.clock += 1
+        node = self.root
+        position = 0
+
+        while position < len(token_ids):
+            child = node.children.get(token_ids[position])
+
+            # Lets add the tokens we have not seen yet as a new leaf
+            if child is None:
+                leaf = PrefixCacheNode(
+                    node,
+                    tuple(token_ids[position:]),
+                    clone_cache_layers(slice_cache_layers(cache_layers, position, len(token_ids)))
+                )
+                leaf.last_access = self.clock
+                node.children[token_ids[position]] = leaf
+                self.bytes += leaf.size
+                break
+
+            length = common_prefix_length(child.token_ids, token_ids[position:])
+            if length < len(child.token_ids):
+                self.split(child, length)
+
+            child.last_access = self.clock
+            node = child
+            position += length
+
+        self.evict()
+
+    # Split the edge of a node in two, the node keeps the first length tokens
+    def split(self, node, length):
+        lower = PrefixCacheNode(
+            node,
+            node.token_ids[length:],
+            clone_cache_layers(slice_cache_layers(node.cache_layers, length, len(node.token_ids)))
+        )
+        lower.children = node.children
+        lower.last_access = node.last_access
+        for child in lower.children.values():
+            child.parent = lower
+
+        node.token_ids = node.token_ids[:length]
+        node.cache_layers = clone_cache_layers(slice_cache_layers(node.cache_layers, 0, length))
+        node.size = cache_layers_bytes(node.cache_layers)
+        node.children = {lower.token_ids[0]: lower}
+
+    # Remove the least recently used leaves until we are under the budget
+    def evict(self):
+        if self.bytes <= self.max_bytes:
+            return
+
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            elif node is not self.root:
+                leaves.append((node.last_access, id(node), node))
+        heapq.heapify(leaves)
+
+        while self.bytes > self.max_bytes and leaves:
+            (_, _, node) = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.token_ids[0]]
+            self.bytes -= node.size
+            self.evictions += 1
+
+            # The parent could be a leaf now
+            if not parent.children and parent is not self.root:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+
+    # Lets report the counters
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "evictions": self.evictions,
+            "bytes": self.bytes,
+        }
+
+# Number of equal tokens at the start of both sequences
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+# Take the positions [start, end) of the key/value tensors of every layer
+def slice_cache_layers(cache_layers, start, end):
+    return tuple((key[:, :, start:end], value[:, :, start:end]) for key, value in cache_layers)
+
+# Join a list of key/value caches on the sequence dimension
+def concat_cache_layers(cache_layers_list):
+    if len(cache_layers_list) == 1:
+        return cache_layers_list[0]
+    return tuple(
+        (torch.cat([layers[0] for layers in layer], dim=2), torch.cat([layers[1] for layers in layer], dim=2))
+        for layer in zip(*cache_layers_list)
+    )
+
+# Copy the key/value tensors so they do not keep bigger tensors alive
+def clone_cache_layers(cache_layers):
+    return tuple((key.clone(), value.clone()) for key, value in cache_layers)
+
+# Size in bytes of the key/value tensors
+def cache_layers_bytes(cache_layers):
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in cache_layers)
@@ -0,0 +1,187 @@
+import logging
+import torch
+from torch import nn
+
+logger = logging.getLogger()
+
+# Values of the QUANTIZATION setting
+QUANTIZATION_MODES = ("int8_dynamic", "int8_weight_only", "int4_weight_only")
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    Linear layer with int8 weights and one float scale per output channel.
+    Activations stay in the model dtype, the weights are dequantized inside the matmul kernel.
+    """
+    def __init__(self, weight, scales, bias):
+        super().__init__()
+        self.in_features = weight.shape[1]
+        self.out_features = weight.shape[0]
+        self.register_buffer("weight", weight)
+        self.register_buffer("scales", scales)
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_linear(cls, linear):
+        weight = linear.weight.detach().float()
+        scales = (weight.abs().amax(dim=1) / 127).clamp(min=1e-8)
+        quantized = (weight / scales[:, None]).round().clamp(-128, 127).to(torch.int8)
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(quantized, scales.to(linear.weight.dtype), bias)
+
+    def forward(self, x):
+        # The kernel only takes 2D activations
+        output = torch._weight_int8pack_mm(x.reshape(-1, self.in_features), self.weight, self.scales)
+        output = output.reshape(*x.shape[:-1], self.out_features)
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    Linear layer with packed int4 weights, quantized in groups of group_size input features.
+    Every group has its own scale and zero point, only the CPU kernel is supported.
+    """
+    # Tiling of the packed weights, the value the CPU kernel is tuned for
+    INNER_K_TILES = 2
+
+    def __init__(self, packed_weight, scales_and_zeros, bias, in_features, out_features, group_size):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.register_buffer("packed_weight", packed_weight)
+        self.register_buffer("scales_and_zeros", scales_and_zeros)
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_linear(cls, linear, group_size):
+        (out_features, in_features) = linear.weight.shape
+        weight = linear.weight.detach().float().reshape(out_features, in_features // group_size, group_size)
+
+        # Asymmetric quantization to 0..15, dequantized as (q - 8) * scale + zero
+        minimum = weight.amin(dim=-1, keepdim=True)
+        maximum = weight.amax(dim=-1, keepdim=True)
+        scales = ((maximum - minimum) / 15).clamp(min=1e-8)
+        zeros = minimum + scales * 8
+        quantized = ((weight - minimum) / scales).round().clamp(0, 15).to(torch.int32).reshape(out_features, in_features)
+
+        packed_weight = torch.ops.aten._convert_weight_to_int4pack_for_cpu(quantized, cls.INNER_K_TILES)
+        scales_and_zeros = torch.cat([scales, zeros], dim=-1).transpose(0, 1).contiguous().to(linear.weight.dtype)
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(packed_weight, scales_and_zeros, bias, in_features, out_features, group_size)
+
+    def forward(self, x):
+        output = torch.ops.aten._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features), self.packed_weight, self.group_size, self.scales_and_zeros
+        )
+        output = output.reshape(*x.shape[:-1], self.out_features)
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+# Lets make sure the device can run the dtype, and warn when it is only emulated
+def validate_dtype(torch_dtype, device):
+    device_type = torch.device(device).type
+
+    if device_type == "cuda" and torch_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        raise ValueError("This CUDA device does not support bfloat16, use TORCH_DTYPE=float16")
+
+    if device_type == "mps" and torch_dtype == torch.bfloat16 and not torch.backends.mps.is_macos_or_newer(14, 0):
+        raise ValueError("bfloat16 on Apple Metal needs macOS 14 or newer, use TORCH_DTYPE=float16")
+
+    # CPUs without native support convert every matmul, which is slower than float32
+    if device_type == "cpu" and torch_dtype == torch.bfloat16 and not torch.cpu._is_avx512_bf16_supported():
+        logger.warning("This CPU has no native bfloat16 support, TORCH_DTYPE=float32 or QUANTIZATION may be faster")
+    if device_type == "cpu" and torch_dtype == torch.float16 and not torch.cpu._is_amx_fp16_supported():
+        logger.warning("This CPU has no native float16 support, TORCH_DTYPE=float32 or QUANTIZATION may be faster")
+
+# Lets make sure the quantization mode runs with this dtype and on this device
+def validate_quantization(mode, torch_dtype, device):
+    if not mode:
+        return
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown QUANTIZATION {mode}, use one of {', '.join(QUANTIZATION_MODES)}")
+
+    device_type = torch.device(device).type
+    if mode == "int8_dynamic":
+        # The dynamic quantized kernels are only built for the CPU, and take float32 activations
+        if device_type != "cpu":
+            raise ValueError("QUANTIZATION=int8_dynamic is only supported on the CPU")
+        if torch_dtype != torch.float32:
+            raise ValueError("QUANTIZATION=int8_dynamic needs TORCH_DTYPE=float32")
+    elif mode == "int4_weight_only" and device_type != "cpu":
+        raise ValueError("QUANTIZATION=int4_weight_only is only supported on the CPU")
+
+    # The CPU weight only kernels are tuned for half precision activations
+    if mode in ("int8_weight_only", "int4_weight_only") and device_type == "cpu" and torch_dtype == torch.float32:
+        logger.warning(f"QUANTIZATION={mode} is slow with float32 activations on the CPU, use TORCH_DTYPE=bfloat16 or QUANTIZATION=int8_dynamic")
+
+    # The weight only kernels depend on the build and the backend, lets try them on a small layer
+    if mode in ("int8_weight_only", "int4_weight_only"):
+        linear = nn.Linear(256, 16, dtype=torch_dtype)
+        try:
+            if mode == "int8_weight_only":
+                layer = Int8WeightOnlyLinear.from_linear(linear).to(device)
+            else:
+                layer = Int4WeightOnlyLinear.from_linear(linear, 128)
+            layer(torch.zeros(1, 256, dtype=torch_dtype, device=device))
+        except (RuntimeError, NotImplementedError, AttributeError) as e:
+            raise ValueError(f"QUANTIZATION={mode} is not supported on {device_type} with {torch_dtype}: {e}")
+
+# Quantize the Linear layers of the model
+# The output embeddings are kept as they are, they are often tied to the input embeddings and decide the sampled token
+def quantize_model(model, mode, group_size):
+    if not mode:
+        return model
+
+    output_embeddings = model.get_output_embeddings()
+    names = [
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and module is not output_embeddings
+    ]
+
+    if mode == "int8_dynamic":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {name: torch.ao.quantization.default_dynamic_qconfig for name in names}, dtype=torch.qint8
+        )
+    else:
+        skipped = 0
+        for name in names:
+            (parent_name, _, child_name) = name.rpartition(".")
+            parent = model.get_submodule(parent_name)
+            linear = getattr(parent, child_name)
+            if mode == "int8_weight_only":
+                setattr(parent, child_name, Int8WeightOnlyLinear.from_linear(linear))
+            elif linear.in_features % group_size == 0:
+                setattr(parent, child_name, Int4WeightOnlyLinear.from_linear(linear, group_size))
+            else:
+                skipped += 1
+        if skipped:
+            logger.warning(f"{skipped} Linear layers are not a multiple of QUANTIZATION_GROUP_SIZE={group_size}, they are not quantized")
+
+    logger.info(f"Quantized {len(names)} Linear layers with {mode}")
+    return model
+
+# Bytes taken by the weights and buffers of the model, counting tied and shared tensors once
+def model_memory_bytes(model):
+    seen = set()
+    total = 0
+
+    # The state dict also holds the packed weights of the dynamic quantized layers
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        for tensor in tensors:
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset()) if not tensor.is_quantized else id(tensor)
+            if key in seen:
+                continue
+            seen.add(key)
+            total += tensor.nelement() * tensor.element_size()
+    return total
@@ -0,0 +1,140 @@
+import math
+import time
+import collections
+
+# Tenants kept before the idle ones are dropped
+MAX_IDLE_TENANTS = 10000
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second, up to burst tokens.
+    It is only used from the event loop and never awaits, so coroutines can not interleave on it and it needs no lock.
+    A rate of 0 is unlimited.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst if burst > 0 else max(rate, 1)
+        self.tokens = self.burst
+        self.updated_at = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Take amount tokens if there are enough, returns True if they were taken
+    def take(self, amount, now):
+        if self.rate <= 0:
+            return True
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    # Take tokens that were already used, the bucket can go below 0
+    def charge(self, amount, now):
+        if self.rate <= 0:
+            return
+        self.refill(now)
+        self.tokens -= amount
+
+    # Seconds until the bucket has amount tokens
+    def retry_after(self, amount, now):
+        if self.rate <= 0:
+            return 0.0
+        self.refill(now)
+        return max(amount - self.tokens, 0) / self.rate
+
+    # True when the bucket is full, so forgetting it changes nothing
+    def full(self, now):
+        if self.rate <= 0:
+            return True
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class Tenant:
+    """
+    An API key with its rate limits and its weight on the fair queue of the generation engines.
+    The engines report the generated tokens on generated_tokens, a deque is safe to append to from their threads.
+    """
+    def __init__(self, key, weight, requests, tokens):
+        self.key = key
+        self.weight = weight
+        self.requests = requests
+        self.tokens = tokens
+        self.generated_tokens = collections.deque()
+
+    # Called by the generation engine once a request is done
+    def record_tokens(self, count):
+        if count > 0:
+            self.generated_tokens.append(count)
+
+class RateLimiter:
+    """
+    Per API key token buckets on requests per second and generated tokens per second.
+    The generated tokens are only known once a request is done, so they are charged afterwards
+    and a key over its budget is rejected until the bucket refills.
+    """
+    def __init__(self, requests_per_second, requests_burst, tokens_per_second, tokens_burst, weights):
+        self.requests_per_second = requests_per_second
+        self.requests_burst = requests_burst
+        self.tokens_per_second = tokens_per_second
+        self.tokens_burst = tokens_burst
+
+        # Weight of every key on the fair queue, 1 by default
+        self.weights = weights
+        self.tenants = {}
+
+    # Tenant of an API key, created on its first request
+    def tenant(self, key, now=None):
+        now = now if now is not None else time.monotonic()
+        tenant = self.tenants.get(key)
+        if tenant is None:
+            if len(self.tenants) >= MAX_IDLE_TENANTS:
+                self.drop_idle(now)
+            tenant = Tenant(
+                key,
+                self.weights.get(key, 1.0),
+                TokenBucket(self.requests_per_second, self.requests_burst, now),
+                TokenBucket(self.tokens_per_second, self.tokens_burst, now),
+            )
+            self.tenants[key] = tenant
+        return tenant
+
+    # Check the limits of a request
+    # Returns (limit, retry_after), limit is None if the request can go ahead
+    def check(self, tenant, now=None):
+        now = now if now is not None else time.monotonic()
+
+        # Lets charge the tokens generated since the last request
+        while tenant.generated_tokens:
+            tenant.tokens.charge(tenant.generated_tokens.popleft(), now)
+
+        # A key that went over its tokens budget waits until the bucket is out of debt
+        if not tenant.tokens.take(0, now):
+            return ("tokens", retry_seconds(tenant.tokens.retry_after(0, now)))
+        if not tenant.requests.take(1, now):
+            return ("requests", retry_seconds(tenant.requests.retry_after(1, now)))
+        return (None, 0)
+
+    # Forget the tenants whose buckets are full, a new tenant would start the same
+    def drop_idle(self, now):
+        self.tenants = {
+            key: tenant for (key, tenant) in self.tenants.items()
+            if tenant.generated_tokens or not tenant.requests.full(now) or not tenant.tokens.full(now)
+        }
+
+# Whole seconds for the Retry-After header
+def retry_seconds(seconds):
+    return max(1, math.ceil(seconds))
+
+# API key of a request, from the Palmapy-Server-Api-Key header or an Authorization bearer token
+# Requests without a key share the empty key
+def api_key(headers, header_name):
+    key = headers.get(header_name)
+    if key:
+        return key
+    authorization = headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        return authorization[7:].strip()
+    return ""
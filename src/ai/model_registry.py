@@ -0,0 +1,174 @@
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+class ModelEntry:
+    """
+    A model the server can serve, resident or not.
+    Every resident model has its own engine, executor and admission queue, so a slow model can not starve the others.
+    """
+    def __init__(self, model_id, pinned):
+        self.model_id = model_id
+        self.pinned = pinned
+
+        # Dependencies returned by the load function, None while the model is not resident
+        self.dependencies = None
+
+        # Bytes of the weights, kept after an eviction as the estimate for the next load
+        self.memory_bytes = 0
+
+        # Future of the load in progress
+        self.loading = None
+
+        # Requests holding the model, and the last time one was released
+        self.in_flight = 0
+        self.last_used = 0.0
+
+    @property
+    def resident(self):
+        return self.dependencies is not None
+
+    # A model can be evicted when no request holds it and its engine has nothing to do
+    def idle(self):
+        return self.in_flight == 0 and self.dependencies["engine"].idle()
+
+class ModelRegistry:
+    """
+    Loads the models lazily, the first time a request names them.
+    Keeps as many resident as fit on the memory budget, evicting the least recently used idle model that is not pinned.
+    Models are loaded one at a time on the loader thread.
+    """
+    def __init__(self, model_ids, default_model_id, memory_budget_bytes, pinned_model_ids, load, unload):
+        self.default_model_id = default_model_id
+        self.memory_budget_bytes = memory_budget_bytes
+        self.entries = {model_id: ModelEntry(model_id, model_id in pinned_model_ids) for model_id in model_ids}
+
+        # load(model_id, on_stage) returns (dependencies, memory_bytes), unload(dependencies) frees them
+        self.load_function = load
+        self.unload_function = unload
+
+        # Time the models are reported as created on /v1/models
+        self.created = int(time.time())
+
+        self.lock = threading.Lock()
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="palmapy-loader")
+
+    def get(self, model_id):
+        return self.entries.get(model_id)
+
+    # Hooks to keep hot models resident, a pinned model is never evicted
+    def pin(self, model_id):
+        self.entries[model_id].pinned = True
+
+    def unpin(self, model_id):
+        self.entries[model_id].pinned = False
+
+    # Load a model if it is not resident yet
+    # Returns the future of the load, on_stage only applies if this call starts the load
+    def load(self, model_id, on_stage=lambda stage: None):
+        entry = self.entries[model_id]
+        with self.lock:
+            return self.start_loading(entry, on_stage)
+
+    # Hold a resident model for a request, loading it first if needed
+    # Raises the load error if the model could not be loaded
+    async def acquire(self, model_id):
+        entry = self.entries[model_id]
+        while True:
+            with self.lock:
+                if entry.resident:
+                    entry.in_flight += 1
+                    return entry
+                future = self.start_loading(entry, lambda stage: None)
+
+            # The model could be evicted again before we take it, so lets check once more
+            await asyncio.wrap_future(future)
+
+    def release(self, entry):
+        with self.lock:
+            entry.in_flight -= 1
+            entry.last_used = time.monotonic()
+
+    # Must be called with the lock held
+    def start_loading(self, entry, on_stage):
+        if entry.loading is None:
+            entry.loading = self.loader.submit(self.run_load, entry, on_stage)
+        return entry.loading
+
+    # Runs on the loader thread
+    def run_load(self, entry, on_stage):
+        try:
+            if entry.resident:
+                return
+
+            # Lets make room for the model, using the size it had last time as the estimate
+            self.evict(entry, entry.memory_bytes)
+
+            started_at = time.monotonic()
+            (dependencies, memory_bytes) = self.load_function(entry.model_id, on_stage)
+            logger.info(f"Model {entry.model_id} is resident after {time.monotonic() - started_at:.1f}s")
+
+            with self.lock:
+                entry.dependencies = dependencies
+                entry.memory_bytes = memory_bytes
+                entry.last_used = time.monotonic()
+
+            self.evict(entry, 0)
+        finally:
+            with self.lock:
+                entry.loading = None
+
+    # Evict idle models until the resident ones and the extra bytes fit on the budget
+    # The keep model is never evicted, a budget of 0 is unlimited
+    def evict(self, keep, extra_bytes):
+        if self.memory_budget_bytes <= 0:
+            return
+
+        while True:
+            with self.lock:
+                resident = [entry for entry in self.entries.values() if entry.resident]
+                if sum(entry.memory_bytes for entry in resident) + extra_bytes <= self.memory_budget_bytes:
+                    return
+
+                candidates = [entry for entry in resident if entry is not keep and not entry.pinned and entry.idle()]
+                if not candidates:
+                    logger.warning("Resident models are over the memory budget, none of them can be evicted now")
+                    return
+
+                victim = min(candidates, key=lambda entry: entry.last_used)
+                dependencies = victim.dependencies
+                victim.dependencies = None
+
+            self.unload_function(dependencies)
+            logger.info(f"Model {victim.model_id} evicted, it was the least recently used")
+
+    # Dependencies of the resident models
+    def resident_dependencies(self):
+        return [entry.dependencies for entry in list(self.entries.values()) if entry.resident]
+
+    # State of every model, for /v1/models
+    def models(self):
+        return [
+            {
+                "id": entry.model_id,
+                "loaded": entry.resident,
+                "pinned": entry.pinned,
+                "memory_bytes": entry.memory_bytes if entry.resident else 0,
+                "in_flight": entry.in_flight,
+            }
+            for entry in self.entries.values()
+        ]
+
+    # Load of the resident models, reported by the readiness check
+    def stats(self):
+        dependencies = self.resident_dependencies()
+        return {
+            "models": [entry.model_id for entry in self.entries.values() if entry.resident],
+            "queue_depth": sum(item["admission"].queued for item in dependencies),
+            "active_generations": sum(len(item["engine"].requests) for item in dependencies),
+            "waiting_generations": sum(len(item["engine"].waiting) + item["engine"].pending.qsize() for item in dependencies),
+        }
@@ -0,0 +1,111 @@
+import torch
+from transformers import DynamicCache
+
+class PromptLookupProposer:
+    """
+    Draft free speculative proposals.
+    The last n-gram of the sequence is searched earlier in the prompt and the output,
+    and the tokens that followed it are proposed. It works well when the output copies the input,
+    like summarization and code editing.
+    """
+    def __init__(self, num_tokens, max_ngram):
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+
+        # Counters
+        self.proposed = 0
+        self.accepted = 0
+
+    # Returns up to num_tokens candidate tokens, or an empty list if there is no match
+    def propose(self, request, num_tokens):
+        sequence = torch.tensor(request.prompt_ids + request.output_ids)
+
+        for ngram_size in range(min(self.max_ngram, len(sequence) - 1), 0, -1):
+            ngram = sequence[-ngram_size:]
+
+            # Every earlier window that matches the ngram and has tokens after it, the most recent wins
+            windows = sequence[:-1].unfold(0, ngram_size, 1)
+            matches = (windows == ngram).all(dim=1).nonzero().flatten()
+            if len(matches) > 0:
+                start = int(matches[-1]) + ngram_size
+                candidates = sequence[start:start + num_tokens].tolist()
+                self.proposed += len(candidates)
+                return candidates
+        return []
+
+    # The proposals come from the sequence itself, so there is nothing else to update
+    def accept(self, request, accepted, emitted):
+        self.accepted += accepted
+
+    # Lets report the counters
+    def stats(self):
+        return speculative_stats(self)
+
+class DraftModelProposer:
+    """
+    Speculative proposals from a small draft model that shares the tokenizer of the main model.
+    The draft keeps its own key/value cache of the request it is proposing for.
+    """
+    def __init__(self, model, num_tokens):
+        self.model = model
+        self.num_tokens = num_tokens
+
+        # Draft cache, it covers the first length tokens of the request sequence
+        self.request = None
+        self.cache_layers = None
+        self.length = 0
+        self.proposed_from = 0
+
+        # Counters
+        self.proposed = 0
+        self.accepted = 0
+
+    # Returns num_tokens greedy tokens of the draft model
+    def propose(self, request, num_tokens):
+        if self.request is not request:
+            self.request = request
+            self.cache_layers = None
+            self.length = 0
+
+        sequence = request.prompt_ids + request.output_ids
+        input_ids = torch.tensor([sequence[self.length:]], device=self.model.device)
+
+        candidates = []
+        for _ in range(num_tokens):
+            outputs = self.model(
+                input_ids=input_ids,
+                past_key_values=DynamicCache.from_legacy_cache(self.cache_layers),
+                use_cache=True,
+            )
+            self.cache_layers = outputs.past_key_values.to_legacy_cache()
+            token = int(outputs.logits[0, -1].argmax())
+            candidates.append(token)
+            input_ids = torch.tensor([[token]], device=self.model.device)
+
+        # The last candidate was never fed to the draft model
+        self.proposed += num_tokens
+        self.proposed_from = len(sequence)
+        self.length = len(sequence) + num_tokens - 1
+        return candidates
+
+    # Drop the draft cache of the candidates that were rejected
+    def accept(self, request, accepted, emitted):
+        self.accepted += accepted
+        if self.request is not request:
+            return
+        self.length = min(self.length, self.proposed_from + min(accepted, emitted))
+        self.cache_layers = tuple(
+            (key[:, :, :self.length], value[:, :, :self.length])
+            for key, value in self.cache_layers
+        )
+
+    # Lets report the counters
+    def stats(self):
+        return speculative_stats(self)
+
+def speculative_stats(proposer):
+    return {
+        "proposed": proposer.proposed,
+        "accepted": proposer.accepted,
+        "acceptance_rate": proposer.accepted / proposer.proposed if proposer.proposed else 0.0,
+    }
@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Stages of the model loading, in order, used to report the progress
+LOAD_STAGES = ("importing", "tokenizer", "weights", "engine", "warm_up")
+
+class ModelStartup:
+    """
+    Loads the model dependencies on a background thread, so the server binds its port right away.
+    The routes ask it if the model is ready, the healthchecks report its stage and progress while it loads.
+    """
+    def __init__(self):
+        self.status = "starting"
+        self.stage = None
+        self.error = None
+        self.started_at = time.monotonic()
+        self.ready_at = None
+
+        # Dependencies returned by model_load.init, only set once the model is ready
+        self.dependencies = None
+        self.thread = threading.Thread(target=self.run, name="palmapy-startup", daemon=True)
+
+    @property
+    def ready(self):
+        return self.dependencies is not None
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        self.status = "loading"
+        try:
+            # Lets import the model stack here, torch and transformers take seconds to import
+            self.set_stage("importing")
+            import src.ai.model_load as model_load
+
+            dependencies = model_load.init(self.set_stage)
+        except Exception as e:
+            logger.exception(f"Error loading the model: {e}")
+            self.error = str(e)
+            self.status = "failed"
+            return
+
+        self.ready_at = time.monotonic()
+        self.status = "ready"
+        self.stage = None
+        self.dependencies = dependencies
+        logger.info(f"Model is ready after {self.ready_at - self.started_at:.1f}s")
+
+    def set_stage(self, stage):
+        self.stage = stage
+        logger.info(f"Model startup stage: {stage}")
+
+    # Fraction of the stages that are done
+    def progress(self):
+        if self.ready:
+            return 1.0
+        if self.stage is None:
+            return 0.0
+        return LOAD_STAGES.index(self.stage) / len(LOAD_STAGES)
+
+    # Load state reported by the healthchecks
+    def stats(self):
+        stats = {
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress(), 2),
+            "elapsed_seconds": round((self.ready_at or time.monotonic()) - self.started_at, 1),
+        }
+        if self.error is not None:
+            stats["error"] = self.error
+
+        # Once the model is ready, lets report the load of the resident models instead
+        if self.ready:
+            stats.update(self.dependencies["registry"].stats())
+        return stats
@@ -0,0 +1,171 @@
+import time
+import logging
+import torch
+import torch.nn.functional as F
+from transformers import StaticCache
+from transformers.cache_utils import Cache
+
+logger = logging.getLogger()
+
+# Decode steps timed for each bucket on the warm-up
+WARM_UP_STEPS = 5
+
+class BucketStaticCache(StaticCache):
+    """
+    StaticCache over a view of the preallocated key/value buffers, for one batch size and cache length bucket.
+    It is a StaticCache so the model builds the attention mask for the whole bucket, without data dependent checks.
+    """
+    def __init__(self, key_cache, value_cache):
+        # The buffers are allocated by the decoder, so StaticCache.__init__ is skipped on purpose
+        Cache.__init__(self)
+        self.key_cache = key_cache
+        self.value_cache = value_cache
+        self.max_batch_size = key_cache[0].shape[0]
+        self.max_cache_len = key_cache[0].shape[2]
+        self.dtype = key_cache[0].dtype
+        self.device = key_cache[0].device
+
+class StaticDecoder:
+    """
+    Decode step of the generation engine on a preallocated key/value cache, compiled with `torch.compile`.
+    The batch and the cache length are rounded up to buckets, so every step of a bucket runs the same compiled graph.
+    The batch cache is only copied into the buffers when the batch changes, decode steps write their token in place.
+    """
+    def __init__(self, model, max_batch_size, cache_lengths, compile=True):
+        self.model = model
+        self.device = model.device
+        self.cache_lengths = sorted(cache_lengths)
+        self.batch_sizes = batch_buckets(max_batch_size)
+
+        # One buffer per layer, sized for the biggest batch and the longest bucket
+        config = model.config
+        num_attention_heads = config.num_attention_heads
+        num_key_value_heads = getattr(config, "num_key_value_heads", None) or num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_attention_heads
+        shape = (self.batch_sizes[-1], num_key_value_heads, self.cache_lengths[-1], head_dim)
+        self.key_buffers = [torch.zeros(shape, dtype=model.dtype, device=self.device) for _ in range(config.num_hidden_layers)]
+        self.value_buffers = [torch.zeros(shape, dtype=model.dtype, device=self.device) for _ in range(config.num_hidden_layers)]
+        for buffer in self.key_buffers + self.value_buffers:
+            torch._dynamo.mark_static_address(buffer)
+
+        # The cache objects are created once, so the compiled graphs always see the same inputs
+        self.caches = {
+            (batch_size, cache_length): BucketStaticCache(
+                [buffer[:batch_size, :, :cache_length] for buffer in self.key_buffers],
+                [buffer[:batch_size, :, :cache_length] for buffer in self.value_buffers],
+            )
+            for batch_size in self.batch_sizes
+            for cache_length in self.cache_lengths
+        }
+
+        # Cache layers of the engine that are views of the buffers, anything else has to be copied in first
+        self.loaded_layers = None
+
+        # Every bucket is a graph, they must all fit on the dynamo cache or the last ones would run eager
+        # The limit counts the graphs of a code object, and the forward of every model is the same transformers
+        # wrapper, so the graphs of this decoder are added on top of what the other models and the default already use
+        self.forward = model.forward
+        if compile:
+            graphs = len(self.caches)
+            torch._dynamo.config.cache_size_limit += graphs
+            torch._dynamo.config.accumulated_cache_size_limit += graphs
+            self.forward = torch.compile(model.forward, dynamic=False)
+        self.compile = compile
+
+        size = 2 * sum(buffer.nelement() * buffer.element_size() for buffer in self.key_buffers)
+        logger.info(f"Static key/value cache of {size / (1024 * 1024):.1f} MB for {len(self.caches)} buckets, compile: {compile}")
+
+    # Returns True if a batch of batch_size rows with cache_length cached tokens has a bucket
+    def fits(self, batch_size, cache_length):
+        return batch_size <= self.batch_sizes[-1] and cache_length < self.cache_lengths[-1]
+
+    # One decode step, the same as the model forward with a DynamicCache
+    # Returns the logits of the last position and the new cache layers, which are views of the buffers
+    def decode(self, input_ids, attention_mask, position_ids, cache_layers):
+        (batch_size, cache_length) = (input_ids.shape[0], cache_layers[0][0].shape[2])
+        bucket_batch_size = next(size for size in self.batch_sizes if size >= batch_size)
+        bucket_cache_length = next(length for length in self.cache_lengths if length > cache_length)
+
+        if cache_layers is not self.loaded_layers:
+            for (key, value), key_buffer, value_buffer in zip(cache_layers, self.key_buffers, self.value_buffers):
+                key_buffer[:batch_size, :, :cache_length].copy_(key)
+                value_buffer[:batch_size, :, :cache_length].copy_(value)
+
+        # Padding rows only see their own token, their logits are dropped
+        padding = bucket_batch_size - batch_size
+        attention_mask = F.pad(attention_mask, (0, bucket_cache_length - attention_mask.shape[1]), value=0)
+        if padding > 0:
+            padding_mask = torch.zeros((padding, bucket_cache_length), dtype=attention_mask.dtype, device=self.device)
+            padding_mask[:, cache_length] = 1
+            attention_mask = torch.cat([attention_mask, padding_mask], dim=0)
+            input_ids = F.pad(input_ids, (0, 0, 0, padding), value=0)
+            position_ids = F.pad(position_ids, (0, 0, 0, padding), value=0)
+
+        outputs = self.forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.caches[(bucket_batch_size, bucket_cache_length)],
+            cache_position=torch.tensor([cache_length], device=self.device),
+            use_cache=True,
+        )
+
+        self.loaded_layers = tuple(
+            (key_buffer[:batch_size, :, :cache_length + 1], value_buffer[:batch_size, :, :cache_length + 1])
+            for key_buffer, value_buffer in zip(self.key_buffers, self.value_buffers)
+        )
+        return (outputs.logits[:batch_size, -1, :], self.loaded_layers)
+
+    # Compile every bucket before the server takes traffic, and measure the compiled step against the eager one
+    # A bucket that goes over the dynamo cache limit fails the warm-up instead of silently running eager
+    def warm_up(self):
+        if self.compile:
+            with torch._dynamo.config.patch(fail_on_cache_limit_hit=True):
+                self.warm_up_buckets()
+        else:
+            self.warm_up_buckets()
+
+    def warm_up_buckets(self):
+        started_at = time.monotonic()
+        for (batch_size, cache_length), cache in self.caches.items():
+            inputs = {
+                "input_ids": torch.zeros((batch_size, 1), dtype=torch.long, device=self.device),
+                "attention_mask": torch.ones((batch_size, cache_length), dtype=torch.long, device=self.device),
+                "position_ids": torch.full((batch_size, 1), cache_length - 1, dtype=torch.long, device=self.device),
+                "past_key_values": cache,
+                "cache_position": torch.tensor([cache_length - 1], device=self.device),
+                "use_cache": True,
+            }
+
+            compile_started_at = time.monotonic()
+            self.forward(**inputs)
+            compile_seconds = time.monotonic() - compile_started_at
+
+            compiled_seconds = time_steps(self.forward, inputs)
+            eager_seconds = time_steps(self.model.forward, inputs)
+            logger.info(
+                f"Decode step for batch {batch_size} and {cache_length} tokens ready in {compile_seconds:.1f}s, "
+                f"{compiled_seconds * 1000:.2f} ms per step against {eager_seconds * 1000:.2f} ms eager "
+                f"({eager_seconds / compiled_seconds:.2f}x)"
+            )
+
+        # The warm-up wrote into the buffers, nothing on them belongs to the engine
+        self.loaded_layers = None
+        logger.info(f"Static decode warm-up done in {time.monotonic() - started_at:.1f}s")
+
+# Mean seconds of a decode step
+def time_steps(forward, inputs):
+    started_at = time.monotonic()
+    for _ in range(WARM_UP_STEPS):
+        forward(**inputs)
+    return (time.monotonic() - started_at) / WARM_UP_STEPS
+
+# Powers of two up to the max batch size, plus the max batch size itself
+def batch_buckets(max_batch_size):
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max_batch_size)
+    return sizes
@@ -0,0 +1,132 @@
+import torch
+from transformers import StoppingCriteria
+from src.ai.model_detokenizer import IncrementalDetokenizer
+
+# Max number of stop sequences of a request, same as OpenAI
+MAX_STOP_SEQUENCES = 4
+
+# Reasons a generation ends, as sent on finish_reason
+FINISH_REASON_STOP = "stop"
+FINISH_REASON_LENGTH = "length"
+
+class StopSequenceMatcher:
+    """
+    Finds the stop sequences of one generation in its text as the tokens arrive.
+    The tokens are decoded incrementally and only the new text is scanned, together with the last characters
+    before it so a stop sequence split over several tokens is still found. The cost per token does not grow with the output.
+    The decode arguments must be the ones of the text that is cut, so the generation stops where that text has the stop sequence.
+    """
+    def __init__(self, tokenizer, stop, **decode_kwargs):
+        self.stop = stop
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
+
+        # A stop sequence can start up to overlap characters before the new text
+        self.overlap = max(len(sequence) for sequence in stop) - 1
+        self.tail = ""
+        self.matched = False
+
+    # Add the new tokens of the sequence
+    # Returns True once the text has a stop sequence
+    def add(self, token_ids):
+        if self.matched:
+            return True
+        text = self.detokenizer.add(token_ids)
+        if not text:
+            return False
+
+        window = self.tail + text
+        self.matched = any(sequence in window for sequence in self.stop)
+        self.tail = window[-self.overlap:] if self.overlap > 0 else ""
+        return self.matched
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    StoppingCriteria for model.generate, every row of the batch has its own stop sequences.
+    Each call only reads the tokens generated since the previous one.
+    """
+    def __init__(self, tokenizer, stops, prompt_length):
+        # The batch rows are decoded without the special tokens
+        self.matchers = [StopSequenceMatcher(tokenizer, stop, skip_special_tokens=True) if stop else None for stop in stops]
+        self.prompt_length = prompt_length
+        self.length = prompt_length
+
+        # Generated tokens of every row when its stop sequence was found
+        self.stopped_at = [None] * len(stops)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        new_tokens = input_ids[:, self.length:].tolist()
+        self.length = input_ids.shape[1]
+        done = []
+        for (row, (matcher, tokens)) in enumerate(zip(self.matchers, new_tokens)):
+            matched = matcher is not None and matcher.add(tokens)
+            if matched and self.stopped_at[row] is None:
+                self.stopped_at[row] = self.length - self.prompt_length
+            done.append(matched)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class StopSequenceFilter:
+    """
+    Cuts the streamed text at the first stop sequence, the stop sequence itself is never sent.
+    The end of the text that could be the start of a stop sequence is held back until the next text tells if it is one.
+    """
+    def __init__(self, stop):
+        self.stop = stop
+        self.pending = ""
+        self.matched = False
+
+    # Returns the text that can be sent, it can be empty
+    def add(self, text):
+        if self.matched or not text:
+            return ""
+        self.pending += text
+
+        index = find_stop(self.pending, self.stop)
+        if index >= 0:
+            self.matched = True
+            (text, self.pending) = (self.pending[:index], "")
+            return text
+
+        cut = len(self.pending) - partial_stop_length(self.pending, self.stop)
+        (text, self.pending) = (self.pending[:cut], self.pending[cut:])
+        return text
+
+    # The generation is done, the held back text was not a stop sequence
+    def flush(self):
+        (text, self.pending) = (self.pending, "")
+        return text
+
+# Stop sequences of a request, OpenAI takes a string or a list of strings
+# Empty strings are ignored, returns an empty list if there are none
+def get_stop_sequences(value):
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    return [sequence for sequence in value if isinstance(sequence, str) and sequence][:MAX_STOP_SEQUENCES]
+
+# Index of the first stop sequence in the text, or -1
+def find_stop(text, stop):
+    indexes = [index for index in (text.find(sequence) for sequence in stop) if index >= 0]
+    return min(indexes) if indexes else -1
+
+# Length of the longest end of the text that is the start of a stop sequence
+def partial_stop_length(text, stop):
+    for length in range(min(len(text), max(len(sequence) for sequence in stop) - 1), 0, -1):
+        suffix = text[-length:]
+        if any(sequence.startswith(suffix) for sequence in stop):
+            return length
+    return 0
+
+# Text of a whole generation cut at its first stop sequence
+# Returns (text, finish_reason)
+def truncate_at_stop(text, stop, token_ids, eos_token_id):
+    index = find_stop(text, stop) if stop else -1
+    if index >= 0:
+        return (text[:index], FINISH_REASON_STOP)
+    return (text, finish_reason(token_ids, eos_token_id))
+
+# A generation that ends without a stop sequence stopped on an end of sequence token or ran out of max_tokens
+def finish_reason(token_ids, eos_token_id):
+    if token_ids and token_ids[-1] in eos_token_id:
+        return FINISH_REASON_STOP
+    return FINISH_REASON_LENGTH
@@ -1,114 +1,323 @@
-import json
 import time
 import asyncio
+import threading
 from typing import Optional
 import src.ai.model_utils as model_utils
-from transformers import AutoTokenizer, TextStreamer
+import src.restapi.json as json_codec
+import src.restapi.response_builder as response_builder
+from src.ai.model_engine import GenerationRequest, DeadlineExceededError, RequestCancelledError
+from src.ai.model_detokenizer import IncrementalDetokenizer, sequence_token_ids
+from src.ai.model_stop import StopSequenceMatcher, StopSequenceFilter, finish_reason, FINISH_REASON_STOP
+from transformers import AutoTokenizer
+from src.ai.model_completion_cache import CompletionBroadcast
+import src.ai.model_gpu as model_gpu
 from config import (
-    model_gpu,
-    MODEL_ID
+    STREAM_COALESCE_MS,
+    STREAM_COALESCE_BYTES
 )
 
-class AsyncTextIteratorStreamer(TextStreamer):
+# Placeholder used to build the streaming chunk template
+CHUNK_CONTENT_MARKER = "__palmapy_chunk_content__"
+
+class StreamEnd:
+    """Last item of a choice, with the reason its generation stopped."""
+    def __init__(self, index, finish_reason):
+        self.index = index
+        self.finish_reason = finish_reason
+
+class AsyncTextIteratorStreamer:
     """
     Streamer that stores print-ready text in an asyncio queue, to be used by a downstream application as an iterator.
     This is useful for applications that benefit from accessing the generated text in a non-blocking way.
+    The tokens are decoded incrementally, the text is the same TextStreamer sends but each token only decodes a small window.
+    Text fragments that arrive within coalesce_window seconds of the last send are joined, up to coalesce_bytes, so the event loop
+    is woken up once per group of tokens instead of once per token. The first text is sent right away,
+    and text that is held back is sent by a timer when the window ends, so it never waits for the next token.
+    With stop sequences the text ends before the first one, and text that could be the start of one is held back.
+    The choices of a request share the queue, every text is sent as (index, text) with the index of its choice.
     """
-    # skip_prompt True its used, to only return the data generated and not the full prompt
+    # The generation engine never sends the prompt, so there is no skip_prompt
     def __init__(
-        self, tokenizer: "AutoTokenizer", queue, skip_prompt: bool = False, timeout: Optional[float] = None, **decode_kwargs
+        self, tokenizer: "AutoTokenizer", queue, eos_token_id=(), index: int = 0, timeout: Optional[float] = None,
+        coalesce_window: float = 0.0, coalesce_bytes: int = 0, **decode_kwargs
     ):
-        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.decode_kwargs = decode_kwargs
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
         self.async_queue = queue
-        self.stop_signal = None
+        self.index = index
         self.timeout = timeout
         self.loop = asyncio.get_event_loop()
 
-    def on_finalized_text(self, text: str, stream_end: bool = False):
-        """Put the new text in the asyncio queue. If the stream is ending, also put a stop signal in the queue."""
-        self.loop.call_soon_threadsafe(self.async_queue.put_nowait, text)
-        if stream_end:
-            self.loop.call_soon_threadsafe(self.async_queue.put_nowait, self.stop_signal)
+        # The finish reason depends on the last token and on the stop sequences
+        self.eos_token_id = set(eos_token_id)
+        self.last_token_ids = []
+        self.stop_filter = None
+
+        # Coalescing buffer
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_flush = 0.0
+
+        # The timer flushes the buffer on the event loop, the tokens arrive on the engine thread
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+
+    def set_stop_sequences(self, stop):
+        """The text is cut at the first of these stop sequences."""
+        self.stop_filter = StopSequenceFilter(stop) if stop else None
+
+    def put(self, value):
+        """Decode the new tokens, value holds one or more tokens of a single sequence, as a tensor or a list."""
+        self.last_token_ids = sequence_token_ids(value)
+        text = self.detokenizer.add(self.last_token_ids)
+        if self.stop_filter is not None:
+            text = self.stop_filter.add(text)
+        self.on_finalized_text(text)
+
+    def end(self):
+        """Send the rest of the text and the stop signal."""
+        text = self.detokenizer.flush()
+        if self.stop_filter is None:
+            reason = finish_reason(self.last_token_ids, self.eos_token_id)
+        else:
+            text = self.stop_filter.add(text) + self.stop_filter.flush()
+            reason = FINISH_REASON_STOP if self.stop_filter.matched else finish_reason(self.last_token_ids, self.eos_token_id)
+        self.on_finalized_text(text, StreamEnd(self.index, reason))
+
+    def on_finalized_text(self, text: str, stream_end: Optional[StreamEnd] = None):
+        """Put the new text in the asyncio queue. If the stream is ending, also put the stream end in the queue."""
+        items = []
+        delay = None
+        with self.lock:
+            if text:
+                self.buffer.append(text)
+                self.buffer_bytes += len(text.encode("utf-8"))
+
+            # The window runs from the last send, the text that is held back gets a timer for the end of the window
+            now = time.monotonic()
+            if self.buffer and (
+                stream_end is not None
+                or self.buffer_bytes >= self.coalesce_bytes
+                or now - self.last_flush >= self.coalesce_window
+            ):
+                items.append(self.take_buffer(now))
+            elif self.buffer and not self.flush_scheduled:
+                self.flush_scheduled = True
+                delay = self.coalesce_window - (now - self.last_flush)
+            if stream_end is not None:
+                items.append(stream_end)
+
+        # A single event loop wake up for everything we are sending
+        if items:
+            self.loop.call_soon_threadsafe(self.put_items, items)
+        if delay is not None:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.flush)
+
+    def flush(self):
+        """Runs on the event loop when the window ends, send the text that was held back."""
+        with self.lock:
+            self.flush_scheduled = False
+            if not self.buffer:
+                return
+            items = [self.take_buffer(time.monotonic())]
+        self.put_items(items)
+
+    def take_buffer(self, now):
+        """Empty the buffer, the lock must be held. Returns the item with its text."""
+        item = (self.index, "".join(self.buffer))
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_flush = now
+        return item
+
+    def fail(self, exception):
+        """The generation failed, send the text we have and then the exception."""
+        with self.lock:
+            items = [self.take_buffer(time.monotonic())] if self.buffer else []
+        items.append(exception)
+        self.loop.call_soon_threadsafe(self.put_items, items)
+
+    def put_items(self, items):
+        """Runs on the event loop, put the items in the asyncio queue."""
+        for item in items:
+            self.async_queue.put_nowait(item)
 
     def __iter__(self):
         return self
 
     def __next__(self):
         value = self.async_queue.get(timeout=self.timeout)
-        if value == self.stop_signal:
+        if isinstance(value, StreamEnd):
             raise StopIteration()
         else:
             return value
         
-# Run the streaming_wrapper coroutine in the executor
-async def start_streaming(response_queue, json_data, tokenizer, model, terminators, shared_executor):
-    loop = asyncio.get_event_loop()
-    streamer = AsyncTextIteratorStreamer(tokenizer, response_queue, True)
-    await loop.run_in_executor(
-            shared_executor, 
-            lambda: asyncio.run(
-                streaming_wrapper(streamer, json_data, tokenizer, model, terminators)
-            )
+# Prepare the request on the shared executor and send it to the generation engine
+# Every choice has its own streamer, they all write to the response queue
+async def start_streaming(response_queue, json_data, model_id, tokenizer, template_cache, engine, terminators, shared_executor, completion_cache, ticket, cancellation, metrics, n=1):
+    loop = asyncio.get_running_loop()
+
+    # The generation engine never sends the prompt to the streamer
+    # The special tokens are skipped, like on the non streaming responses
+    streamers = [
+        AsyncTextIteratorStreamer(
+            tokenizer,
+            response_queue,
+            eos_token_id=terminators,
+            index=index,
+            coalesce_window=STREAM_COALESCE_MS / 1000,
+            coalesce_bytes=STREAM_COALESCE_BYTES,
+            skip_special_tokens=True
         )
-        
-# Define an asynchronous wrapper function for model streaming
-async def streaming_wrapper(streamer, json_data, tokenizer, model, terminators):
-    streaming(streamer, json_data, tokenizer, model, terminators)
-    
-    # Signal the end of streaming by calling the end method on the streamer
-    streamer.end()
-        
+        for index in range(n)
+    ]
+    try:
+        await loop.run_in_executor(
+                shared_executor, 
+                metrics.track_executor,
+                streaming, streamers, json_data, model_id, tokenizer, template_cache, engine, terminators, completion_cache, ticket, cancellation
+            )
+    except Exception:
+        # The request never reached the generation engine
+        ticket.leave()
+        raise
+
 # Function for streaming inference
-def streaming(streamer, json_data, tokenizer, model, terminators):
+# Every streamer is a choice of the same prompt
+def streaming(streamers, json_data, model_id, tokenizer, template_cache, engine, terminators, completion_cache, ticket, cancellation):
+
+    if ticket.trace is not None:
+        ticket.trace.lap("executor_wait")
+
+    # If the request expired or the client left while waiting for a worker, lets drop it before doing any work
+    if ticket.is_expired():
+        raise DeadlineExceededError()
+    if cancellation.cancelled:
+        raise RequestCancelledError()
 
     # Lets sanitize the parameters
-    (messages, max_tokens, do_sample, temperature, top_p) = model_utils.get_safe_parameters(json_data)
-
-    # Lets proccess the messages template
-    input_ids = tokenizer.apply_chat_template(
-        messages,
-        add_generation_prompt=True,
-        return_tensors="pt"
-    ).to(model_gpu.device)
-
-    # Manually set the pad_token_id if it's None
-    # Assuming EOS token can be used as padding
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id  
-
-    # Attention mask
-    attention_mask = (input_ids != tokenizer.pad_token_id).long()
-
-    # Perform streaming inference
-    model.generate(
-        input_ids,
-        attention_mask=attention_mask,
-        streamer=streamer,
-        max_new_tokens=max_tokens,
-        eos_token_id=terminators,
-        pad_token_id=tokenizer.pad_token_id,
-        do_sample=do_sample,
-        temperature=temperature,
-        top_p=top_p,
-    )
+    (messages, max_tokens, do_sample, temperature, top_p, stop) = model_utils.get_safe_parameters(json_data)
+
+    choices = []
+    for streamer in streamers:
+        # The engine looks for the stop sequences as it generates, so it stops right after the first one
+        # The streamer holds back the text that could be the start of one, the engine decodes the same way the streamer does
+        streamer.set_stop_sequences(stop)
+        stop_sequences = StopSequenceMatcher(tokenizer, stop, **streamer.decode_kwargs) if stop else None
+        choice_cancellation = cancellation
+
+        # Deterministic requests can be served from the completion cache
+        # or attached to an identical generation that is already running, the greedy choices share a single one
+        if completion_cache is not None and completion_cache.is_deterministic(do_sample, temperature):
+            key = completion_cache.get_key(model_id, messages, max_tokens, stop)
+            streamer = completion_cache.subscribe(key, streamer, terminators, max_tokens, cancellation, stop_sequences)
+            if streamer is None:
+                continue
+
+            # The shared generation is only cancelled when all its clients are gone
+            choice_cancellation = streamer.cancellation
+        choices.append((streamer, choice_cancellation, stop_sequences))
+
+    if not choices:
+        ticket.leave()
+        return
+
+    try:
+        # Lets proccess the messages template
+        # The template cache only tokenizes the pieces of the conversation it has not seen yet
+        input_ids = template_cache.encode(messages).to(model_gpu.device)
+        if ticket.trace is not None:
+            ticket.trace.lap("chat_template")
+
+        # Schedule the streaming inference on the generation engine, the choices share the prefill of the prompt
+        # The engine calls the end method on every streamer once its generation is done
+        engine.submit_group([
+            GenerationRequest(
+                input_ids,
+                streamer,
+                max_new_tokens=max_tokens,
+                eos_token_id=terminators,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                ticket=ticket,
+                cancellation=choice_cancellation,
+                stream=True,
+                stop_sequences=stop_sequences,
+            )
+            for (streamer, choice_cancellation, stop_sequences) in choices
+        ])
+    except Exception as e:
+        # Identical requests are waiting on the shared generations this request started, lets fail them too
+        # Otherwise they stay in flight and every later identical request hangs on them
+        for (streamer, _, _) in choices:
+            if isinstance(streamer, CompletionBroadcast):
+                streamer.fail(e)
+        raise
+
+# Pre-serialize a streaming chunk, only the delta content changes between the chunks of a choice
+# Returns the (prefix, suffix) bytes that go around the json encoded content
+def chunk_template(created, model_id, index=0):
+    chunk = json_codec.dumps({"object":"chat.completion.chunk","created":created,"model":model_id,"choices":[{"index":index,"delta":{"content":CHUNK_CONTENT_MARKER},"finish_reason":None}]})
+    (prefix, suffix) = chunk.rsplit(json_codec.dumps(CHUNK_CONTENT_MARKER), 1)
+    return (b"data: " + prefix, suffix + b"\n\n")
 
 # Catch the token that are being streamed
 # https://platform.openai.com/docs/api-reference/chat/create
-async def catch_token(response_queue):
-    while True:
-        # Catch the token that are being generated
-        outputs = await response_queue.get()
-
-        # Get the current Unix timestamp
-        current_timestamp = int(time.time())
-
-        # If no more tokens, lets end streaming
-        if outputs is None:
-            json_response = json.dumps({"object":"chat.completion.chunk","created":current_timestamp,"model":MODEL_ID,"choices":[{"index":0,"delta":{},"finish_reason":"stop"}]})
-            yield f"data: {json_response}\n\n"
-            yield f"data: [DONE]"
-            break
-
-        # Stream data
-        json_response = json.dumps({"object":"chat.completion.chunk","created":current_timestamp,"model":MODEL_ID,"choices":[{"index":0,"delta":{"content":outputs},"finish_reason":None}]})
-        yield f"data: {json_response}\n\n"
\ No newline at end of file
+# If the client disconnects the response stops reading from here, so we cancel the generation
+# With n choices their chunks are interleaved, each one has the index of its choice, and [DONE] comes after the last one ends
+# A traced request ends with a server-timing event, before [DONE]
+async def catch_token(response_queue, model_id, metrics, cancellation, trace=None, tracer=None, n=1):
+    # All the chunks of a request share the same created timestamp
+    current_timestamp = int(time.time())
+    templates = [chunk_template(current_timestamp, model_id, index) for index in range(n)]
+    remaining = n
+
+    try:
+        while True:
+            # Catch the token that are being generated
+            outputs = await response_queue.get()
+
+            # If the generation failed, lets send the error and end streaming
+            if isinstance(outputs, Exception):
+                error_code = getattr(outputs, "error_code", "internal_error")
+                metrics.errors.labels("true", error_code).inc()
+                (json_error, _) = response_builder.set_error_response(error_code, "")
+                yield b"data: " + json_error + b"\n\ndata: [DONE]"
+                if tracer is not None:
+                    tracer.finish(trace, model=model_id, stream=True, error=error_code)
+                break
+
+            # If no more tokens for this choice, lets send its finish reason, once every choice is done lets end streaming
+            if isinstance(outputs, StreamEnd):
+                json_response = json_codec.dumps({"object":"chat.completion.chunk","created":current_timestamp,"model":model_id,"choices":[{"index":outputs.index,"delta":{},"finish_reason":outputs.finish_reason}]})
+                remaining -= 1
+                if remaining > 0:
+                    yield b"data: " + json_response + b"\n\n"
+                    continue
+
+                if trace is None:
+                    yield b"data: " + json_response + b"\n\ndata: [DONE]"
+                    break
+
+                trace.lap("stream")
+                timing = b"event: server-timing\ndata: " + json_codec.dumps(trace.to_json()) + b"\n\n" if trace.exposed else b""
+                yield b"data: " + json_response + b"\n\n" + timing + b"data: [DONE]"
+                tracer.finish(trace, model=model_id, stream=True)
+                break
+
+            # Stream data, we only have to escape the new content
+            (index, text) = outputs
+            (chunk_prefix, chunk_suffix) = templates[index]
+            if trace is None:
+                yield chunk_prefix + json_codec.dumps(text) + chunk_suffix
+            else:
+                started_at = time.perf_counter()
+                chunk = chunk_prefix + json_codec.dumps(text) + chunk_suffix
+                trace.add("serialize", time.perf_counter() - started_at)
+                yield chunk
+    finally:
+        # Once the generation is done this does nothing
+        cancellation.cancel()
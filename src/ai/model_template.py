@@ -0,0 +1,125 @@
+import re
+import logging
+import threading
+import collections
+import torch
+
+logger = logging.getLogger()
+
+# Conversation used to check that the cached tokenization gives the same ids as the tokenizer
+SELF_CHECK_MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "Hello, how are you?"},
+    {"role": "assistant", "content": " I am fine.\n\nThanks!"},
+    {"role": "user", "content": "Write `print(1)` in Python."},
+]
+
+class ChatTemplateCache:
+    """
+    Memoized chat template tokenization.
+    The rendered prompt is split on the tokenizer added tokens (like <|eot_id|>), which is what the fast tokenizers do
+    before tokenizing each piece on its own, so we can cache the token ids of every piece in a LRU.
+    Repeated system prompts and previous turns of a conversation are only tokenized once.
+    """
+    def __init__(self, tokenizer, max_entries):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+        # Lets map every added token to its id
+        self.added_tokens = {token.content: token_id for token_id, token in tokenizer.added_tokens_decoder.items()}
+        self.pattern = re.compile(
+            "(" + "|".join(re.escape(content) for content in sorted(self.added_tokens, key=len, reverse=True)) + ")"
+        ) if self.added_tokens else None
+
+        self.enabled = max_entries > 0 and self.is_supported()
+        if max_entries > 0 and not self.enabled:
+            logger.info("Chat template cache is not supported by this tokenizer, using the uncached path")
+
+    # The cache is only safe when the added tokens split the text the same way the tokenizer does
+    def is_supported(self):
+        if not getattr(self.tokenizer, "is_fast", False) or self.pattern is None:
+            return False
+        for token in self.tokenizer.added_tokens_decoder.values():
+            if token.lstrip or token.rstrip or token.single_word or token.normalized:
+                return False
+
+        # Lets compare both paths on a sample conversation
+        try:
+            expected = self.tokenizer.apply_chat_template(SELF_CHECK_MESSAGES, add_generation_prompt=True)
+            return self.tokenize(self.render(SELF_CHECK_MESSAGES)) == expected
+        except Exception as e:
+            logger.info(f"Chat template cache self check failed: {e}")
+            return False
+
+    # Returns the input ids of the messages, same output as
+    # tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+    def encode(self, messages):
+        if not self.enabled:
+            return self.tokenizer.apply_chat_template(
+                messages,
+                add_generation_prompt=True,
+                return_tensors="pt"
+            )
+
+        return torch.tensor([self.tokenize(self.render(messages))], dtype=torch.long)
+
+    # Render the chat template into text
+    def render(self, messages):
+        return self.tokenizer.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=False
+        )
+
+    # Tokenize the text one piece at a time, using the cached ids when we have them
+    def tokenize(self, text):
+        pieces = [piece for piece in self.pattern.split(text) if piece]
+
+        # Lets find the pieces we have not tokenized yet
+        cached = {}
+        missing = []
+        with self.lock:
+            for piece in pieces:
+                if piece in self.added_tokens or piece in cached:
+                    continue
+                token_ids = self.entries.get(piece)
+                if token_ids is None:
+                    missing.append(piece)
+                    cached[piece] = None
+                else:
+                    self.entries.move_to_end(piece)
+                    cached[piece] = token_ids
+            self.hits += len(cached) - len(missing)
+            self.misses += len(missing)
+
+        # Tokenize all the missing pieces on a single batch call
+        if missing:
+            encoded = self.tokenizer(missing, add_special_tokens=False)["input_ids"]
+            with self.lock:
+                for piece, token_ids in zip(missing, encoded):
+                    cached[piece] = token_ids
+                    self.entries[piece] = token_ids
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        input_ids = []
+        for piece in pieces:
+            if piece in self.added_tokens:
+                input_ids.append(self.added_tokens[piece])
+            else:
+                input_ids.extend(cached[piece])
+        return input_ids
+
+    # Lets report the counters
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+        }
@@ -0,0 +1,172 @@
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+import collections
+import torch
+import src.restapi.json as json_codec
+
+logger = logging.getLogger()
+
+# Finished profiles kept for the admin endpoint
+MAX_PROFILE_SESSIONS = 100
+
+class RequestTrace:
+    """
+    Durations of the phases of one request, for the Server-Timing header and the trace log.
+    The phases follow each other from the event loop to the shared executor, the engine thread and back,
+    so each one lasts from the end of the previous one and only one thread writes at a time.
+    """
+    def __init__(self, sampled, exposed):
+        self.started_at = time.perf_counter()
+        self.last_at = self.started_at
+        self.spans = {}
+
+        # Written to the trace log, and sent to the client on the Server-Timing header
+        self.sampled = sampled
+        self.exposed = exposed
+
+    # End the current phase
+    def lap(self, name):
+        now = time.perf_counter()
+        self.add(name, now - self.last_at)
+        self.last_at = now
+
+    # Add time to a phase that does not follow the others, like serializing the chunks of a stream
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    # Server-Timing header value, the durations are in milliseconds
+    # The engine thread can add a phase meanwhile, so lets copy the spans first
+    def server_timing(self):
+        spans = [f"{name};dur={seconds * 1000:.2f}" for (name, seconds) in list(self.spans.items())]
+        spans.append(f"total;dur={(time.perf_counter() - self.started_at) * 1000:.2f}")
+        return ", ".join(spans)
+
+    def to_json(self):
+        return {
+            "total_ms": round((time.perf_counter() - self.started_at) * 1000, 3),
+            "spans": {name: round(seconds * 1000, 3) for (name, seconds) in list(self.spans.items())}
+        }
+
+class Tracer:
+    """
+    Starts the traces of the requests and writes the sampled ones to the trace log.
+    With tracing disabled and no trace log no trace is created, so the requests only check for None.
+    """
+    def __init__(self, enabled, log_path, sample_rate):
+        self.enabled = enabled
+        self.sample_rate = sample_rate if log_path else 0
+        self.log = open(log_path, "a", encoding="utf-8") if log_path else None
+        self.lock = threading.Lock()
+
+    # Returns the trace of a new request, or None if it is not traced
+    def start(self):
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not self.enabled and not sampled:
+            return None
+        return RequestTrace(sampled, self.enabled)
+
+    # Write a sampled trace once its request is done, with the fields that describe the request
+    def finish(self, trace, **fields):
+        if trace is None or not trace.sampled:
+            return
+        line = json_codec.dumps(dict(fields, time=time.time(), **trace.to_json()))
+        with self.lock:
+            self.log.write(line.decode("utf-8") + "\n")
+            self.log.flush()
+
+# Headers of a traced response
+def trace_headers(trace):
+    if trace is None or not trace.exposed:
+        return None
+    return {"Server-Timing": trace.server_timing()}
+
+class ProfileSession:
+    """
+    torch.profiler capture of the next requests of a generation engine, written as a Chrome trace.
+    It starts on the engine thread between two steps and stops once num_requests requests are done.
+    """
+    def __init__(self, session_id, model_id, num_requests, path):
+        self.id = session_id
+        self.model_id = model_id
+        self.num_requests = num_requests
+        self.remaining = num_requests
+        self.path = path
+        self.status = "pending"
+        self.error = None
+        self.created_at = int(time.time())
+        self.completed_at = None
+        self.profiler = None
+
+    def start(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.profiler.start()
+        self.status = "running"
+
+    # Called by the engine when a request is done
+    # Returns True once the capture is over
+    def request_done(self):
+        self.remaining -= 1
+        if self.remaining > 0:
+            return False
+        self.stop()
+        return True
+
+    def stop(self):
+        try:
+            self.profiler.stop()
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.profiler.export_chrome_trace(self.path)
+            self.status = "completed"
+        except Exception as e:
+            logger.exception(f"Error writing the profile {self.id}: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        self.profiler = None
+        self.completed_at = int(time.time())
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "object": "profile",
+            "model": self.model_id,
+            "status": self.status,
+            "requests": self.num_requests,
+            "remaining_requests": max(self.remaining, 0),
+            "output_file": self.path,
+            "error": self.error,
+            "created_at": self.created_at,
+            "completed_at": self.completed_at
+        }
+
+class ProfileManager:
+    """
+    Profiles started from the admin endpoint, the newest MAX_PROFILE_SESSIONS are kept.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.sessions = collections.OrderedDict()
+
+    # Start a profile on the engine of a model
+    # Returns the session and the future of its start, it fails if the engine is already profiling
+    def start(self, engine, model_id, num_requests):
+        session_id = f"profile_{uuid.uuid4().hex}"
+        session = ProfileSession(session_id, model_id, num_requests, os.path.join(self.output_dir, session_id + ".json"))
+        future = engine.start_profile(session)
+
+        self.sessions[session_id] = session
+        while len(self.sessions) > MAX_PROFILE_SESSIONS:
+            self.sessions.popitem(last=False)
+        return (session, future)
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def list(self):
+        return list(self.sessions.values())
@@ -1,9 +1,11 @@
 import src.utils.validators as validators
+from src.ai.model_stop import get_stop_sequences
 from config import (
     DEFAULT_DO_SAMPLE,
     DEFAULT_MAX_TOKENS,
     DEFAULT_TEMPERATURE,
-    DEFAULT_TOP_P
+    DEFAULT_TOP_P,
+    MAX_CHOICES
 )
 
 # Function for sanitazing the inference parameters
@@ -13,7 +15,8 @@ def get_safe_parameters(json_data):
     messages = json_data.get("messages", "")
 
     # If empty we establish default values
-    max_tokens = json_data.get("max_tokens", DEFAULT_MAX_TOKENS)
+    # The routes reject an invalid max_tokens before we get here
+    max_tokens = get_max_tokens(json_data) or DEFAULT_MAX_TOKENS
     temperature = json_data.get("temperature", DEFAULT_TEMPERATURE)
     top_p = json_data.get("top_p", DEFAULT_TOP_P)
 
@@ -21,13 +24,45 @@ def get_safe_parameters(json_data):
     # So we default to the .env configuration
     do_sample = DEFAULT_DO_SAMPLE
 
+    # Up to 4 stop sequences, the text ends right before the first one
+    stop = get_stop_sequences(json_data.get("stop"))
+
     # Lets sanitate values
-    if not validators.is_numeric(max_tokens):
-        max_tokens = DEFAULT_MAX_TOKENS
     if not validators.is_numeric(temperature):
         temperature = DEFAULT_TEMPERATURE
     if not validators.is_numeric(top_p):
         top_p = DEFAULT_TOP_P
 
     # Lets return the values
-    return (messages, max_tokens, do_sample, temperature, top_p)
\ No newline at end of file
+    return (messages, max_tokens, do_sample, temperature, top_p, stop)
+
+# Max number of tokens to generate, the OpenAI max_tokens parameter
+# Returns None if it is not a positive integer
+def get_max_tokens(json_data):
+    max_tokens = json_data.get("max_tokens")
+    if max_tokens is None:
+        return DEFAULT_MAX_TOKENS
+    if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens <= 0:
+        return None
+    return max_tokens
+
+# Number of choices of a request, the OpenAI n parameter
+# Returns None if it is not between 1 and MAX_CHOICES
+def get_choices(json_data):
+    n = json_data.get("n")
+    if n is None:
+        return 1
+    if not isinstance(n, int) or isinstance(n, bool) or not 0 < n <= MAX_CHOICES:
+        return None
+    return n
+
+# Complete an asyncio future, this must run on the future event loop
+# The request could be gone already, so we check it is still waiting
+def set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+# Fail an asyncio future, this must run on the future event loop
+def set_future_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
@@ -0,0 +1,93 @@
+import os
+import json
+import glob
+import struct
+import logging
+import torch
+from accelerate import init_empty_weights
+from huggingface_hub import snapshot_download
+from transformers import AutoConfig, AutoModelForCausalLM
+
+logger = logging.getLogger()
+
+# Safetensors dtypes we can map straight into torch tensors
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+# Load the model with its weights memory mapped from the safetensors files
+# The pages come from the OS page cache, so every process that loads the same files shares the same memory
+# Returns None if the checkpoint can not be mapped as it is (other dtype, no safetensors, not on CPU)
+def load_mmap_model(model_id, torch_dtype, device):
+    if torch.device(device).type != "cpu":
+        return None
+
+    # Lets find the checkpoint files, downloading them if needed
+    model_path = model_id
+    if not os.path.isdir(model_path):
+        model_path = snapshot_download(model_id, allow_patterns=["*.json", "*.safetensors"])
+    files = sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+    if not files:
+        return None
+
+    state_dict = {}
+    for path in files:
+        tensors = mmap_safetensors(path, torch_dtype)
+        if tensors is None:
+            logger.info(f"Weights of {path} are not stored as {torch_dtype}, they can not be memory mapped")
+            return None
+        state_dict.update(tensors)
+
+    # Parameters are created empty and then pointed to the mapped tensors
+    # Buffers (like the rotary embeddings) are still computed on the CPU
+    config = AutoConfig.from_pretrained(model_path)
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, parameter in model.named_parameters() if parameter.is_meta]
+    if missing:
+        logger.info(f"Checkpoint is missing the weights {missing[:3]}, they can not be memory mapped")
+        return None
+
+    model.eval()
+    logger.info(f"Model weights are memory mapped from {len(files)} safetensors files")
+    return model
+
+# Map every tensor of a safetensors file without copying it
+# Returns None if any floating point tensor is not stored as torch_dtype
+def mmap_safetensors(path, torch_dtype):
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+
+    # Private mapping, writes would be copy on write and never reach the file
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data_offset = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None or (dtype.is_floating_point and dtype != torch_dtype):
+            return None
+
+        (start, end) = info["data_offsets"]
+        element_size = torch.empty((), dtype=dtype).element_size()
+        if (data_offset + start) % element_size != 0:
+            return None
+
+        tensor = torch.empty((0,), dtype=dtype)
+        tensor.set_(storage, (data_offset + start) // element_size, info["shape"])
+        tensors[name] = tensor
+    return tensors
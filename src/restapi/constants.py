@@ -12,9 +12,19 @@ API_KEY_HTTP_HEADER_NAME = "Palmapy-Server-Api-Key"
 # ERRORS
 ERROR_API = "api_error"
 ERROR_INVALID_REQUEST = "invalid_request_error"
+ERROR_RATE_LIMIT = "rate_limit_error"
+
+# HTTP HEADERS NAMES
+HEADER_RETRY_AFTER = "Retry-After"
 
 # CONTENT TYPE
 HTTP_DEFAULT_CONTENT_TYPE = "application/json"
+HTTP_STREAMING_CONTENT_TYPE = "text/event-stream"
+HTTP_METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+HTTP_JSONL_CONTENT_TYPE = "application/jsonl"
+
+# Content types worth compressing, streaming responses are never compressed
+HTTP_COMPRESSIBLE_CONTENT_TYPES = (HTTP_DEFAULT_CONTENT_TYPE, "text/plain")
 
 # CORS HTTP HEADERS NAMES
 HEADER_DEFAULT_ACCESS_CONTROL_MAX_AGE = "Access-Control-Max-Age"
@@ -1,31 +1,59 @@
 import json
+import logging
 import src.utils.validators as validators
 import src.restapi.response_builder as response_builder
 
+logger = logging.getLogger()
+
+# Lets use orjson when it is installed, it encodes and decodes several times faster than the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Name of the JSON backend in use
+backend = "orjson" if orjson is not None else "json"
+
+# Encode a value as compact JSON
+# Returns bytes, so they go straight to the Response without another encoding
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value)
+else:
+    def dumps(value):
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+# Decode JSON from bytes or str
+# Invalid JSON raises a ValueError on both backends
+if orjson is not None:
+    loads = orjson.loads
+else:
+    loads = json.loads
+
 # Process JSON Requests
 # Check for valid messages and valid json body
 # returns (json_data, json_error, status_code)
 async def read_json_request(request):
     # Retrieve and parse the JSON body of the request asynchronously
     try:
-        json_data = await request.json()
-
-        # Lets validate the messages format and that is not empty
-        if not validators.is_valid_messages(json_data.get("messages", "")) or validators.is_empty(json_data.get("messages", "")):
-            # Json error
-            (json_error, status_code) = response_builder.set_error_response("invalid_request", "The request was unacceptable, the parameter `messages` structure is not valid or its empty.")
-
-            # Return an json error with status code 400
-            return ("", json_error, status_code)
-    except json.JSONDecodeError as e:
+        json_data = loads(await request.body())
+    except ValueError as e:
         # Json error
         (json_error, status_code) = response_builder.set_error_response("invalid_request", "The request was unacceptable, the json body is not valid.")
 
         # Debug
-        print(f"JSONDecodeError: {e}")
+        logger.debug(f"Invalid JSON body: {e}")
 
         # Return an json error with status code 400
         return ("", json_error, status_code)
-    
+
+    # Lets validate the messages format and that is not empty
+    if not isinstance(json_data, dict) or not validators.is_valid_messages(json_data.get("messages")):
+        # Json error
+        (json_error, status_code) = response_builder.set_error_response("invalid_request", "The request was unacceptable, the parameter `messages` structure is not valid or its empty.")
+
+        # Return an json error with status code 400
+        return ("", json_error, status_code)
+
     # If everything works, return the data
-    return (json_data, "", 200)
\ No newline at end of file
+    return (json_data, "", 200)
@@ -0,0 +1,154 @@
+import re
+import logging
+import itertools
+import contextlib
+import httpx
+from starlette.routing import Route
+from starlette.responses import Response, StreamingResponse
+from starlette.applications import Starlette
+import src.restapi.constants as constants
+import src.restapi.response_builder as response_builder
+
+logger = logging.getLogger()
+
+# Headers that only apply to a single connection, they are never forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+# Headers the router server adds on its own
+SERVER_HEADERS = {"date", "server"}
+
+# Batch ids carry the index of the replica that runs the job, like batch_r1_<hex>
+BATCH_PATH = re.compile(r"/batches/batch_r(\d+)_")
+
+class Replica:
+    """A server process with its own model replica."""
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+
+class ReplicaResponse(StreamingResponse):
+    """
+    Response streamed from a replica.
+    The replica is released when the response is done, also when the client disconnects halfway,
+    which is when the Starlette background tasks are skipped.
+    """
+    def __init__(self, upstream, replica, **kwargs):
+        super().__init__(upstream.aiter_raw(), **kwargs)
+        self.upstream = upstream
+        self.replica = replica
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.replica.in_flight -= 1
+            await self.upstream.aclose()
+
+class ReplicaRouter:
+    """
+    Front router of the model replicas.
+    Every request is proxied to the replica with the fewest requests in flight,
+    the response body (including SSE streams) is forwarded as it arrives.
+    Requests on a batch job go to the replica that runs it, the jobs only live in that replica.
+    """
+    def __init__(self, urls):
+        self.replicas = [Replica(url) for url in urls]
+        self.rotation = itertools.count()
+
+        # The replicas apply their own request deadlines, so the router does not time out reads
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(None, connect=5.0),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=64),
+        )
+
+    # Replicas sorted from the least loaded, ties are rotated so they get the same share
+    def candidates(self):
+        start = next(self.rotation) % len(self.replicas)
+        rotated = self.replicas[start:] + self.replicas[:start]
+        return sorted(rotated, key=lambda replica: replica.in_flight)
+
+    # Replicas a request can go to, only the owner of the batch for the routes of a batch job
+    def targets(self, path):
+        match = BATCH_PATH.search(path)
+        if match is None:
+            return self.candidates()
+        index = int(match.group(1))
+        return [self.replicas[index]] if index < len(self.replicas) else []
+
+    # Forward a request to a replica and stream back its response
+    async def proxy(self, request):
+        body = await request.body()
+        headers = [(name, value) for name, value in request.headers.raw if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS]
+
+        for replica in self.targets(request.url.path):
+            upstream_request = self.client.build_request(
+                request.method,
+                replica.url + request.url.path,
+                params=request.url.query,
+                headers=headers,
+                content=body,
+            )
+
+            replica.in_flight += 1
+            try:
+                upstream = await self.client.send(upstream_request, stream=True)
+            except httpx.TransportError as e:
+                # The replica is down, lets try the next one
+                replica.in_flight -= 1
+                logger.warning(f"Replica {replica.url} is not available: {e}")
+                continue
+
+            # The replica is still loading the model, lets try the next one
+            if upstream.status_code == 503:
+                replica.in_flight -= 1
+                await upstream.aclose()
+                continue
+
+            # Headers like Set-Cookie can come more than once, so they are kept as a list of pairs
+            # ASGI header names are lowercase
+            response_headers = []
+            for (name, value) in upstream.headers.raw:
+                name = name.lower()
+                header_name = name.decode("latin-1")
+                if (header_name not in HOP_BY_HOP_HEADERS or header_name == "content-length") and header_name not in SERVER_HEADERS:
+                    response_headers.append((name, value))
+            response = ReplicaResponse(
+                upstream,
+                replica,
+                status_code=upstream.status_code,
+            )
+            response.raw_headers = response_headers
+            return response
+
+        (json_error, status_code) = response_builder.set_error_response("service_unavailable", "")
+        return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+    async def close(self):
+        await self.client.aclose()
+
+# Create the Starlette application of the router
+def create_app(urls):
+    router = ReplicaRouter(urls)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await router.close()
+
+    return Starlette(
+        routes=[
+            Route("/{path:path}", router.proxy, methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]),
+        ],
+        lifespan=lifespan,
+    )
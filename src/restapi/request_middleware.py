@@ -1,66 +1,149 @@
+import zlib
 from starlette.responses import Response
 import src.restapi.constants as constants
 import src.restapi.response_builder as response_builder
-from starlette.requests import Request
-from starlette.exceptions import HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-
-# Lets create a custom exception for invalid Content-Type:
-class InvalidContentTypeException(HTTPException):
-    def __init__(self, detail: str):
-        super().__init__(status_code=415, detail=detail)
-
-# Lets check to see if the content type is the one we support 
-class ValidateContentTypeMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if request.method in ("POST", "PUT", "PATCH"):
-            # Note that we parse and normalize the header to remove
-		    # any additional parameters (like charset or boundary information) and normalize
-		    # it by stripping whitespace and converting to lowercase before we check the value.
-            content_type = request.headers.get("content-type")
-            content_type = content_type.split(";")[0].strip().lower()
-            if content_type != constants.HTTP_DEFAULT_CONTENT_TYPE:
-                # You should only raise HTTPException inside routing or endpoints. 
-                # Middleware classes should instead just return appropriate responses directly.
-                (json_error, status_code) = response_builder.set_error_response("request_unsupported_media", "")
-
-                # Return an json error with status code 415
-                return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
-        return await call_next(request)
-
-# Lets create a Middleware for the default content type header 
-# If there is no content type header we send the default response
-class DefaultContentTypeMiddleware:
-    def __init__(self, app, content_type=constants.HTTP_DEFAULT_CONTENT_TYPE):
-        self.app = app
-        self.content_type = content_type
-    
-    async def __call__(self, scope, receive, send):
-        async def send_wrapper(message):
-            if message['type'] == 'http.response.start':
-                headers = dict(message['headers'])
-                if b'Content-Type' not in headers:
-                    headers[b'Content-Type'] = self.content_type.encode('utf-8')
-                message['headers'] = list(headers.items())
-            await send(message)
-        await self.app(scope, receive, send_wrapper)
 
-# Lets create a Middleware for the use of custom values
-# You can add multiple headers with this middleware separated by comma
-class CustomHeadersMiddleware:
-    def __init__(self, app, headers):
+# Methods with a request body, their Content-Type must be the one we support
+BODY_METHODS = ("POST", "PUT", "PATCH")
+
+# Lets create one pure ASGI middleware for every request and response
+# It validates the request Content-Type, sets the default Content-Type, adds the custom headers and compresses the body
+# A single middleware avoids a wrapper per layer, and BaseHTTPMiddleware tasks and streams that delay streaming responses
+class ServerMiddleware:
+    """
+    Pure ASGI middleware fusing the request validation and the response headers and compression.
+    Headers are encoded once, and only bodies of compressible content types over minimum_size are compressed, SSE is sent as it is.
+    """
+    def __init__(self, app, headers, content_type=constants.HTTP_DEFAULT_CONTENT_TYPE, minimum_size=1000, compresslevel=1, compressible_content_types=constants.HTTP_COMPRESSIBLE_CONTENT_TYPES):
         self.app = app
-        self.headers = headers
+
+        # Header names are lowercase on ASGI, so the custom headers replace the ones set by the response
+        self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+        self.header_names = {name for (name, _) in self.headers}
+        self.content_type = content_type.encode('latin-1')
+
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+        self.compressible_content_types = {value.encode('latin-1') for value in compressible_content_types}
+
+        # The unsupported media error never changes, lets render it once
+        (self.unsupported_media_body, self.unsupported_media_status) = response_builder.set_error_response("request_unsupported_media", "")
 
     async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        # Lets read the request headers we need in one pass
+        request_content_type = None
+        has_body = False
+        accepts_gzip = False
+        for header_name, header_value in scope['headers']:
+            if header_name == b'content-type':
+                request_content_type = header_value
+            elif header_name == b'content-length':
+                has_body = header_value.strip() not in (b'', b'0')
+            elif header_name == b'transfer-encoding':
+                has_body = True
+            elif header_name == b'accept-encoding':
+                accepts_gzip = b'gzip' in header_value.lower()
+
+        start_message = None
+        compressor = None
+        passthrough = not accepts_gzip
+        pending_body = []
+
         async def send_wrapper(message):
+            nonlocal start_message, compressor, passthrough
+
             if message['type'] == 'http.response.start':
-                headers = dict(message['headers'])
-                for header_name, header_value in self.headers.items():
-                    headers[header_name.encode('utf-8')] = header_value.encode('utf-8')
-                message['headers'] = list(headers.items())
-            await send(message)
-        
+                # The custom headers go last, the first Content-Type is the one set by the response
+                content_type = None
+                content_length = None
+                headers = []
+                for header in message['headers']:
+                    header_name = header[0].lower()
+                    if header_name in self.header_names:
+                        continue
+                    if header_name == b'content-type' and content_type is None:
+                        content_type = header[1]
+                    elif header_name == b'content-length':
+                        content_length = int(header[1])
+                    elif header_name == b'content-encoding':
+                        passthrough = True
+                    headers.append(header)
+                if content_type is None:
+                    content_type = self.content_type
+                    headers.append((b'content-type', content_type))
+                headers.extend(self.headers)
+                message['headers'] = headers
+
+                # Lets decide on the headers if we can, so most responses are not held
+                if not passthrough:
+                    passthrough = (
+                        content_type.split(b';')[0].strip().lower() not in self.compressible_content_types
+                        or (content_length is not None and content_length < self.minimum_size)
+                    )
+                if passthrough:
+                    await send(message)
+                else:
+                    # We hold the response start until we know if we are compressing the body
+                    start_message = message
+                return
+
+            if passthrough or message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+            if compressor is None:
+                # The body can arrive in pieces, lets wait until we know if it is big enough
+                pending_body.append(body)
+                body = b''.join(pending_body)
+                if more_body and len(body) < self.minimum_size:
+                    return
+
+                # Small responses are not worth compressing
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start_message)
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+                    return
+
+                compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                headers = [header for header in start_message['headers'] if header[0].lower() != b'content-length']
+                headers.append((b'content-encoding', b'gzip'))
+                headers.append((b'vary', b'Accept-Encoding'))
+
+                if not more_body:
+                    body = compressor.compress(body) + compressor.flush()
+                    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+                    start_message['headers'] = headers
+                    await send(start_message)
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+                    return
+
+                start_message['headers'] = headers
+                await send(start_message)
+
+            body = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+        # Lets check to see if the content type is the one we support
+        # Parameters like charset are dropped, a missing Content-Type is not supported either
+        # Requests without a body, like the cancel of a batch, have nothing to check
+        if scope['method'] in BODY_METHODS and has_body:
+            if request_content_type is None or request_content_type.split(b';')[0].strip().lower() != self.content_type:
+                await send_wrapper({
+                    'type': 'http.response.start',
+                    'status': self.unsupported_media_status,
+                    'headers': [(b'content-length', str(len(self.unsupported_media_body)).encode('latin-1'))],
+                })
+                await send_wrapper({'type': 'http.response.body', 'body': self.unsupported_media_body, 'more_body': False})
+                return
+
         await self.app(scope, receive, send_wrapper)
 
 # Options handlers for the different methods
@@ -77,4 +160,11 @@ async def options_handler_post(request):
     headers = {
         "Access-Control-Allow-Methods": "POST, OPTIONS"
     }
+    return Response(status_code=204, headers=headers)
+
+# Options handlers for GET and POST
+async def options_handler_get_post(request):
+    headers = {
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS"
+    }
     return Response(status_code=204, headers=headers)
\ No newline at end of file
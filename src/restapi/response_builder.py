@@ -1,37 +1,32 @@
 import json
 import src.restapi.constants as constants
 
-# Set error response to return to the client
-def set_error_response(error_code, override_message):
-    if error_code == "invalid_request":
-        status_code = 400
-        message = "The request was unacceptable, often due to a problem with the request parameters."
-        type = constants.ERROR_INVALID_REQUEST
-    elif error_code == "invalid_endpoint":
-        status_code = 400
-        message = "Unrecognized request URL. Please use a valid url endpoint."
-        type = constants.ERROR_INVALID_REQUEST
-    elif error_code == "resource_missing":
-        status_code = 404
-        message = "The requested resource was not found."
-        type = constants.ERROR_INVALID_REQUEST
-    elif error_code == "request_unsupported_method":
-        status_code = 405
-        message = "This requested method is not allowed."
-        type = constants.ERROR_INVALID_REQUEST
-    elif error_code == "request_unsupported_media":
-        status_code = 415
-        message = "Unsupported Media Type. This endpoint requires a Content-Type of application/json"
-        type = constants.ERROR_INVALID_REQUEST
-    elif error_code == "internal_error":
-        status_code = 500
-        message = "An unexpected error occurred. Try again later."
-        type = constants.ERROR_API
-    # Default
-    else:
-        status_code = 500
-        message = "An unexpected error occurred. Try again later."
-        type = constants.ERROR_API
+# Errors we send to the client
+# error_code: (status_code, message, type)
+ERRORS = {
+    "invalid_request": (400, "The request was unacceptable, often due to a problem with the request parameters.", constants.ERROR_INVALID_REQUEST),
+    "invalid_endpoint": (400, "Unrecognized request URL. Please use a valid url endpoint.", constants.ERROR_INVALID_REQUEST),
+    "invalid_api_key": (401, "Incorrect API key provided.", constants.ERROR_INVALID_REQUEST),
+    "resource_missing": (404, "The requested resource was not found.", constants.ERROR_INVALID_REQUEST),
+    "model_not_found": (404, "The requested model does not exist.", constants.ERROR_INVALID_REQUEST),
+    "request_unsupported_method": (405, "This requested method is not allowed.", constants.ERROR_INVALID_REQUEST),
+    "request_unsupported_media": (415, "Unsupported Media Type. This endpoint requires a Content-Type of application/json", constants.ERROR_INVALID_REQUEST),
+    "rate_limit_exceeded": (429, "Rate limit reached for your API key. Please retry after a brief wait.", constants.ERROR_RATE_LIMIT),
+    "queue_full": (429, "The server is overloaded with requests. Please retry after a brief wait.", constants.ERROR_RATE_LIMIT),
+    # Nginx code for a client that closed the connection, nobody reads this response
+    "cancelled": (499, "The request was cancelled because the client closed the connection.", constants.ERROR_API),
+    "timeout": (504, "The request took too long to complete. Try again later.", constants.ERROR_API),
+    "service_unavailable": (503, "The server is not ready to handle the request. Try again later.", constants.ERROR_API),
+    "internal_error": (500, "An unexpected error occurred. Try again later.", constants.ERROR_API),
+}
+
+# Unknown error codes are sent as internal errors
+DEFAULT_ERROR = ERRORS["internal_error"]
+
+# Set error data for the client
+# returns (json_data, status_code)
+def get_error_data(error_code, override_message):
+    (status_code, message, type) = ERRORS.get(error_code, DEFAULT_ERROR)
 
     # Lets see if there is a message override the default one 
     if override_message != "":
@@ -46,7 +41,20 @@ def set_error_response(error_code, override_message):
         }
     }
 
-    # Pretty-print JSON error
-    json_error = json.dumps(json_data, indent=4)
-    
-    return json_error, status_code
\ No newline at end of file
+    return json_data, status_code
+
+# Render an error as compact JSON bytes
+# The errors are small and mostly rendered once, so the standard library is enough here
+def render_error(error_code, override_message):
+    (json_data, status_code) = get_error_data(error_code, override_message)
+    return json.dumps(json_data, separators=(",", ":")).encode("utf-8"), status_code
+
+# The default errors never change, lets render them once
+ERROR_RESPONSES = {error_code: render_error(error_code, "") for error_code in ERRORS}
+
+# Set error response to return to the client
+# returns (json_error, status_code), json_error are bytes
+def set_error_response(error_code, override_message):
+    if override_message == "" and error_code in ERROR_RESPONSES:
+        return ERROR_RESPONSES[error_code]
+    return render_error(error_code, override_message)
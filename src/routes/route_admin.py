@@ -0,0 +1,94 @@
+import hmac
+import asyncio
+import src.restapi.constants as constants
+import src.restapi.json as json_codec
+import src.restapi.response_builder as response_builder
+import src.utils.validators as validators
+from starlette.responses import Response
+from src.ai.model_rate_limit import api_key
+from config import (
+    ADMIN_API_KEY
+)
+
+# Max number of requests of a profile, the trace of every request is kept in memory until it is written
+MAX_PROFILE_REQUESTS = 100
+
+# Json error response
+def error_response(error_code, override_message):
+    (json_error, status_code) = response_builder.set_error_response(error_code, override_message)
+    return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+# Json response
+def json_response(json_data):
+    return Response(content=json_codec.dumps(json_data), media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200)
+
+# The admin routes need ADMIN_API_KEY, without it they do not exist
+# Returns the error response, or None if the request can go ahead
+def check_admin(request):
+    if not ADMIN_API_KEY:
+        return error_response("invalid_endpoint", "")
+    if not hmac.compare_digest(api_key(request.headers, constants.API_KEY_HTTP_HEADER_NAME).encode("utf-8"), ADMIN_API_KEY.encode("utf-8")):
+        return error_response("invalid_api_key", "")
+    return None
+
+# Profile the next requests of a model with torch.profiler, the Chrome trace is written to PROFILE_DIR
+async def start_profile(request, registry, profiles):
+    error = check_admin(request)
+    if error is not None:
+        return error
+
+    try:
+        json_data = json_codec.loads(await request.body() or b"{}")
+    except ValueError:
+        return error_response("invalid_request", "The request was unacceptable, the json body is not valid.")
+    if not isinstance(json_data, dict):
+        return error_response("invalid_request", "The request was unacceptable, the json body must be an object.")
+
+    num_requests = json_data.get("requests", 1)
+    if not isinstance(num_requests, int) or isinstance(num_requests, bool) or not 0 < num_requests <= MAX_PROFILE_REQUESTS:
+        return error_response("invalid_request", f"The request was unacceptable, the parameter `requests` must be between 1 and {MAX_PROFILE_REQUESTS}.")
+
+    model_id = json_data.get("model", "")
+    if validators.is_empty(model_id):
+        model_id = registry.default_model_id
+    if not validators.is_string(model_id) or registry.get(model_id) is None:
+        return error_response("model_not_found", f"The model {model_id} does not exist.")
+
+    try:
+        entry = await registry.acquire(model_id)
+    except Exception:
+        return error_response("service_unavailable", f"The model {model_id} could not be loaded.")
+
+    try:
+        (session, future) = profiles.start(entry.dependencies["engine"], model_id, num_requests)
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            session.status = "failed"
+            session.error = str(e)
+            return error_response("invalid_request", f"The profile could not start: {e}")
+    finally:
+        registry.release(entry)
+
+    return json_response(session.to_json())
+
+# List the profiles, the newest first
+async def list_profiles(request, profiles):
+    error = check_admin(request)
+    if error is not None:
+        return error
+    sessions = sorted(profiles.list(), key=lambda session: session.created_at, reverse=True)
+    return json_response({
+        "object": "list",
+        "data": [session.to_json() for session in sessions]
+    })
+
+# Retrieve a profile, the output file is there once its status is completed
+async def get_profile(request, profiles):
+    error = check_admin(request)
+    if error is not None:
+        return error
+    session = profiles.get(request.path_params["profile_id"])
+    if session is None:
+        return error_response("resource_missing", "")
+    return json_response(session.to_json())
@@ -0,0 +1,86 @@
+import os
+import asyncio
+import src.restapi.constants as constants
+import src.restapi.json as json_codec
+import src.restapi.response_builder as response_builder
+import src.utils.validators as validators
+from starlette.responses import Response, FileResponse
+from src.ai.model_batch import BATCH_ENDPOINT, parse_batch_line, read_batch_file
+
+# Json error response
+def error_response(error_code, override_message):
+    (json_error, status_code) = response_builder.set_error_response(error_code, override_message)
+    return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+# Json response
+def json_response(json_data):
+    return Response(content=json_codec.dumps(json_data), media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200)
+
+# Create a batch
+# https://platform.openai.com/docs/api-reference/batch/create
+# The lines come from input_file_id, a file on BATCH_DIR, or inline on requests, in the same shape as the lines of a batch file
+async def create_batch(request, batches):
+    try:
+        json_data = json_codec.loads(await request.body())
+    except ValueError:
+        return error_response("invalid_request", "The request was unacceptable, the json body is not valid.")
+    if not isinstance(json_data, dict):
+        return error_response("invalid_request", "The request was unacceptable, the json body must be an object.")
+
+    endpoint = json_data.get("endpoint", BATCH_ENDPOINT)
+    if endpoint != BATCH_ENDPOINT:
+        return error_response("invalid_request", f"The request was unacceptable, only the {BATCH_ENDPOINT} endpoint is supported.")
+
+    metadata = json_data.get("metadata")
+    if metadata is not None and not isinstance(metadata, dict):
+        return error_response("invalid_request", "The request was unacceptable, the parameter `metadata` must be an object.")
+
+    input_file_id = json_data.get("input_file_id")
+    lines = json_data.get("requests")
+    if isinstance(lines, list):
+        requests = [parse_batch_line(row, index) for (index, row) in enumerate(lines)]
+    elif input_file_id is not None:
+        path = batches.file_path(input_file_id)
+        if path is None or not os.path.isfile(path):
+            return error_response("resource_missing", f"The input file {input_file_id} does not exist.")
+        requests = await asyncio.to_thread(read_batch_file, path)
+    else:
+        return error_response("invalid_request", "The request was unacceptable, set `input_file_id` or `requests`.")
+
+    if validators.is_empty(requests):
+        return error_response("invalid_request", "The request was unacceptable, the batch has no requests.")
+
+    job = batches.create(requests, input_file_id, metadata)
+    return json_response(job.to_json())
+
+# List the batches, the newest first
+async def list_batches(request, batches):
+    jobs = sorted(batches.list(), key=lambda job: job.created_at, reverse=True)
+    return json_response({
+        "object": "list",
+        "data": [job.to_json() for job in jobs],
+        "has_more": False
+    })
+
+# Retrieve a batch
+async def get_batch(request, batches):
+    job = batches.get(request.path_params["batch_id"])
+    if job is None:
+        return error_response("resource_missing", "")
+    return json_response(job.to_json())
+
+# Cancel a batch, the lines in flight are cancelled and the rest are not run
+async def cancel_batch(request, batches):
+    job = batches.get(request.path_params["batch_id"])
+    if job is None:
+        return error_response("resource_missing", "")
+    job.cancel()
+    return json_response(job.to_json())
+
+# Output file of a batch, one line per finished request
+# It can be read while the batch runs
+async def batch_output(request, batches):
+    job = batches.get(request.path_params["batch_id"])
+    if job is None or not os.path.isfile(job.output_path):
+        return error_response("resource_missing", "")
+    return FileResponse(job.output_path, media_type=constants.HTTP_JSONL_CONTENT_TYPE)
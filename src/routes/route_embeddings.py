@@ -0,0 +1,109 @@
+import src.restapi.constants as constants
+import src.restapi.json as json_codec
+import src.restapi.response_builder as response_builder
+import src.utils.validators as validators
+import src.ai.model_admission as model_admission
+from starlette.responses import Response
+from src.ai.model_engine import GenerationError
+from src.ai.model_rate_limit import api_key
+from src.ai.model_embeddings import ENCODING_FLOAT, ENCODING_FORMATS, encode_vector
+from config import (
+    QUEUE_RETRY_AFTER
+)
+
+# Max number of inputs of one request, same as OpenAI
+MAX_INPUTS = 2048
+
+# Json error response
+def error_response(error_code, override_message, headers=None):
+    (json_error, status_code) = response_builder.set_error_response(error_code, override_message)
+    return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code, headers=headers)
+
+# Token ids input, a non empty list of integers
+def is_token_ids(value):
+    return isinstance(value, list) and len(value) > 0 and all(isinstance(item, int) and not isinstance(item, bool) for item in value)
+
+# The input as a list of strings or token id lists
+# OpenAI takes a string, a list of strings, a list of token ids or a list of token id lists
+# Returns None if it is not valid
+def parse_input(value):
+    if isinstance(value, str):
+        return [value] if value else None
+    if is_token_ids(value):
+        return [value]
+    if not isinstance(value, list) or len(value) == 0 or len(value) > MAX_INPUTS:
+        return None
+    if all(isinstance(item, str) and item for item in value) or all(is_token_ids(item) for item in value):
+        return value
+    return None
+
+# Create embeddings
+# https://platform.openai.com/docs/api-reference/embeddings/create
+async def embeddings(request, registry, metrics, limiter):
+    try:
+        json_data = json_codec.loads(await request.body())
+    except ValueError:
+        return error_response("invalid_request", "The request was unacceptable, the json body is not valid.")
+    if not isinstance(json_data, dict):
+        return error_response("invalid_request", "The request was unacceptable, the json body must be an object.")
+
+    inputs = parse_input(json_data.get("input"))
+    if inputs is None:
+        return error_response("invalid_request", f"The request was unacceptable, the parameter `input` must be a non empty string, token ids or a list of up to {MAX_INPUTS} of them.")
+
+    encoding_format = json_data.get("encoding_format", ENCODING_FLOAT)
+    if encoding_format not in ENCODING_FORMATS:
+        return error_response("invalid_request", f"The request was unacceptable, the parameter `encoding_format` must be {' or '.join(ENCODING_FORMATS)}.")
+
+    # Rate limits of the API key, the same buckets as the completions
+    tenant = limiter.tenant(api_key(request.headers, constants.API_KEY_HTTP_HEADER_NAME))
+    (limit, retry_after) = limiter.check(tenant)
+    if limit is not None:
+        metrics.rate_limited.labels(limit).inc()
+        return error_response(
+            "rate_limit_exceeded",
+            f"Rate limit reached for your API key on {limit} per second. Please retry after {retry_after} seconds.",
+            {constants.HEADER_RETRY_AFTER: str(retry_after)}
+        )
+
+    # model validation
+    # Without a model we use the default one
+    model_id = json_data.get("model", "")
+    if validators.is_empty(model_id):
+        model_id = registry.default_model_id
+    if not validators.is_string(model_id) or registry.get(model_id) is None:
+        return error_response("model_not_found", f"The model {model_id} does not exist.")
+
+    try:
+        entry = await registry.acquire(model_id)
+    except Exception:
+        return error_response("service_unavailable", f"The model {model_id} could not be loaded.")
+
+    try:
+        # The forward passes share the engine thread with the generations, so they hold a place on its queue
+        ticket = entry.dependencies["admission"].enter(model_admission.PRIORITY_DEFAULT, tenant=tenant)
+        if ticket is None:
+            return error_response("queue_full", "", {constants.HEADER_RETRY_AFTER: str(QUEUE_RETRY_AFTER)})
+
+        try:
+            results = await entry.dependencies["embedder"].embed(inputs, entry.dependencies["shared_executor"])
+        except GenerationError as e:
+            return error_response(e.error_code, str(e))
+        finally:
+            ticket.leave()
+    finally:
+        registry.release(entry)
+
+    prompt_tokens = sum(tokens for (_, tokens) in results)
+    return Response(content=json_codec.dumps({
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index, "embedding": encode_vector(vector, encoding_format)}
+            for (index, (vector, _)) in enumerate(results)
+        ],
+        "model": model_id,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "total_tokens": prompt_tokens
+        }
+    }), media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200)
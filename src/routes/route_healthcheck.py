@@ -1,19 +1,51 @@
-import json
+import src.restapi.json as json_codec
 import src.restapi.constants as constants
+import src.restapi.response_builder as response_builder
 from datetime import datetime, timezone
 from starlette.responses import Response
 from version import palmapy_version
 
-async def healthcheck(request):
+# Liveness, the process answers requests
+# It only fails when the model could not be loaded, so the process gets restarted
+async def healthcheck(request, startup):
     # Json data
     json_data = {
-        "status": "ok",
+        "status": "failed" if startup.status == "failed" else "ok",
+        "ready": startup.ready,
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "version": palmapy_version
     }
 
-    # Pretty-print JSON
-    json_pretty = json.dumps(json_data, indent=4)
+    # Compact JSON, the healthchecks are polled all the time
+    json_response = json_codec.dumps(json_data)
 
     # Return the output as a JSON response
-    return Response(content=json_pretty, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200)
\ No newline at end of file
+    status_code = 503 if startup.status == "failed" else 200
+    return Response(content=json_response, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+# Readiness, the model is loaded and takes requests
+# Answers 503 with the load progress until then, and the load of the engine after
+async def readiness(request, startup):
+    # Json data
+    json_data = {
+        **startup.stats(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "version": palmapy_version
+    }
+
+    # Compact JSON, the healthchecks are polled all the time
+    json_response = json_codec.dumps(json_data)
+
+    # Return the output as a JSON response
+    status_code = 200 if startup.ready else 503
+    return Response(content=json_response, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+# Error response of the routes that need the model, while it is not ready
+def not_ready_response(startup):
+    if startup.status == "failed":
+        message = "The model could not be loaded."
+    else:
+        message = f"The model is loading ({startup.stage or 'starting'}, {int(startup.progress() * 100)}%). Try again later."
+
+    (json_error, status_code) = response_builder.set_error_response("service_unavailable", message)
+    return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
@@ -6,56 +6,207 @@ from starlette.responses import Response
 from starlette.responses import StreamingResponse
 import src.ai.model_inference as model_inference
 import src.ai.model_streaming as model_streaming
+import src.ai.model_admission as model_admission
+import src.ai.model_utils as model_utils
+import src.restapi.response_builder as response_builder
+from src.ai.model_engine import GenerationError
+from src.ai.model_metrics import stream_label
+from src.ai.model_cancellation import CancellationToken
+from src.ai.model_rate_limit import api_key
+from src.ai.model_tracing import trace_headers
+from config import (
+    QUEUE_RETRY_AFTER,
+    MAX_CHOICES
+)
+
+# Wait until the client closes the connection
+# The request body must be read already, so the only message left is the disconnect
+async def wait_for_disconnect(request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
 
 # route_inference
-async def inference(request, tokenizer, model, terminators, shared_executor):
+async def inference(request, registry, metrics, limiter, tracer):
+    # Phases of the request, None when it is not traced
+    trace = tracer.start()
+
     # Lets read the json request
     (json_data, json_error, status_code) = await read_json_request(request)
+    if trace is not None:
+        trace.lap("read_json")
     
     # Lets check for errors on the json request
     if not validators.is_empty(json_error):
         return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
 
-    # Create an asyncio Queue to hold the response
-    response_queue = asyncio.Queue()
-
     # stream validation
     # default value of false
     stream = json_data.get("stream", False)
     if not validators.is_bool(stream):
         stream = False
 
+    # n validation, every choice takes a row of the batch so there is a server side cap
+    n = model_utils.get_choices(json_data)
+    if n is None:
+        (json_error, status_code) = response_builder.set_error_response("invalid_request", f"The request was unacceptable, the parameter `n` must be between 1 and {MAX_CHOICES}.")
+        return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+    # max_tokens validation, the engine always generates at least one token
+    if model_utils.get_max_tokens(json_data) is None:
+        (json_error, status_code) = response_builder.set_error_response("invalid_request", "The request was unacceptable, the parameter `max_tokens` must be a positive integer.")
+        return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+    label = stream_label(stream)
+    metrics.requests.labels(label).inc()
+
+    # Rate limits of the API key, before the request takes a place on the queue
+    tenant = limiter.tenant(api_key(request.headers, constants.API_KEY_HTTP_HEADER_NAME))
+    (limit, retry_after) = limiter.check(tenant)
+    if limit is not None:
+        metrics.errors.labels(label, "rate_limit_exceeded").inc()
+        metrics.rate_limited.labels(limit).inc()
+        (json_error, status_code) = response_builder.set_error_response("rate_limit_exceeded", f"Rate limit reached for your API key on {limit} per second. Please retry after {retry_after} seconds.")
+        return Response(
+            content=json_error,
+            media_type=constants.HTTP_DEFAULT_CONTENT_TYPE,
+            status_code=status_code,
+            headers={constants.HEADER_RETRY_AFTER: str(retry_after)}
+        )
+
+    # model validation
+    # Without a model we use the default one
+    model_id = json_data.get("model", "")
+    if validators.is_empty(model_id):
+        model_id = registry.default_model_id
+    if not validators.is_string(model_id) or registry.get(model_id) is None:
+        metrics.errors.labels(label, "model_not_found").inc()
+        (json_error, status_code) = response_builder.set_error_response("model_not_found", f"The model {model_id} does not exist.")
+        return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+    # Lets hold the model while we use it, so it is not unloaded, loading it if it is not resident
+    try:
+        entry = await registry.acquire(model_id)
+    except Exception:
+        metrics.errors.labels(label, "service_unavailable").inc()
+        (json_error, status_code) = response_builder.set_error_response("service_unavailable", f"The model {model_id} could not be loaded.")
+        return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+    if trace is not None:
+        trace.lap("model")
+
+    try:
+        return await complete(request, json_data, stream, n, label, metrics, tenant, trace, tracer, **entry.dependencies)
+    finally:
+        registry.release(entry)
+
+# Generate the completion with the dependencies of the requested model
+# The dependencies of the other routes, like the embedder, are not used here
+async def complete(request, json_data, stream, n, label, metrics, tenant, trace, tracer, model_id, tokenizer, template_cache, model, terminators, shared_executor, engine, completion_cache, admission, **other_dependencies):
+
+    # Admission control, interactive streaming goes ahead of the rest
+    # Within a priority the engine shares the batch between the API keys
+    ticket = admission.enter(model_admission.PRIORITY_INTERACTIVE if stream else model_admission.PRIORITY_DEFAULT, tenant=tenant, trace=trace)
+
+    # If the queue is full, lets tell the client when to retry
+    if ticket is None:
+        metrics.errors.labels(label, "queue_full").inc()
+        (json_error, status_code) = response_builder.set_error_response("queue_full", "")
+        return Response(
+            content=json_error,
+            media_type=constants.HTTP_DEFAULT_CONTENT_TYPE,
+            status_code=status_code,
+            headers={constants.HEADER_RETRY_AFTER: str(QUEUE_RETRY_AFTER)}
+        )
+
+    # Cancelled when the client disconnects, so the engine stops generating for nobody
+    cancellation = CancellationToken()
+
     # if we are doing normal inference
     if not stream:
-        # Schedule the start_generating function to run as a background task
-        asyncio.create_task(
-            model_inference.start_generating(
-                response_queue, 
+        try:
+            # Send the request to the generation engine
+            # Any error while preparing it is raised here
+            future = await model_inference.start_generating(
                 json_data, 
+                model_id,
                 tokenizer, 
-                model, 
+                template_cache, 
+                engine, 
                 terminators, 
-                shared_executor
+                shared_executor,
+                completion_cache,
+                ticket,
+                cancellation,
+                metrics,
+                n
             )
-        )
 
-        # Return the output as a JSON response
-        json_data = await model_inference.catch_token(response_queue)
-        return Response(content=json_data, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200)
+            # Lets wait for the generation, unless the client leaves first
+            disconnect = asyncio.ensure_future(wait_for_disconnect(request))
+            try:
+                await asyncio.wait([future, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                disconnect.cancel()
+            if not future.done():
+                cancellation.cancel()
+                future.cancel()
+                (json_error, status_code) = response_builder.set_error_response("cancelled", "")
+                return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code)
+
+            # Return the output as a JSON response
+            json_data = await model_inference.catch_token(future, model_id)
+            if trace is not None:
+                trace.lap("serialize")
+                tracer.finish(trace, model=model_id, stream=False)
+            return Response(content=json_data, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200, headers=trace_headers(trace))
+        except GenerationError as e:
+            metrics.errors.labels(label, e.error_code).inc()
+            tracer.finish(trace, model=model_id, stream=False, error=e.error_code)
+            (json_error, status_code) = response_builder.set_error_response(e.error_code, "")
+            return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code, headers=trace_headers(trace))
+        except Exception:
+            metrics.errors.labels(label, "internal_error").inc()
+            raise
 
     # if we are streaming
     else:
-        # Schedule the start_streaming function to run as a background task
-        asyncio.create_task(
-            model_streaming.start_streaming(
+        # Create an asyncio Queue to hold the streamed text
+        response_queue = asyncio.Queue()
+
+        try:
+            # Send the request to the generation engine
+            # Any error while preparing it is raised here, before we start streaming
+            await model_streaming.start_streaming(
                 response_queue, 
                 json_data, 
+                model_id,
                 tokenizer, 
-                model, 
+                template_cache, 
+                engine, 
                 terminators, 
-                shared_executor
+                shared_executor,
+                completion_cache,
+                ticket,
+                cancellation,
+                metrics,
+                n
             )
-        )
+        except GenerationError as e:
+            metrics.errors.labels(label, e.error_code).inc()
+            tracer.finish(trace, model=model_id, stream=True, error=e.error_code)
+            (json_error, status_code) = response_builder.set_error_response(e.error_code, "")
+            return Response(content=json_error, media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=status_code, headers=trace_headers(trace))
+        except Exception:
+            metrics.errors.labels(label, "internal_error").inc()
+            raise
 
         # Return a streaming response with SSE media type
-        return StreamingResponse(model_streaming.catch_token(response_queue), media_type='text/event-stream', status_code=200)
\ No newline at end of file
+        # The Server-Timing header has the phases up to the first byte, the server-timing event at the end has all of them
+        return StreamingResponse(
+            model_streaming.catch_token(response_queue, model_id, metrics, cancellation, trace, tracer, n),
+            media_type=constants.HTTP_STREAMING_CONTENT_TYPE,
+            status_code=200,
+            headers=trace_headers(trace)
+        )
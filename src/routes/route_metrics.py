@@ -0,0 +1,6 @@
+import src.restapi.constants as constants
+from starlette.responses import Response
+
+async def metrics(request, metrics):
+    # Prometheus text format
+    return Response(content=metrics.render(), media_type=constants.HTTP_METRICS_CONTENT_TYPE, status_code=200)
@@ -0,0 +1,28 @@
+import src.restapi.json as json_codec
+import src.restapi.constants as constants
+from starlette.responses import Response
+
+# List the models the server can serve
+# https://platform.openai.com/docs/api-reference/models/list
+async def models(request, registry):
+    # Json data, the fields after owned_by are ours
+    json_data = {
+        "object": "list",
+        "data": [
+            {
+                "id": model["id"],
+                "object": "model",
+                "created": registry.created,
+                "owned_by": "palmapy",
+                "default": model["id"] == registry.default_model_id,
+                "loaded": model["loaded"],
+                "pinned": model["pinned"],
+                "memory_bytes": model["memory_bytes"],
+                "in_flight": model["in_flight"]
+            }
+            for model in registry.models()
+        ]
+    }
+
+    # Return the output as a JSON response
+    return Response(content=json_codec.dumps(json_data), media_type=constants.HTTP_DEFAULT_CONTENT_TYPE, status_code=200)
@@ -1,10 +1,11 @@
 # Function to evaluate if the messages are valid
+# A non empty list of objects with a role and a content, checked in a single pass
 # Return True if its valid
 def is_valid_messages(messages):
-    for index, item in enumerate(messages):
-        if "role" not in item:
-            return False
-        if "content" not in item:
+    if not isinstance(messages, list) or len(messages) == 0:
+        return False
+    for item in messages:
+        if not isinstance(item, dict) or "role" not in item or "content" not in item:
             return False
     return True
 
@@ -13,7 +14,7 @@ def is_valid_messages(messages):
 def is_empty(value):
     if value is None:
         return True
-    if isinstance(value, (str, list, dict, set, tuple)):
+    if isinstance(value, (str, bytes, list, dict, set, tuple)):
         return len(value) == 0
     return False
 
@@ -25,4 +26,9 @@ def is_numeric(value):
 # Function to evaluate if a value is bool
 # Return True if its bool
 def is_bool(value):
-    return isinstance(value, bool)
\ No newline at end of file
+    return isinstance(value, bool)
+
+# Function to evaluate if a value is a string
+# Return True if its a string
+def is_string(value):
+    return isinstance(value, str)